@@ -25,6 +25,7 @@ def get_debug():
 class Log:
     def __init__(self):
         self.hist = []
+        self.prefix = ""  # Printed (not saved) before each line. See --multi
 
     def log(self, *a, **k):
         """print() to the log with date"""
@@ -54,7 +55,7 @@ class Log:
         for line in lines:
             with LOCK:
                 self.hist.append((True, line))
-                print(line, **k0)
+                print(self.prefix + line, **k0)
 
     __call__ = log
 
@@ -128,9 +128,15 @@ class Config:
             "compare": ("size", "mtime", "hash"),
             "hash_fail_fallback": ("size", "mtime", None),
             "tag_conflict": (True, False),
+            "state_format": ("single", "delta", "sharded", "packed"),
+            "filelist_store": ("memory", "sqlite"),
+            "rc_daemon": (True, False),
+            "adaptive_threads": (True, False),
+            "list_processes": (True, False),
         }
         for AB in "AB":
             reqs[f"reuse_hashes{AB}"] = True, False
+            reqs[f"lazy_hashes{AB}"] = True, False
             reqs[f"renames{AB}"] = "size", "mtime", "hash", None
 
         reqs["conflict_mode"] = ["tag", None]
@@ -143,6 +149,50 @@ class Config:
                 raise ConfigError(f"'{key}' must be in {options}. Specified '{val}'")
 
         self._config["action_threads"] = int(max([self._config["action_threads"], 1]))
+        self._config["adaptive_threads_min"] = int(
+            min(
+                max(self._config["adaptive_threads_min"], 1),
+                self._config["action_threads"],
+            )
+        )
+        if self._config["watch_delay"] < 0:
+            raise ConfigError("'watch_delay' must be >= 0")
+        if self._config["watch_full_interval"] <= 0:
+            raise ConfigError("'watch_full_interval' must be > 0")
+
+        if self._config["daemon_interval"] is not None:
+            if self._config["daemon_interval"] <= 0:
+                raise ConfigError("'daemon_interval' must be > 0 or None")
+
+        if not self._config["rclone_cache_ttl"]:
+            self._config["rclone_cache_ttl"] = 0
+        if self._config["rclone_cache_ttl"] < 0:
+            raise ConfigError("'rclone_cache_ttl' must be >= 0")
+
+        if not isinstance(self._config["hash_cache"], (bool, str)):
+            raise ConfigError("'hash_cache' must be True, False, or a path")
+
+        if self._config["out_of_core"]:
+            if not self._config["avoid_relist"]:
+                raise ConfigError("out_of_core requires avoid_relist = True")
+            for key in ["reuse_hashes", "lazy_hashes"]:
+                if self._config[f"{key}A"] or self._config[f"{key}B"]:
+                    raise ConfigError(f"out_of_core can not be used with {key}(A/B)")
+            if self._config["hash_cache"]:
+                raise ConfigError("out_of_core can not be used with hash_cache")
+            if self._config["filelist_store"] != "memory":
+                raise ConfigError("out_of_core requires filelist_store = 'memory'")
+            if self._config["state_format"] == "sharded":
+                raise ConfigError("out_of_core can not be used with sharded state")
+
+        if self._config["hash_threads"] is not None:
+            self._config["hash_threads"] = int(max([self._config["hash_threads"], 1]))
+        self._config["state_deltas_max"] = int(max([self._config["state_deltas_max"], 1]))
+        shard_by = self._config["state_shard_by"]
+        if shard_by != "top" and (
+            not isinstance(shard_by, int) or isinstance(shard_by, bool) or shard_by < 1
+        ):
+            raise ConfigError("'state_shard_by' must be 'top' or an integer >= 1")
 
         if self._config["tempdir"] is None:
             import tempfile
@@ -236,6 +286,31 @@ class Config:
         self._config[attr] = value
 
 
+def check_subpath(config):
+    """Validate and normalize config.subpath (--subpath)"""
+    from .rclone import filter_rule
+
+    subpath = config.subpath.strip("/")
+    parts = subpath.split("/")
+    if (
+        not subpath
+        or any(part in {"", ".", ".."} for part in parts)
+        or parts[0] == ".syncrclone"
+        or filter_rule(subpath) is None
+    ):
+        raise ConfigError(f"Invalid --subpath {config.subpath!r}")
+
+    for flag in ["reset_state", "watch", "daemon"]:
+        if config._config[flag]:
+            raise ConfigError(f"Cannot use --subpath with --{flag.replace('_', '-')}")
+    if config.out_of_core:
+        raise ConfigError("--subpath can not be used with out_of_core")
+    if any(flag in {"--include", "--include-from"} for flag in config.filter_flags):
+        # Its implicit exclude of everything else would come after the subpath
+        raise ConfigError("--subpath can not be used with --include filters")
+    config.subpath = subpath
+
+
 DESCRIPTION = "Simple bi-directional sync using rclone"
 EPILOG = """\
 See syncrclone config file template for details and settings
@@ -300,6 +375,14 @@ def cli(argv=None):
             "Can specify multiple times. There is no input validation of any sort."
         ),
     )
+    parser.add_argument(
+        "--refresh-rclone-cache",
+        action="store_true",
+        help=(
+            "Look up the rclone version and remote features again rather than "
+            "using the cached values (see rclone_cache_ttl) and update the cache"
+        ),
+    )
     parser.add_argument(
         "--reset-state",
         action="store_true",
@@ -311,10 +394,68 @@ def cli(argv=None):
             "and then perform a reset."
         ),
     )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help=(
+            "Keep running and sync every daemon_interval or when triggered with "
+            "SIGUSR1 or daemon_socket. The file lists are kept in memory between "
+            "syncs. See the config"
+        ),
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help=(
+            "Keep running and sync the files that change on A (must be local) as "
+            "they change. See watch_delay and watch_full_interval in the config"
+        ),
+    )
+    parser.add_argument(
+        "--subpath",
+        metavar="DIR",
+        help=(
+            "Only sync DIR (relative to the remotes). The rest of the state is kept "
+            "as is. Files moved into or out of DIR are treated as new and deleted"
+        ),
+    )
     parser.add_argument(
         "--version", action="version", version="syncrclone-" + __version__
     )
 
+    multi = parser.add_argument_group(
+        "Multiple pairs",
+        "Run many sync pairs from one command. The flags above apply to all of them "
+        "except --new, --interactive, --break-lock, --daemon, --subpath, and --watch",
+    )
+    multi.add_argument(
+        "--multi",
+        nargs="+",
+        metavar="PATH",
+        help=(
+            "Run the sync for each of these configs instead of configpath. "
+            "Directories are searched for '*.py' configs and "
+            "'.syncrclone/config.py' in it or its subdirectories"
+        ),
+    )
+    multi.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of pairs to run at once. Default %(default)s",
+    )
+    multi.add_argument(
+        "--remote-limit",
+        type=int,
+        default=1,
+        metavar="N",
+        help=(
+            "Maximum number of pairs using the same rclone remote (e.g. 'gdrive:') "
+            "to run at once. Default %(default)s"
+        ),
+    )
+
     if argv is None:
         argv = sys.argv[1:]
 
@@ -332,6 +473,12 @@ def cli(argv=None):
     debug("argv:", argv)
     debug("CLI config:", cliconfig)
 
+    if cliconfig.multi:
+        from . import multi
+
+        return multi.cli(cliconfig)
+    del cliconfig.multi, cliconfig.jobs, cliconfig.remote_limit
+
     try:
         if cliconfig.interactive and cliconfig.dry_run:
             raise ValueError("Cannot set `--dry-run` AND `--interactive`")
@@ -376,6 +523,9 @@ def cli(argv=None):
         for key, val in vars(cliconfig).items():
             setattr(config, key, val)
 
+        if config.subpath is not None:
+            check_subpath(config)
+
         # Reset workdir
         for AB in "AB":
             workdir = getattr(config, f"workdir{AB}")
@@ -388,7 +538,16 @@ def cli(argv=None):
                 )
 
         debug("config:", config)
-        r = SyncRClone(config, break_lock=config.break_lock)
+        if config.break_lock or not (config.watch or config.daemon):
+            r = SyncRClone(config, break_lock=config.break_lock)
+        elif config.daemon:
+            from . import daemon
+
+            r = daemon.run(config)
+        else:
+            from . import watch
+
+            r = watch.run(config)
         if _RETURN:
             return r
         # Do this iff not returning
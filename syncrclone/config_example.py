@@ -111,6 +111,14 @@ rclone_env = {}
 rclone_flagsA = []
 rclone_flagsB = []
 
+# The rclone version and the features of each remote are cached on disk
+# (~/.cache/syncrclone/ or $XDG_CACHE_HOME/syncrclone) so they do not need to
+# be looked up with rclone every run. They are looked up again if the rclone
+# executable, the RCLONE_* environment, or the remote's definition in the rclone
+# config file change or if older than this (seconds). Set to 0 to not use the
+# cache. Use --refresh-rclone-cache to refresh it for one run.
+rclone_cache_ttl = 24 * 60 * 60  # 1 day
+
 ## Sync Options
 
 # How to compare files on A and B. Note that mtime also includes size.
@@ -153,6 +161,35 @@ tag_conflict = False
 reuse_hashesA = False
 reuse_hashesB = False
 
+# Hashes can also be computed lazily. Files are listed without hashes (other
+# than those reused as above) and then hashes are only computed for the files
+# where a decision depends on them: files on both sides with the same size,
+# files with the same size as in the previous state but a different mtime, and
+# possible renames (if renames(A/B) = 'hash'). Everything else is decided
+# without hashes. Implies reuse_hashes(A/B).
+#
+# Files that have never been hashed are compared to the previous state by size
+# and mtime (so the side is always listed with mtime). Files on a side that is
+# not lazy must still have hashes (or see hash_fail_fallback). It is well suited
+# to local or sftp remotes with lots of files on only one side (e.g. the first
+# sync to a new remote).
+lazy_hashesA = False
+lazy_hashesB = False
+
+# When hashes are fetched for some files (reuse_hashes or lazy_hashes), they
+# are split into this many concurrent rclone calls. If None, will use the CPU
+# count for local remotes (since hashing is CPU-bound) and 1 otherwise. Small
+# numbers of files are not split.
+hash_threads = None
+
+# For local remotes, hashes can also be kept in a persistent cache keyed by the
+# device, inode, size, and mtime of the file. Unlike reuse_hashes, this
+# survives renames and --reset-state and is shared by all pairs using the same
+# cache. Set to True to use the default location (~/.cache/syncrclone/ or
+# $XDG_CACHE_HOME/syncrclone) or set a path to the database. Only used when
+# hashes are needed and, if set, implies reuse_hashes on local remotes.
+hash_cache = False
+
 # Some remotes (e.g. S3) require an additional API call to get modtimes. If you
 # are comparing with 'size' of 'hash', you can forgo this API call by setting
 # this to False. Future versions may be smart about this and allow for
@@ -203,6 +240,21 @@ action_threads = 1
 # action_threads = __CPU_COUNT__ // 1.5
 # action_threads = 4
 
+# Alternatively, the concurrency of these actions can adapt to the remote. It
+# starts at adaptive_threads_min and grows by about one thread per round of
+# calls that succeed up to action_threads. Errors, retries or rate limiting
+# reported by rclone, or calls that get much slower halve it.
+adaptive_threads = False
+adaptive_threads_min = 1
+
+# Some actions (renames where the file name changes, including conflict tags, and
+# removing empty directories) are done one item at a time and would otherwise
+# start an rclone process for each. With rc_daemon, a single
+# `rclone rcd` (remote control daemon) is started for each remote (only
+# listening on localhost) and those actions are sent to it instead. The
+# action_threads setting still controls how many run at once.
+rc_daemon = False
+
 # syncrclone does not transfer empty directories however if a directory is
 # empty after a sync and it was NOT empty before (e.g. the directory was moved
 # or deleted), then it can remove them. Note that (a) this only removes
@@ -222,6 +274,65 @@ cleanup_empty_dirsB = None
 # The default used to be False but it is now True. See the docs for more details.
 avoid_relist = True
 
+# The file list (state) of each remote is stored in its workdir and, by
+# default, the full compressed list is uploaded at the end of every run and
+# downloaded at the start of the next. For very large remotes with few changes,
+# the state can instead be stored as a base plus small delta files of just the
+# changes. The deltas are compacted into a new base after `state_deltas_max`
+# deltas or if they get to be half as large as the list.
+#
+#   'single' : A single file. Compatible with older versions of syncrclone
+#   'delta'  : Base plus deltas. Older versions will only read the (outdated)
+#              base so do NOT mix versions with this setting!
+#   'sharded': The list is split into shards by `state_shard_by` plus a small
+#              manifest of them. Only the shards that changed are uploaded and,
+#              with --daemon or --watch, downloaded and read again. Shards are
+#              read in parallel. Older versions can not read it at all! Can not
+#              be used with out_of_core.
+#   'packed' : A binary list that is decompressed to the tempdir and memory-
+#              mapped rather than parsed. The previous files are looked up by
+#              path in it and only those that are not the same on A and B are
+#              kept in memory. Older versions can not read it at all!
+#
+# `state_shard_by` is either "top" for a shard per top-level directory (plus one
+# for the files at the top) or an integer number of buckets to hash paths into.
+# "top" works well if changes are usually in a few directories.
+#
+# Any setting will correctly read the state written by the others.
+state_format = "single"
+state_deltas_max = 50
+state_shard_by = "top"
+
+# For very large remotes (tens of millions of files), the file lists may not fit
+# in memory. With out_of_core, the lists are spilled to sorted files in the
+# tempdir and merged so that only the files that changed (and their previous
+# versions) are held in memory. It is slower for small remotes. Note that it
+# requires avoid_relist = True and can not be used with reuse_hashes,
+# lazy_hashes, or hash_cache (hashes, if needed, are always fetched while
+# listing).
+out_of_core = False
+
+# Where the file lists are held while planning. With 'sqlite', the current and
+# previous lists are moved into a SQLite database in the tempdir once listed
+# and the common files are found with SQL joins. Each list is still read into
+# memory when listed but is freed once stored so planning uses less memory for
+# very large remotes. It is slower for small ones. Can not be used with
+# out_of_core.
+#
+#   'memory' : In memory (default)
+#   'sqlite' : '{tempdir}/filelists.sqlite'. Kept if there is an error
+filelist_store = "memory"
+
+# After rclone lists a remote, parsing and cleaning up the entries is CPU-bound
+# and, since A and B are listed in threads, they are done one at a time. With
+# list_processes, this is done in worker processes instead so A and B are done
+# in parallel. The entries still have to be built here (about a tenth of the
+# work: ~0.3 s vs ~3 s for 500,000 files). It uses more memory (the listing is
+# copied to and from the worker) and starting the workers takes a moment so it
+# only helps for very large remotes on machines with more than one core. Not
+# used with out_of_core.
+list_processes = False
+
 ## Rename Tracking
 
 # Renames can be tracked if the file is unmodified on both sides and only
@@ -248,6 +359,25 @@ renamesB = None
 # status, use rclone_flags = ['--stats','10'] or the like.
 list_status_dt = 10  # sec
 
+## Watch
+# With --watch, syncrclone keeps running and syncs changes on A (which must be
+# local) as they happen. Changes are collected until there are none for
+# watch_delay seconds and then only the changed paths are listed and synced.
+# Changes on B are only found by a full sync which is done at least every
+# watch_full_interval seconds.
+watch_delay = 5  # sec
+watch_full_interval = 60 * 60  # sec
+
+## Daemon
+# With --daemon, syncrclone keeps running and syncs every daemon_interval
+# seconds (or set to None to only sync when triggered). The file lists are kept
+# in memory and the state is only downloaded again if it changed (e.g. another
+# machine synced this pair). A sync can be triggered with SIGUSR1
+# (`kill -USR1 <pid>`) or, if daemon_socket is set to a path, by sending 'sync'
+# to that Unix socket. Send 'stop' to stop it.
+daemon_interval = 60 * 60  # sec
+daemon_socket = None
+
 ## Logs
 
 # All output is printed to stdout and stderr but this can also be saved and
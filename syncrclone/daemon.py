@@ -0,0 +1,140 @@
+"""
+Keep running and sync on a schedule or when triggered (see --daemon).
+
+The new file lists of each sync are kept in memory as the previous lists of the
+next one. The state files are only pulled again if they changed on the remote
+(e.g. another machine synced the pair). See SyncRClone.resident_state.
+
+A sync is triggered by SIGUSR1 or, with daemon_socket, by sending 'sync' to the
+Unix socket. 'stop' stops the daemon after any running sync.
+"""
+import os
+import shutil
+import signal
+import socket
+import threading
+import time
+
+from . import debug, log
+from .cli import ConfigError
+
+_TEST_CYCLES = None  # Stop after this many syncs (after the first). Testing only
+
+
+class Trigger:
+    """Wait for the next sync from the schedule, SIGUSR1, or daemon_socket"""
+
+    def __init__(self, sockpath=None):
+        self.event = threading.Event()
+        self.stopped = False
+        self.sockpath = sockpath
+        self.server = None
+
+        self.handler = None
+        try:
+            self.handler = signal.signal(signal.SIGUSR1, lambda *_: self.event.set())
+        except (AttributeError, ValueError):  # Windows or not the main thread
+            debug("daemon: Can not trigger with SIGUSR1")
+
+        if sockpath:
+            try:
+                os.remove(sockpath)  # From an old run
+            except OSError:
+                pass
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(sockpath)
+            os.chmod(sockpath, 0o600)
+            self.server.listen()
+            threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:  # Closed
+                return
+            with conn:
+                try:
+                    conn.sendall(self.command(conn.makefile("r").readline()))
+                except (OSError, UnicodeDecodeError) as exc:
+                    debug(f"daemon: socket error {exc!r}")
+
+    def command(self, cmd):
+        """Act on cmd and return the reply"""
+        cmd = cmd.strip().lower()
+        if cmd == "sync":
+            self.event.set()
+        elif cmd == "stop":
+            self.stopped = True
+            self.event.set()
+        else:
+            return f"Unknown command {cmd!r}. Use 'sync' or 'stop'\n".encode()
+        return b"OK\n"
+
+    def wait(self, timeout=None):
+        """Wait for a trigger or timeout. Returns False if stopped"""
+        self.event.wait(timeout)
+        self.event.clear()
+        return not self.stopped
+
+    def close(self):
+        if self.handler is not None:
+            signal.signal(signal.SIGUSR1, self.handler)
+        if self.server:
+            self.server.close()
+            try:
+                os.remove(self.sockpath)
+            except OSError:
+                pass
+
+
+def run(config):
+    """Sync and then keep syncing until stopped. Returns the last SyncRClone"""
+    from .main import SyncRClone
+
+    if config.interactive:
+        raise ConfigError("Cannot use --daemon with --interactive")
+    if config.watch:
+        raise ConfigError("Cannot use --daemon with --watch")
+
+    trigger = Trigger(config.daemon_socket)
+    log(f"Running as a daemon (PID {os.getpid()})")
+    if config.daemon_socket:
+        log(f"Listening on '{os.path.abspath(config.daemon_socket)}'")
+
+    try:
+        r = SyncRClone(config)
+        resident = r.resident_state()  # None with --dry-run
+    except BaseException:
+        trigger.close()
+        raise
+    config.reset_state = False  # Only the first
+    cycles = 0
+    try:
+        while _TEST_CYCLES is None or cycles < _TEST_CYCLES:
+            if config.daemon_interval:
+                next_sync = time.strftime(
+                    "%Y-%m-%d %H:%M:%S",
+                    time.localtime(time.time() + config.daemon_interval),
+                )
+                log(f"Next sync at {next_sync} or when triggered")
+            else:
+                log("Next sync when triggered")
+            if not trigger.wait(config.daemon_interval):
+                break
+
+            log.clear()  # Each sync has its own log
+            shutil.rmtree(config.tempdir, ignore_errors=True)
+            try:
+                r = SyncRClone(config, resident=resident)
+                resident = r.resident_state()
+            except Exception as exc:
+                log(f"ERROR: {exc!r}. Will pull the state next time")
+                resident = None
+            cycles += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        trigger.close()
+    log("Stopping --daemon")
+    return r
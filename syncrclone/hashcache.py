@@ -0,0 +1,127 @@
+"""
+Persistent cache of the hashes of local files.
+
+Entries are keyed by (device, inode, size, mtime_ns) so they survive renames
+and state resets and are shared by all pairs that use the same database. The
+path is not part of the key.
+"""
+import json
+import os
+import sqlite3
+import time
+
+from . import debug
+from . import utils
+
+PRUNE_AGE = 90 * 24 * 60 * 60  # Remove entries not used in this long (sec)
+PRUNE_EVERY = 24 * 60 * 60
+
+
+def dbpath(setting):
+    """Database path for the hash_cache config setting"""
+    if setting is True:
+        return utils.cache_dir("hashes.sqlite")
+    return os.path.abspath(os.path.expanduser(setting))
+
+
+def statkey(path):
+    """Cache key for path or None if it cannot be stat'ed or has no inode"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not st.st_ino:  # Some filesystems do not have reliable inodes
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class HashCache:
+    """
+    The SQLite database. Each instance has its own connection so use one per
+    thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+
+        self.db = sqlite3.connect(path, timeout=60)
+        with self.db:
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS hashes(
+                    dev INTEGER,
+                    ino INTEGER,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    hashes TEXT,
+                    used INTEGER,
+                    PRIMARY KEY (dev, ino, size, mtime_ns)
+                )"""
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value)"
+            )
+        self.prune()
+
+    def get(self, keys):
+        """
+        Lookup keys, a dict of {path: statkey}. Returns {path: hashes} for
+        those found. Keys of None are skipped
+        """
+        found = {}
+        used = []
+        for path, key in keys.items():
+            if key is None:
+                continue
+            row = self.db.execute(
+                "SELECT hashes FROM hashes "
+                "WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                key,
+            ).fetchone()
+            if row:
+                found[path] = json.loads(row[0])
+                used.append(key)
+
+        now = int(time.time())
+        with self.db:
+            self.db.executemany(
+                "UPDATE hashes SET used = ? "
+                "WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                ((now, *key) for key in used),
+            )
+        return found
+
+    def set(self, items):
+        """Set items, an iterable of (statkey, hashes). Empty hashes are skipped"""
+        now = int(time.time())
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (*key, json.dumps(hashes, sort_keys=True), now)
+                    for key, hashes in items
+                    if key is not None and hashes
+                ),
+            )
+
+    def prune(self):
+        """Remove old entries (at most once every PRUNE_EVERY)"""
+        now = int(time.time())
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'pruned'").fetchone()
+        if row and now - row[0] < PRUNE_EVERY:
+            return
+        with self.db:
+            cur = self.db.execute(
+                "DELETE FROM hashes WHERE used < ?", (now - PRUNE_AGE,)
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('pruned', ?)", (now,)
+            )
+        debug(f"Pruned {cur.rowcount} entries from hash cache {self.path!r}")
+
+    def close(self):
+        self.db.close()
@@ -6,20 +6,32 @@ import warnings
 
 from . import debug, log
 from . import utils
-from .rclone import Rclone
+from . import outofcore
+from . import packed
+from . import sqlitetable
+from .rclone import Rclone, filter_rule
 from .dicttable import DictTable
 
 _TEST_AVOID_RELIST = False
 
 
 class SyncRClone:
-    def __init__(self, config, break_lock=None):
+    def __init__(self, config, break_lock=None, incremental=None, resident=None):
         """
         Main sync object. If break_lock is not None, will *just* break the
-        locks
+        locks.
+
+        incremental is a (paths, listA, listB) tuple to only list those paths
+        on A and B and take the rest from listA and listB, the lists from the
+        end of the last run (see --watch)
+
+        resident is the resident_state() of the last run in this process to use
+        as the previous lists unless the state changed (see --daemon)
         """
         self.t0 = time.time()
         self.shell_time = 0.0
+        self.timings = {}  # phase: seconds. See mark_time()
+        self._tmark = self.t0
         self.now = time.strftime("%Y-%m-%dT%H%M%S", time.localtime())
         self.now_compact = self.now.replace("-", "")
 
@@ -30,6 +42,7 @@ class SyncRClone:
         # Set workdir and workdir0
 
         self.rclone = Rclone(self.config)
+        self.rclone.resident = resident or {}
 
         self.run_shell(pre=True)
 
@@ -44,34 +57,74 @@ class SyncRClone:
         log("")
         log("Refreshing file lists concurrently")
 
+        if config.set_lock:  # Check while listing
+            lock_threads = {
+                AB: utils.ReturnThread(
+                    target=self.rclone.check_lock, kwargs=dict(remote=AB)
+                ).start()
+                for AB in "AB"
+            }
+
+        self.incremental = incremental
+        only = sorted(incremental[0]) if incremental else None
+        if incremental:
+            log(f"Only listing {len(only)} changed paths")
+        if config.subpath:
+            log(f"Only syncing '{config.subpath}'")
+
         listA = utils.ReturnThread(
-            target=self.rclone.file_list, kwargs=dict(remote="A")
+            target=self.rclone.file_list, kwargs=dict(remote="A", only=only)
         ).start()
-        time.sleep(2e-6)  # 2 microseconds just to make sure the time_ns() changes
         listB = utils.ReturnThread(
-            target=self.rclone.file_list, kwargs=dict(remote="B")
+            target=self.rclone.file_list, kwargs=dict(remote="B", only=only)
         ).start()
 
         self.currA, self.prevA = listA.join()
+        if incremental:
+            self.currA = self.merge_listing(self.currA, incremental[1], only)
         log(f"Refreshed file list on A '{config.remoteA}'")
         log(utils.file_summary(self.currA))
 
         self.currB, self.prevB = listB.join()
+        if incremental:
+            self.currB = self.merge_listing(self.currB, incremental[2], only)
         log(f"Refreshed file list on B '{config.remoteB}'")
         log(utils.file_summary(self.currB))
+        del listA, listB  # They hold the lists too (see store_lists)
+
+        if config.subpath:
+            self.split_subpath()
 
         if config.set_lock:
-            self.rclone.check_lock()
+            for thread in lock_threads.values():
+                thread.join()  # Will raise LockedRemoteError
             if not config.dry_run:  # no lock for dry-run since we won't change anything
                 self.rclone.lock()
 
-        # Store the original "curr" list as the prev list for speeding
-        # up the hashes. Also used to tag checking.
-        # This makes a copy but keeps the items
-        self.currA0 = self.currA.copy()
-        self.currB0 = self.currB.copy()
+        self.fetch_lazy_hashes()
+
+        if config.filelist_store == "sqlite":
+            self.store_lists()
+            self.store_state_lists()
+
+        self.mark_time("listing")
+
+        if config.out_of_core:
+            self.remove_common_files_ooc()  # Also sets currA0 and currB0
+        else:
+            # Store the original "curr" list as the prev list for speeding
+            # up the hashes. Also used to tag checking.
+            # This makes a copy but keeps the items
+            self.currA0 = self.currA.copy()
+            self.currB0 = self.currB.copy()
+
+            self.remove_common_files()
+
+        # Index the original directories now since avoid_relist may modify
+        # the items in currA0 and currB0
+        self.dirindexA = utils.DirIndex(f["Path"] for f in self.currA0)
+        self.dirindexB = utils.DirIndex(f["Path"] for f in self.currB0)
 
-        self.remove_common_files()
         self.process_non_common()  # builds new,del,tag,backup,trans,move lists
 
         self.echo_queues("Initial")
@@ -89,6 +142,8 @@ class SyncRClone:
 
         self.echo_queues("After processing new and tags")
 
+        self.mark_time("planning")
+
         if config.dry_run:
             self.summarize(dry=True)
             self.run_shell(pre=False)  # has a --dry-run catch
@@ -109,6 +164,8 @@ class SyncRClone:
         else:
             self.summarize(dry=False)
 
+        self.mark_time("summary")
+
         ## Perform deletes, backups, and moves
 
         # Do actions. Clear the backup list if not using rather than keep around.
@@ -128,6 +185,8 @@ class SyncRClone:
         if config.backup and (self.delB or self.backupB):
             log(f"""Backups for B stored in '{self.rclone.backup_path["B"]}'""")
 
+        self.mark_time("actions")
+
         # Add the backed up files to be transfered too. This way the backups
         # are on *both* systems. Only del and backup lists add to the backup.
         # Keep as part of the single transfer
@@ -158,18 +217,29 @@ class SyncRClone:
         log(f"A <<< B {self.sumB}")
         self.rclone.transfer("B2A", *self.split_transfer_lists_matching_size("B2A"))
 
+        self.mark_time("transfers")
+
         # Update lists if needed
         log("")
         if self.config.avoid_relist:
             log("Apply changes to file lists instead of refreshing")
             new_listA, new_listB = self.avoid_relist()
+            if config.out_of_core:  # Add back the common files
+                new_listA = outofcore.MergedFiles(
+                    self.commonA, sorted(new_listA, key=lambda f: f["Path"])
+                )
+                new_listB = outofcore.MergedFiles(
+                    self.commonB, sorted(new_listB, key=lambda f: f["Path"])
+                )
         else:
+            only = self.touched_paths() if incremental else None
+
             refreshA = self.delA or self.backupA or self.movesA or self.transB2A
             if refreshA:
                 log("Refreshing file list on A (concurrently if needed)")
                 threadA = utils.ReturnThread(
                     target=self.rclone.file_list,
-                    kwargs=dict(remote="A", prev_list=self.currA0),
+                    kwargs=dict(remote="A", prev_list=self.currA0, only=only),
                 ).start()
             else:
                 log("No need to refresh file list on A")
@@ -178,12 +248,9 @@ class SyncRClone:
             refreshB = self.delB or self.backupB or self.movesB or self.transA2B
             if refreshB:
                 log("Refreshing file list on B (concurrently if needed)")
-                if refreshA:
-                    # 2 microseconds just to make sure the time_ns() changes
-                    time.sleep(2e-6)
                 threadB = utils.ReturnThread(
                     target=self.rclone.file_list,
-                    kwargs=dict(remote="B", prev_list=self.currB0),
+                    kwargs=dict(remote="B", prev_list=self.currB0, only=only),
                 ).start()
             else:
                 log("No need to refresh file list on B")
@@ -192,28 +259,31 @@ class SyncRClone:
             # Wait for threads if needed
             if refreshA:
                 new_listA, _ = threadA.join()
+                if only is not None:
+                    new_listA = self.merge_listing(new_listA, self.currA0, only)
                 log("Refresh file list on A")
                 log(utils.file_summary(new_listA))
             if refreshB:
                 new_listB, _ = threadB.join()
+                if only is not None:
+                    new_listB = self.merge_listing(new_listB, self.currB0, only)
                 log("Refresh file list on B")
                 log(utils.file_summary(new_listB))
 
+        self.mark_time("relist")
+
         if config.cleanup_empty_dirsA or (
             config.cleanup_empty_dirsA is None and self.rclone.empty_dir_support("A")
         ):
-            emptyA = {os.path.dirname(f["Path"]) for f in self.currA0} - {
-                os.path.dirname(f["Path"]) for f in new_listA
-            }
-            self.rclone.rmdirs("A", emptyA)
+            self.rclone.rmdirs("A", self.empty_dirs("A", new_listA))
 
         if config.cleanup_empty_dirsB or (
             config.cleanup_empty_dirsB is None and self.rclone.empty_dir_support("B")
         ):
-            emptyB = {os.path.dirname(f["Path"]) for f in self.currB0} - {
-                os.path.dirname(f["Path"]) for f in new_listB
-            }
-            self.rclone.rmdirs("B", emptyB)
+            self.rclone.rmdirs("B", self.empty_dirs("B", new_listB))
+
+        self.rclone.stop_daemons()
+        self.mark_time("cleanup")
 
         ######## For testing only
         if _TEST_AVOID_RELIST:
@@ -229,16 +299,44 @@ class SyncRClone:
                     fout,
                 )
         ########
+        if config.subpath:
+            new_listA = self.merge_subpath(new_listA, self.prevA_full)
+            new_listB = self.merge_subpath(new_listB, self.prevB_full)
         self.new_listA, self.new_listB = new_listA, new_listB
 
-        log("Uploading filelists")
-        self.rclone.push_file_list(new_listA, remote="A")
-        self.rclone.push_file_list(new_listB, remote="B")
+        log("Uploading filelists concurrently")
+        utils.join_all(
+            {
+                AB: utils.ReturnThread(
+                    target=self.rclone.push_file_list,
+                    args=(new_list,),
+                    kwargs=dict(remote=AB),
+                ).start()
+                for AB, new_list in [("A", new_listA), ("B", new_listB)]
+            },
+            what="Uploading file list",
+        )
+
+        # For the next run (see resident_state). Taken before the lock is
+        # released so they can only be of the state just written
+        if (config.daemon or config.watch) and not config.out_of_core:
+            self.signatures = utils.join_all(
+                {
+                    AB: utils.ReturnThread(
+                        target=self.rclone.state_signature, args=(AB,)
+                    ).start()
+                    for AB in "AB"
+                },
+                what="State signature",
+            )
 
         # There shouldn't be a lock since we didn't set it so save the rclone call
         if self.config.set_lock:
             self.rclone.lock(breaklock=True)
 
+        self.mark_time("push")
+        debug("Timings:", self.timings)
+
         self.stats()
 
         self.run_shell(pre=False)
@@ -246,6 +344,92 @@ class SyncRClone:
             log(line)
         self.dump_logs()
 
+    def resident_state(self):
+        """
+        What to keep in memory for the next run (see --daemon and --watch). For
+        A and B, the new list, the state info, and the signature of the state
+        files as written (taken after the upload while still locked) so the
+        next run only pulls them if they changed. None if there are no new lists
+        (e.g. --dry-run) or with out_of_core
+        """
+        if not hasattr(self, "signatures"):
+            return None
+        resident = {}
+        for AB, signature in self.signatures.items():
+            new_list = getattr(self, f"new_list{AB}")
+            if not isinstance(new_list, DictTable):  # e.g. SQLite in the tempdir
+                new_list = DictTable(
+                    new_list, fixed_attributes=["Path", "Size", "mtime"]
+                )
+            resident[AB] = {
+                "list": new_list,
+                "info": self.rclone.state_info.get(AB),
+                "signature": signature,
+            }
+        return resident
+
+    def split_subpath(self):
+        """
+        With --subpath, only the files in it were listed. Plan with just the
+        previous files in it too but keep the full lists for merge_subpath()
+        """
+        prefix = f"{self.config.subpath}/"
+        for AB in "AB":
+            prev = getattr(self, f"prev{AB}")
+            setattr(self, f"prev{AB}_full", prev)
+            setattr(
+                self,
+                f"prev{AB}",
+                DictTable(
+                    [f for f in prev if f["Path"].startswith(prefix)],
+                    fixed_attributes=["Path", "Size", "mtime"],
+                ),
+            )
+
+    def merge_subpath(self, new_list, prev_full):
+        """
+        The full list for the state: new_list (in --subpath) and the previous
+        files outside of it. Anything moved across the boundary looks deleted
+        on one side of it and will be new on the other at the next full sync
+        """
+        prefix = f"{self.config.subpath}/"
+        files = [f for f in prev_full if not f["Path"].startswith(prefix)]
+        files.extend(new_list)
+        return DictTable(files, fixed_attributes=["Path", "Size", "mtime"])
+
+    def merge_listing(self, files, base, paths):
+        """
+        Files listed for only paths with the rest from base (e.g. the last
+        full list) as a new DictTable
+        """
+        paths = set(paths)
+        files = list(files)
+        files.extend(dict(file) for file in base if file["Path"] not in paths)
+        return DictTable(files, fixed_attributes=["Path", "Size", "mtime"])
+
+    def touched_paths(self):
+        """
+        All paths that were listed incrementally or acted on (on either side)
+        so they can be the only ones relisted. None if they can not all be
+        """
+        paths = set(self.incremental[0])
+        for AB in "AB":
+            paths.update(getattr(self, f"del{AB}"))
+            paths.update(getattr(self, f"backup{AB}"))
+            for move in getattr(self, f"moves{AB}"):
+                paths.update(move)
+        paths.update(self.transA2B)
+        paths.update(self.transB2A)
+        if any(filter_rule(path) is None for path in paths):
+            return None  # Relist all
+        return sorted(paths)
+
+    def mark_time(self, phase):
+        """Record the time since the last mark (or start) as phase"""
+        now = time.time()
+        self.timings[phase] = now - self._tmark
+        self._tmark = now
+
     def dump_logs(self):
         if not self.config.local_log_dest and not self.config.save_logs:
             log("Logs are not being saved")
@@ -273,8 +457,15 @@ class SyncRClone:
             shutil.copy2(tfile, dest)
 
         if self.config.save_logs:
-            self.rclone.copylog("A", tfile, logname)
-            self.rclone.copylog("B", tfile, logname)
+            utils.join_all(
+                {
+                    AB: utils.ReturnThread(
+                        target=self.rclone.copylog, args=(AB, tfile, logname)
+                    ).start()
+                    for AB in "AB"
+                },
+                what="Uploading log",
+            )
 
     def summarize(self, dry=False):
         """
@@ -339,12 +530,139 @@ class SyncRClone:
                     pa = f"{attr}{AB}"
                 debug("   ", pa, getattr(self, pa))
 
+    def empty_dirs(self, remote, new_list):
+        """
+        The top-most directories that had files before but do not after. With
+        out_of_core, only the changed files are in memory so the common files
+        are added if there are any candidates
+        """
+        AB = remote
+        index = getattr(self, f"dirindex{AB}")
+        index.reset()
+        if self.config.out_of_core:
+            new_list = new_list.lists[-1]  # Just the changed files
+        index.update(f["Path"] for f in new_list)
+        if self.config.subpath:  # Never the subpath itself or above
+            index.add(f"{self.config.subpath}/")
+
+        if self.config.out_of_core and index.empty():
+            index.update(f["Path"] for f in getattr(self, f"common{AB}"))
+        return index.empty()
+
+    def fetch_lazy_hashes(self):
+        """
+        With lazy_hashes(A/B), the files were listed without hashes (other than
+        those reused from prev). Find the files where a decision depends on the
+        hash and fetch only those. See compare() for how files that are never
+        hashed are handled.
+        """
+        config = self.config
+        lazy = {
+            AB: getattr(config, f"lazy_hashes{AB}")
+            and "hash" in [config.compare, getattr(config, f"renames{AB}")]
+            for AB in "AB"
+        }
+        if not any(lazy.values()):
+            return
+
+        curr = {"A": self.currA, "B": self.currB}
+        prev = {"A": self.prevA, "B": self.prevB}
+        paths = {AB: {file["Path"]: file for file in curr[AB]} for AB in "AB"}
+        needed = {"A": set(), "B": set()}
+
+        def unhashed(file):
+            return "Hashes" not in file
+
+        def samesize(file1, file2):  # Treat unknown sizes (-1) as the same
+            return file1["Size"] == file2["Size"] or min(
+                file1["Size"], file2["Size"]
+            ) < 0
+
+        if config.compare == "hash":
+            # Common paths are compared to each other
+            for path in paths["A"].keys() & paths["B"].keys():
+                fileA, fileB = paths["A"][path], paths["B"][path]
+                if not samesize(fileA, fileB):
+                    continue
+                for AB, file in [("A", fileA), ("B", fileB)]:
+                    if lazy[AB] and unhashed(file):
+                        needed[AB].add(path)
+
+            # And may be compared to prev
+            for AB in "AB":
+                if not lazy[AB]:
+                    continue
+                for path, file in paths[AB].items():
+                    if not unhashed(file) or path in needed[AB]:
+                        continue
+                    prevfile = prev[AB][{"Path": path}]
+                    if prevfile and not unhashed(prevfile) and samesize(file, prevfile):
+                        needed[AB].add(path)
+
+        # New files that may be renames of a file no longer there
+        for AB, BA in ["AB", "BA"]:
+            if not lazy[AB] or getattr(config, f"renames{AB}") != "hash":
+                continue
+            gone_sizes = {
+                file["Size"]
+                for file in packed.lazy(prev[AB])
+                if file["Path"] not in paths[AB] and not unhashed(file)
+            }
+            for path, file in paths[AB].items():
+                if (
+                    unhashed(file)
+                    and file["Size"] in gone_sizes
+                    and path not in paths[BA]
+                    and not prev[AB][{"Path": path}]
+                ):
+                    needed[AB].add(path)
+
+        for AB in "AB":
+            if not lazy[AB]:
+                continue
+            nunhashed = sum(1 for file in curr[AB] if unhashed(file))
+            log(
+                f"Lazy hashes on {AB}: {len(needed[AB])} of {nunhashed} "
+                "unhashed files are needed"
+            )
+            if needed[AB]:
+                self.rclone.fetch_hashes(AB, curr[AB], needed[AB])
+
+    def store_lists(self):
+        """
+        Move the curr and prev lists into a sqlitetable.FileListDB in the tempdir.
+        See filelist_store in the config
+        """
+        dbpath = os.path.join(self.config.tempdir, "filelists.sqlite")
+        self.listdb = sqlitetable.FileListDB(dbpath)
+        for attr in ["currA", "prevA", "currB", "prevB"]:
+            setattr(self, attr, self.listdb.table(getattr(self, attr), name=attr))
+        debug(f"Stored file lists in {dbpath!r}")
+
+    def store_state_lists(self):
+        """
+        The pulled state is also kept for a delta (see Rclone.push_file_list).
+        Store it too (or drop it) after store_lists() so nothing holds the
+        in-memory lists
+        """
+        for AB in "AB":
+            info = self.rclone.state_info.get(AB)
+            if not info or info.get("list") is None:
+                continue
+            if self.config.state_format == "delta":
+                info["list"] = self.listdb.table(info["list"], name=f"state{AB}")
+            else:
+                info["list"] = None  # Only used for a delta
+
     def remove_common_files(self):
         """
         Removes files common in the curr list from the curr lists and,
         if present, the prev lists
         """
         config = self.config
+        if config.filelist_store == "sqlite":
+            return self.remove_common_files_sql()
+
         commonPaths = set(file["Path"] for file in self.currA)
         commonPaths.intersection_update(file["Path"] for file in self.currB)
 
@@ -357,9 +675,14 @@ class SyncRClone:
                 continue
             delpaths.add(path)
 
+        # A packed prev list only decodes the entries that are kept
         for attr in ["currA", "prevA", "currB", "prevB"]:
             new = DictTable(
-                [f for f in getattr(self, attr) if f["Path"] not in delpaths],
+                [
+                    f if isinstance(f, dict) else dict(f)
+                    for f in packed.lazy(getattr(self, attr))
+                    if f["Path"] not in delpaths
+                ],
                 fixed_attributes=["Path", "Size", "mtime"],
             )
             setattr(self, attr, new)
@@ -368,6 +691,60 @@ class SyncRClone:
             f"Found {len(commonPaths)} common paths with {len(delpaths)} matching files"
         )
 
+    def remove_common_files_sql(self):
+        """
+        SQLite version of remove_common_files. The common paths are found with a
+        join and, where possible, compared in SQL. Only the pairs that need it
+        (e.g. hashes) are compared with compare()
+        """
+        config = self.config
+        common = sqlitetable.common_paths(
+            self.currA, self.currB, config.compare, config.dt, self.compare
+        )
+        for attr in ["currA", "prevA", "currB", "prevB"]:
+            getattr(self, attr).remove_paths(common)
+
+    def remove_common_files_ooc(self):
+        """
+        Out-of-core version of remove_common_files. currA, currB, prevA, and
+        prevB are outofcore.SortedFiles so they are merged by path. Files that
+        are the same on both sides are spilled into commonA and commonB (only
+        needed at the end) and the rest are kept in memory as usual.
+        """
+        attribs = ["currA", "currB", "prevA", "prevB"]
+        kept = {attr: [] for attr in attribs}
+        self.commonA = outofcore.SortedFiles(self.config.tempdir, "commonA")
+        self.commonB = outofcore.SortedFiles(self.config.tempdir, "commonB")
+
+        # A packed prev list only decodes the path unless the file is kept
+        ncommon = 0
+        for path, files in outofcore.merge_by_path(
+            *(packed.lazy(getattr(self, attr)) for attr in attribs)
+        ):
+            fileA, fileB, _, _ = files
+            if fileA and fileB:
+                ncommon += 1
+                if self.compare(fileA, fileB):
+                    self.commonA.add(fileA)
+                    self.commonB.add(fileB)
+                    continue
+            for attr, file in zip(attribs, files):
+                if file is not None:  # Not truthiness. That decodes a LazyFile
+                    kept[attr].append(file if isinstance(file, dict) else dict(file))
+        self.commonA.finish()
+        self.commonB.finish()
+
+        for attr in attribs:
+            new = DictTable(kept[attr], fixed_attributes=["Path", "Size", "mtime"])
+            setattr(self, attr, new)
+        self.currA0 = self.currA.copy()
+        self.currB0 = self.currB.copy()
+
+        debug(
+            f"Found {ncommon} common paths with {len(self.commonA)} matching files. "
+            f"Kept {len(self.currA)} on A and {len(self.currB)} on B in memory"
+        )
+
     def process_non_common(self):
         """
         Create action lists (some need more processing) and then populate
@@ -416,7 +793,7 @@ class SyncRClone:
                 if not fileBp:
                     debug(f"File '{path}' is new on B")
                     self.newB.append(path)  # B is new
-                elif self.compare(fileB, fileBp):
+                elif self.compare(fileB, fileBp, sides="BB"):
                     debug(f"File '{path}' deleted on A")
                     self.delB.append(path)  # B must have been deleted on A
                 else:
@@ -430,7 +807,7 @@ class SyncRClone:
                 if not fileAp:
                     debug(f"File '{path}' is new on A")
                     self.newA.append(path)  # A is new
-                elif self.compare(fileA, fileAp):
+                elif self.compare(fileA, fileAp, sides="AA"):
                     debug(f"File '{path}' deleted on A")
                     self.delA.append(path)  # A must have been deleted on B
                 else:
@@ -442,8 +819,8 @@ class SyncRClone:
 
             # We *know* they do not agree since this common ones were removed.
             # Now must decide if this is a conflict or just one was modified
-            compA = self.compare(fileA, fileAp)
-            compB = self.compare(fileB, fileBp)
+            compA = self.compare(fileA, fileAp, sides="AA")
+            compB = self.compare(fileB, fileBp, sides="BB")
 
             debug(
                 f"Resolving:\n{json.dumps({'A':fileA,'Ap':fileAp,'B':fileB,'Bp':fileB},indent=1)}"
@@ -649,8 +1026,11 @@ class SyncRClone:
 
         trans.extend(new)
 
-    def compare(self, file1, file2):
-        """Compare file1 and file2 (may be A or B or curr and prev)"""
+    def compare(self, file1, file2, sides="AB"):
+        """
+        Compare file1 and file2 (may be A or B or curr and prev). sides is the
+        remote each file came from (e.g. "AB" or "AA" for curr and prev of A)
+        """
         config = self.config
         compare = (
             config.compare
@@ -681,7 +1061,15 @@ class SyncRClone:
             else:
                 msg = "One or both remotes are missing hashes"
 
-            if config.hash_fail_fallback:
+            # Sides missing hashes. Only lazy sides may skip hashing
+            unhashed = [
+                AB for AB, file in zip(sides, [file1, file2]) if "Hashes" not in file
+            ]
+            if unhashed and all(getattr(config, f"lazy_hashes{AB}") for AB in unhashed):
+                # Never hashed because it wasn't needed (or, if prev, couldn't be).
+                # Fall back silently to size and mtime
+                compare = "mtime"
+            elif config.hash_fail_fallback:
                 msg += f". Falling back to '{config.hash_fail_fallback}'"
                 warnings.warn(msg)
                 compare = config.hash_fail_fallback
@@ -695,7 +1083,7 @@ class SyncRClone:
         if compare == "size":  # No need to compare mtime
             return True
 
-        if "mtime" not in file1 or "mtime" not in file2:
+        if file1.get("mtime") is None or file2.get("mtime") is None:
             warnings.warn(f"File do not have mtime. Using only size")
             return True  # Only got here size is equal
 
@@ -876,5 +1264,8 @@ class SyncRClone:
         dt = utils.time_format(time.time() - self.t0)
         dt_rclone = utils.time_format(self.rclone.rclonetime)
         dt_shell = utils.time_format(self.shell_time)
-        txt.append(f"Time: {dt} (rclone {dt_rclone}, shell {dt_shell})")
+        txt.append(
+            f"Time: {dt} (rclone {dt_rclone} in {self.rclone.rclonecalls} calls, "
+            f"shell {dt_shell})"
+        )
         return "\n".join(txt)
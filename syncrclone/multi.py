@@ -0,0 +1,209 @@
+"""
+Run the sync for many configs (pairs) from one command (see --multi).
+
+With one job, they all run in this process. Otherwise they run in a pool of
+worker processes (config parsing changes the working directory so pairs can not
+share one) that each run many pairs. Either way, the rclone version check and
+remote features are only looked up once per process (see Rclone).
+
+Pairs that share a remote (e.g. 'gdrive:') are not run at the same time unless
+allowed by --remote-limit.
+"""
+import contextlib
+import io
+import os
+import re
+import shutil
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from glob import glob
+
+from . import log
+from . import utils
+from . import cli as _cli
+
+
+def find_configs(paths):
+    """
+    Config files from paths. Directories are searched for '*.py' configs and
+    '.syncrclone/config.py' in it or any of its subdirectories
+    """
+    configs = []
+    for path in paths:
+        if not os.path.isdir(path):
+            configs.append(path)
+            continue
+        configs.extend(glob(os.path.join(path, ".syncrclone", "config.py")))
+        configs.extend(sorted(glob(os.path.join(path, "*.py"))))
+        subconfigs = glob(os.path.join(path, "*", ".syncrclone", "config.py"))
+        configs.extend(sorted(subconfigs))
+
+    configs = [os.path.abspath(config) for config in configs]
+    return list(dict.fromkeys(configs))  # Unique but in order
+
+
+def remote_key(remote):
+    """
+    The rclone remote of a remote path, e.g. 'gdrive:' for 'gdrive:sub/dir'
+    or None for a local path
+    """
+    m = re.match(r"^(:?[^:/\\]+):", remote)
+    if not m or len(m.group(1)) == 1:  # Also Windows drive letters
+        return None
+    return m.group(0)
+
+
+def remote_keys(configpath, override=""):
+    """Parse the config and return the set of remote keys it uses"""
+    cwd = os.getcwd()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            config = _cli.Config(configpath)
+            config.parse(skiplog=True, override=override)
+    finally:
+        os.chdir(cwd)
+        log.clear()
+    keys = {remote_key(getattr(config, f"remote{AB}")) for AB in "AB"}
+    keys.discard(None)
+    return keys
+
+
+def run_one(configpath, argv, label=""):
+    """
+    Run the sync for configpath with the (other) cli argv. Returns a result
+    dict. Does not raise.
+    """
+    t0 = time.time()
+    cwd = os.getcwd()
+    ret0 = _cli._RETURN
+    log.clear()
+    log.prefix = f"[{label}] " if label else ""
+
+    res = {"config": configpath, "status": "OK", "error": None, "stats": ""}
+    try:
+        _cli._RETURN = True
+        r = _cli.cli([configpath] + argv)
+        if r is not None:
+            try:
+                res["stats"] = r.stats()
+            except AttributeError:  # Did not get that far (e.g. dry-run)
+                pass
+            shutil.rmtree(r.config.tempdir, ignore_errors=True)
+    except SystemExit as exc:
+        if exc.code:
+            res["status"], res["error"] = "FAILED", f"exit {exc.code}"
+    except Exception as exc:  # --debug re-raises
+        res["status"], res["error"] = "FAILED", repr(exc)
+    finally:
+        _cli._RETURN = ret0
+        log.prefix = ""
+        os.chdir(cwd)
+
+    res["time"] = time.time() - t0
+    return res
+
+
+def run(configs, argv, jobs=1, remote_limit=1, override=""):
+    """
+    Run all configs with at most jobs at once and remote_limit per remote.
+    Returns the list of result dicts (in the order of configs)
+    """
+    results = {}
+    keys = {}
+    for config in configs:
+        try:
+            keys[config] = remote_keys(config, override=override)
+        except Exception as exc:
+            log(f"ERROR: Could not read '{config}': {exc!r}")
+            results[config] = {
+                "config": config,
+                "status": "FAILED",
+                "error": repr(exc),
+                "stats": "",
+                "time": 0.0,
+            }
+    pending = [config for config in configs if config in keys]
+    labels = {config: f"{ii}" for ii, config in enumerate(configs)}
+
+    if jobs <= 1:
+        for config in pending:
+            log(f"Running [{labels[config]}] '{config}'")
+            results[config] = run_one(config, argv, label=labels[config])
+        return [results[config] for config in configs]
+
+    busy = Counter()
+    running = {}  # future:config
+    with ProcessPoolExecutor(max_workers=jobs) as exe:
+        while pending or running:
+            for config in pending.copy():
+                if len(running) >= jobs:
+                    break
+                if any(busy[key] >= remote_limit for key in keys[config]):
+                    continue
+                pending.remove(config)
+                busy.update(keys[config])
+                log(f"Running [{labels[config]}] '{config}'")
+                fut = exe.submit(run_one, config, argv, label=labels[config])
+                running[fut] = config
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                config = running.pop(fut)
+                busy.subtract(keys[config])
+                results[config] = fut.result()
+
+    return [results[config] for config in configs]
+
+
+def summarize(results):
+    """Log the summary and return whether all were OK"""
+    nfailed = sum(res["status"] != "OK" for res in results)
+    total = utils.time_format(sum(res["time"] for res in results))
+    log("")
+    log(
+        f"Multi summary: {len(results) - nfailed} OK, {nfailed} FAILED. "
+        f"Total sync time {total}"
+    )
+    for ii, res in enumerate(results):
+        dt = utils.time_format(res["time"])
+        log(f"  [{ii}] {res['status']:<6s} {dt:>10s} '{res['config']}'")
+        if res["error"]:
+            log(f"        {res['error']}")
+        for line in res["stats"].split("\n"):
+            if line:
+                log(f"        {line}")
+    return not nfailed
+
+
+def cli(cliconfig):
+    """Called from cli.cli with the parsed arguments"""
+    for opt in ["new", "interactive", "break_lock", "daemon", "subpath", "watch"]:
+        if getattr(cliconfig, opt):
+            log(f"ERROR: Cannot use --{opt.replace('_', '-')} with --multi")
+            sys.exit(1)
+
+    argv = []
+    flags = ["debug", "dry_run", "no_backup", "refresh_rclone_cache", "reset_state"]
+    for opt in flags:
+        if getattr(cliconfig, opt):
+            argv.append(f"--{opt.replace('_', '-')}")
+    for item in cliconfig.override:
+        argv += ["--override", item]
+
+    configs = find_configs(cliconfig.multi)
+    if not configs:
+        log("ERROR: No configs found for --multi")
+        sys.exit(1)
+    log(f"Found {len(configs)} configs. Running {cliconfig.jobs} at a time")
+
+    results = run(
+        configs,
+        argv,
+        jobs=cliconfig.jobs,
+        remote_limit=cliconfig.remote_limit,
+        override="\n".join(cliconfig.override),
+    )
+    if not summarize(results):
+        sys.exit(1)
@@ -0,0 +1,176 @@
+"""
+Tools for out-of-core planning (see out_of_core in the config).
+
+The file lists are spilled to disk as sorted (by Path) runs of JSON lines and
+read back with a merge so that only one chunk is ever in memory. The planner
+then does a streaming merge of currA, currB, prevA, and prevB to pull out the
+files that are the same on both sides. Those are written straight back to disk
+and only the remaining (changed) files are kept in memory.
+"""
+import codecs
+import heapq
+import json
+import os
+from itertools import count
+
+from . import debug
+
+RUN_SIZE = 200000  # Max entries held in memory before spilling a sorted run
+READ_SIZE = 1 << 20
+
+_DECODER = json.JSONDecoder()
+_names = count()
+
+
+def iter_json_array(fp, chunksize=READ_SIZE):
+    """
+    Iterate the items of a JSON array in binary file object, fp, without
+    reading it all into memory. Works for lsjson output (one item per line) and
+    the state files (all on one line)
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    started = eof = False
+    while True:
+        # Skip whitespace and separators
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if not started and pos < len(buf):
+            if buf[pos] != "[":
+                raise ValueError("Not a JSON array")
+            started = True
+            pos += 1
+            continue
+        if pos < len(buf) and buf[pos] == "]":
+            return
+
+        if pos < len(buf):
+            try:
+                item, end = _DECODER.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                yield item
+                pos = end
+                continue
+
+        if eof:
+            if not started:  # Empty output
+                return
+            raise ValueError("Unterminated JSON array")
+
+        chunk = fp.read(chunksize)
+        eof = not chunk
+        buf = buf[pos:] + decoder.decode(chunk, final=eof)
+        pos = 0
+
+
+class SortedFiles:
+    """
+    A list of files sorted by Path that is spilled to disk. Add files with
+    add() (in any order) and then call finish(). It can then be iterated (in
+    order) as many times as needed.
+    """
+
+    sorted = True
+
+    def __init__(self, tmpdir, name="files"):
+        self.tmpdir = tmpdir
+        self.name = f"{name}.{next(_names)}"
+        self.runs = []
+        self.buffer = []
+        self.count = 0
+        self.finished = False
+
+    def add(self, file):
+        self.buffer.append(file)
+        self.count += 1
+        if len(self.buffer) >= RUN_SIZE:
+            self._spill()
+
+    def extend(self, files):
+        for file in files:
+            self.add(file)
+
+    def _spill(self):
+        if not self.buffer:
+            return
+        self.buffer.sort(key=lambda file: file["Path"])
+        path = os.path.join(self.tmpdir, f"ooc.{self.name}.{len(self.runs)}.jsonl")
+        with open(path, "wt", encoding="utf-8") as fp:
+            for file in self.buffer:
+                fp.write(json.dumps(file, ensure_ascii=False))
+                fp.write("\n")
+        self.runs.append(path)
+        self.buffer = []
+
+    def finish(self):
+        """Done adding. If it all fit in one run, it stays in memory"""
+        if self.runs:
+            self._spill()
+        else:
+            self.buffer.sort(key=lambda file: file["Path"])
+        self.finished = True
+        debug(f"{self.name}: {self.count} files in {len(self.runs)} run(s)")
+        return self
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        if not self.finished:
+            raise ValueError("Must call finish() before iterating")
+        if not self.runs:
+            return iter(self.buffer)
+        return heapq.merge(
+            *(_read_run(path) for path in self.runs), key=lambda file: file["Path"]
+        )
+
+
+def _read_run(path):
+    with open(path, "rt", encoding="utf-8") as fp:
+        for line in fp:
+            yield json.loads(line)
+
+
+class MergedFiles:
+    """Re-iterable, sorted merge of sorted file lists (e.g. SortedFiles)"""
+
+    sorted = True
+
+    def __init__(self, *lists):
+        self.lists = lists
+
+    def __len__(self):
+        return sum(len(files) for files in self.lists)
+
+    def __iter__(self):
+        return heapq.merge(*self.lists, key=lambda file: file["Path"])
+
+
+def merge_by_path(*lists):
+    """
+    Merge sorted file lists and yield (path, [file or None for each list]).
+    If a list has a path more than once, the first is used.
+    """
+    N = len(lists)
+
+    def _keyed(ii, files):  # jj so that files are never compared
+        for jj, file in enumerate(files):
+            yield file["Path"], ii, jj, file
+
+    path0, group = None, None
+    keyed = (_keyed(ii, files) for ii, files in enumerate(lists))
+    for path, ii, _, file in heapq.merge(*keyed):
+        if path != path0:
+            if group is not None:
+                yield path0, group
+            path0, group = path, [None] * N
+        if group[ii] is None:
+            group[ii] = file
+        else:
+            debug(f"Duplicate path {path!r}. Using the first")
+    if group is not None:
+        yield path0, group
@@ -0,0 +1,268 @@
+"""
+Binary file lists that are memory-mapped (see state_format = 'packed').
+
+A packed list is a sequence of records sorted by Path followed by an index of
+the record offsets and a trailer:
+
+    MAGIC
+    record * count    : RECORD (path length, Size, mtime, flags, extra length)
+                        then the UTF-8 path and the JSON of any other keys
+                        (e.g. Hashes)
+    offset * count    : '<Q' offset of each record
+    TRAILER           : count, index offset, MAGIC
+
+It is written as a stream (so it can be compressed on the way) and read with
+mmap. Nothing is decoded until it is needed. PackedFiles.lazy() yields records
+that only decode their path until another key is asked for so a merge by path
+(see outofcore.merge_by_path) never builds the entries that are the same.
+"""
+import hashlib
+import json
+import lzma
+import mmap
+import struct
+from bisect import bisect_left
+from collections.abc import Mapping
+
+from . import outofcore
+
+MAGIC = b"SRCPACK1"
+RECORD = struct.Struct("<IqdBI")
+OFFSET = struct.Struct("<Q")
+TRAILER = struct.Struct("<QQ8s")
+
+# RECORD flags
+NO_SIZE = 1  # No Size key
+NO_MTIME = 2  # No mtime key
+NULL_MTIME = 4  # mtime is None
+INT_MTIME = 8  # mtime is an int (e.g. read from JSON)
+
+CORE_KEYS = {"Path", "Size", "mtime"}
+
+
+def write(fp, files):
+    """
+    Write the packed files (which must be sorted by Path) to the binary file
+    object fp. Returns the count
+    """
+    fp.write(MAGIC)
+    pos = len(MAGIC)
+    offsets = []
+    for file in files:
+        path = file["Path"].encode("utf-8", "surrogateescape")
+        flags = 0
+        if "Size" not in file:
+            flags |= NO_SIZE
+        mtime = file.get("mtime")
+        if "mtime" not in file:
+            flags |= NO_MTIME
+        elif mtime is None:
+            flags |= NULL_MTIME
+        elif isinstance(mtime, int):
+            flags |= INT_MTIME
+        extra = {k: v for k, v in file.items() if k not in CORE_KEYS}
+        extra = json.dumps(extra, ensure_ascii=False).encode() if extra else b""
+
+        record = RECORD.pack(
+            len(path), file.get("Size", 0), mtime or 0.0, flags, len(extra)
+        )
+        fp.write(record)
+        fp.write(path)
+        fp.write(extra)
+        offsets.append(pos)
+        pos += len(record) + len(path) + len(extra)
+
+    for offset in offsets:
+        fp.write(OFFSET.pack(offset))
+    fp.write(TRAILER.pack(len(offsets), pos, MAGIC))
+    return len(offsets)
+
+
+class _Writer:
+    """Binary file-like object that compresses into fp and counts the md5"""
+
+    def __init__(self, fp, md5):
+        self.fp, self.md5 = fp, md5
+        self.comp = lzma.LZMACompressor()
+
+    def write(self, data):
+        self._out(self.comp.compress(data))
+
+    def close(self):
+        self._out(self.comp.flush())
+
+    def _out(self, data):
+        self.md5.update(data)
+        self.fp.write(data)
+
+
+def write_xz(path, files):
+    """Write the packed files xz compressed to path. Returns the md5"""
+    md5 = hashlib.md5()
+    if not getattr(files, "sorted", False):
+        files = sorted(files, key=lambda file: file["Path"])
+    with open(path, "wb") as fp:
+        writer = _Writer(fp, md5)
+        write(writer, files)
+        writer.close()
+    return md5.hexdigest()
+
+
+def decompress(src, dst):
+    """Decompress the .packed.xz at src into dst. Returns the md5 of src"""
+    md5 = hashlib.md5()
+    decomp = lzma.LZMADecompressor()
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        for chunk in iter(lambda: fin.read(outofcore.READ_SIZE), b""):
+            md5.update(chunk)
+            fout.write(decomp.decompress(chunk, max_length=outofcore.READ_SIZE))
+            while not decomp.needs_input and not decomp.eof:  # Bounded memory
+                fout.write(decomp.decompress(b"", max_length=outofcore.READ_SIZE))
+    if not decomp.eof:
+        raise ValueError(f"Truncated packed list {src!r}")
+    return md5.hexdigest()
+
+
+class PackedFiles:
+    """
+    A packed list read with mmap. Iterating it builds each entry as a dict (in
+    Path order) but lookups, lengths, and lazy() do not build the rest. It is
+    used in place of a DictTable for the previous list, so it can be queried
+    by Path the same way.
+    """
+
+    sorted = True
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[: len(MAGIC)] != MAGIC or len(self.mm) < TRAILER.size:
+            raise ValueError(f"Not a packed list {filename!r}")
+        self.count, self.index, magic = TRAILER.unpack_from(
+            self.mm, len(self.mm) - TRAILER.size
+        )
+        if magic != MAGIC:
+            raise ValueError(f"Not a packed list {filename!r}")
+        self._paths = _Paths(self)
+
+    def __len__(self):
+        return self.count
+
+    def offset(self, ii):
+        return OFFSET.unpack_from(self.mm, self.index + ii * OFFSET.size)[0]
+
+    def path(self, ii):
+        """The Path of record ii. Decodes nothing else"""
+        offset = self.offset(ii)
+        (plen,) = struct.unpack_from("<I", self.mm, offset)
+        start = offset + RECORD.size
+        return self.mm[start : start + plen].decode("utf-8", "surrogateescape")
+
+    def entry(self, ii):
+        """Record ii as a dict"""
+        offset = self.offset(ii)
+        plen, size, mtime, flags, elen = RECORD.unpack_from(self.mm, offset)
+        start = offset + RECORD.size
+        path = self.mm[start : start + plen].decode("utf-8", "surrogateescape")
+        file = {"Path": path}
+        if not flags & NO_SIZE:
+            file["Size"] = size
+        if flags & NULL_MTIME:
+            file["mtime"] = None
+        elif flags & INT_MTIME:
+            file["mtime"] = int(mtime)
+        elif not flags & NO_MTIME:
+            file["mtime"] = mtime
+        if elen:
+            file.update(json.loads(self.mm[start + plen : start + plen + elen]))
+        return file
+
+    def find(self, path):
+        """The index of path or None. A binary search that only decodes paths"""
+        ii = bisect_left(self._paths, path)
+        if ii < self.count and self.path(ii) == path:
+            return ii
+        return None
+
+    def get(self, path):
+        """The entry (dict) for path or None"""
+        ii = self.find(path)
+        return None if ii is None else self.entry(ii)
+
+    def __getitem__(self, query):
+        """
+        Like DictTable, the entry matching {'Path':path, ...} or None. Must have
+        'Path' since that is the only thing indexed
+        """
+        if not isinstance(query, dict) or "Path" not in query:
+            raise ValueError("PackedFiles only supports {'Path':path, ...} queries")
+        file = self.get(query["Path"])
+        if file is None or any(file.get(k) != v for k, v in query.items()):
+            return None
+        return file
+
+    def __contains__(self, query):
+        return self[query] is not None
+
+    def __iter__(self):
+        return (self.entry(ii) for ii in range(self.count))
+
+    def lazy(self):
+        """Iterate LazyFile records (in Path order)"""
+        return (LazyFile(self, ii) for ii in range(self.count))
+
+    def close(self):
+        self.mm.close()
+
+
+class _Paths:
+    """Sequence of the paths for bisect"""
+
+    def __init__(self, packed):
+        self.packed = packed
+
+    def __len__(self):
+        return self.packed.count
+
+    def __getitem__(self, ii):
+        return self.packed.path(ii)
+
+
+class LazyFile(Mapping):
+    """
+    Read-only entry of a PackedFiles. Only the path is decoded until another
+    key is needed. Use dict(file) to keep it
+    """
+
+    __slots__ = ("packed", "ii", "_path", "_file")
+
+    def __init__(self, packed, ii):
+        self.packed, self.ii = packed, ii
+        self._path = self._file = None
+
+    def _load(self):
+        if self._file is None:
+            self._file = self.packed.entry(self.ii)
+        return self._file
+
+    def __getitem__(self, key):
+        if key == "Path":
+            if self._path is None:
+                self._path = self.packed.path(self.ii)
+            return self._path
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return f"LazyFile({self._load()!r})"
+
+
+def lazy(files):
+    """files.lazy() for a PackedFiles. Otherwise files"""
+    return files.lazy() if isinstance(files, PackedFiles) else files
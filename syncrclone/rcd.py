@@ -0,0 +1,140 @@
+"""
+A persistent `rclone rcd` (remote control daemon) for actions that would
+otherwise be one rclone process per item (see rc_daemon in the config).
+
+The daemon only listens on localhost with a random user and password and the
+calls are made over HTTP so they can be done from many threads. There is one
+daemon per remote so the remote-specific flags apply.
+"""
+import atexit
+import base64
+import json
+import os
+import shlex
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from . import debug, log
+from . import utils
+
+START_TIMEOUT = 30  # sec
+
+_OPENER = urllib.request.build_opener(urllib.request.ProxyHandler({}))  # No proxies
+
+
+class RCError(ValueError):
+    pass
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class RCDaemon:
+    """
+    rclone rcd for remote AB. It is started on the first call() and must be
+    stopped with stop() (also done at exit).
+    """
+
+    def __init__(self, rclone, AB):
+        self.rclone = rclone
+        self.config = rclone.config
+        self.AB = AB
+        self.proc = None
+        self.ready = False
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def start(self):
+        with self.lock:
+            if self.ready:
+                return self
+            config = self.config
+            self.url = f"http://127.0.0.1:{_free_port()}/"
+            user, passwd = "syncrclone", utils.random_str(20)
+            token = base64.b64encode(f"{user}:{passwd}".encode()).decode()
+            self.auth = f"Basic {token}"
+
+            cmd = shlex.split(config.rclone_exe)
+            cmd += config.rclone_flags + getattr(config, f"rclone_flags{self.AB}")
+            cmd += ["rcd", "--rc-addr", self.url[7:-1]]
+            debug("rclone:rcd", cmd)
+
+            # The credentials are passed in the environment since the arguments
+            # can be read by any user (e.g. with ps)
+            env = self.rclone.env()
+            env.update(RCLONE_RC_USER=user, RCLONE_RC_PASS=passwd)
+
+            self.errpath = os.path.join(config.tempdir, f"rcd.{self.AB}.err")
+            with open(self.errpath, "wb") as err:
+                self.proc = subprocess.Popen(
+                    cmd, stdout=subprocess.DEVNULL, stderr=err, env=env
+                )
+            self.rclone.add_stats(calls=1)
+            atexit.register(self.stop)
+
+            t0 = time.time()
+            while True:
+                try:
+                    self._request("rc/noop", {})
+                    break
+                except (OSError, RCError):
+                    if self.proc.poll() is not None or time.time() - t0 > START_TIMEOUT:
+                        self._stop()
+                        raise RCError(f"Could not start rclone rcd for {self.AB}")
+                    time.sleep(0.05)
+            self.ready = True
+        debug(f"{self.AB}: rclone rcd started at {self.url}")
+        return self
+
+    def call(self, method, **params):
+        """Call method with params and return the (decoded) result"""
+        if not self.ready:
+            self.start()
+        t0 = time.time()
+        try:
+            return self._request(method, params)
+        finally:
+            with self.lock:
+                self.calls += 1
+            self.rclone.add_stats(dt=time.time() - t0)
+
+    def _request(self, method, params):
+        req = urllib.request.Request(
+            self.url + method,
+            data=json.dumps(params).encode(),
+            headers={"Content-Type": "application/json", "Authorization": self.auth},
+        )
+        try:
+            with _OPENER.open(req) as resp:
+                return json.loads(resp.read() or b"{}")
+        except urllib.error.HTTPError as exc:
+            try:
+                msg = json.loads(exc.read()).get("error", str(exc))
+            except ValueError:
+                msg = str(exc)
+            raise RCError(f"{method}: {msg}") from None
+
+    def stop(self):
+        with self.lock:
+            self._stop()
+
+    def _stop(self):
+        if self.proc is None:
+            return
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+        self.ready = False
+        atexit.unregister(self.stop)
+        debug(f"{self.AB}: rclone rcd stopped after {self.calls} calls")
@@ -1,21 +1,53 @@
 """
 Most of the rclone interfacing
 """
+import contextlib
 import json
+import multiprocessing
 import os
+import threading
+from array import array
 from collections import deque, defaultdict
 import subprocess, shlex
 import lzma
 import time
 import re
-from itertools import zip_longest
-from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest, count
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 
 from . import debug, log, MINRCLONE
 from .cli import ConfigError
 from .dicttable import DictTable
 from . import utils
+from . import state
+from . import hashcache
+from . import outofcore
+from . import packed
+from . import rcd
+from . import rclonecache
+
+# Things we do not need from lsjson. There may be others but it doesn't hurt
+LIST_DROP_KEYS = ["IsDir", "Name", "ID", "Tier"]
+
+HASH_BATCH_MIN = 1000  # Minimum paths per concurrent hash batch
+
+# Results that are the same for every run in this process (e.g. with --multi),
+# keyed by everything they could depend on. See process_key()
+_PROCESS_CACHE = {}
+
+# Worker processes for list_processes. Started once and shared by every run in
+# this process (e.g. --daemon). See list_pool()
+_LIST_POOL = None
+_LIST_POOL_LOCK = threading.Lock()
+
+# rclone output (or errors) that mean the remote wants us to slow down
+# (including the 'Attempt 1/3 failed with ...' lines of a retried call)
+CONGESTED_RE = re.compile(
+    r"low level retry|attempt \d+/\d+ failed|too many requests|\b429\b|rate.?limit",
+    re.IGNORECASE,
+)
 
 FILTER_FLAGS = {
     "--include",
@@ -28,6 +60,124 @@ FILTER_FLAGS = {
 }
 
 
+def _output(result):
+    """Whether the output of an action, (item, rclone output), shows congestion"""
+    return bool(CONGESTED_RE.search(result[1]))
+
+
+def _error(result):
+    """Whether the error of an action, (item, error or None), shows congestion"""
+    return result[1] is not None and bool(CONGESTED_RE.search(str(result[1])))
+
+
+def clean_listing(data):
+    """
+    Parse the lsjson output, data, and clean up the entries: drop the keys we do
+    not need and convert ModTime to mtime. With list_processes, this is run in a
+    worker process so A and B are not serialized by the GIL.
+    """
+    files = json.loads(data)
+    mtimes = utils.RFC3339_to_unix_many([file.pop("ModTime", None) for file in files])
+    for file, mtime in zip(files, mtimes):
+        for key in LIST_DROP_KEYS:
+            file.pop(key, None)
+        file["mtime"] = mtime
+    return files
+
+
+def clean_listing_packed(data):
+    """clean_listing(data) as pack_files() to return it from a worker process"""
+    return pack_files(clean_listing(data))
+
+
+def pack_files(files):
+    """
+    Compact form of the (cleaned up) files to return from a worker process. A
+    list of dicts is slow to unpickle and that is done in this process, under
+    the GIL. Instead, the paths are joined into one str and Size and mtime are
+    arrays so only the other keys (e.g. Hashes) are dicts. Files that do not
+    fit (which should not happen with lsjson) are kept whole. Empties files.
+    See unpack_files()
+    """
+    paths, sizes, mtimes = [], array("q"), array("d")
+    nomtime, extra, whole = [], {}, {}
+    for ii, file in enumerate(files):
+        size, mtime = file.get("Size"), file.get("mtime", ...)
+        if (
+            "\0" in file["Path"]
+            or type(size) is not int
+            or not (mtime is None or type(mtime) is float)
+        ):
+            whole[ii] = file
+            file = {"Path": "", "Size": 0, "mtime": 0.0}
+        paths.append(file.pop("Path"))
+        sizes.append(file.pop("Size"))
+        mtime = file.pop("mtime")
+        if mtime is None:
+            nomtime.append(ii)
+            mtime = 0.0
+        mtimes.append(mtime)
+        if file:
+            extra[ii] = file
+    files.clear()
+    return "\0".join(paths), sizes.tobytes(), mtimes.tobytes(), nomtime, extra, whole
+
+
+def unpack_files(packed):
+    """The list of files from pack_files()"""
+    paths, sizes, mtimes, nomtime, extra, whole = packed
+    sizes, mtimes = array("q", sizes), array("d", mtimes)
+    mtimes = mtimes.tolist()
+    for ii in nomtime:
+        mtimes[ii] = None
+    files = [
+        {"Path": path, "Size": size, "mtime": mtime}
+        for path, size, mtime in zip(paths.split("\0"), sizes.tolist(), mtimes)
+    ]
+    for ii, file in extra.items():
+        files[ii].update(file)
+    for ii, file in whole.items():
+        files[ii] = file
+    return files
+
+
+def list_pool():
+    """
+    The worker processes for list_processes. Spawned rather than forked since
+    the listings are running in threads.
+    """
+    global _LIST_POOL
+    with _LIST_POOL_LOCK:
+        if _LIST_POOL is None:
+            _LIST_POOL = ProcessPoolExecutor(
+                max_workers=2, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _LIST_POOL
+
+
+class ProgressReader:
+    """
+    Wrap a binary file object (e.g. a pipe) and log the number of lines read
+    every dt seconds. Reads return whatever is available (up to size)
+    """
+
+    def __init__(self, fp, descr, dt):
+        self.fp = fp
+        self.descr = descr
+        self.dt = dt
+        self.lines = 0
+        self._t = time.time()
+
+    def read(self, size=-1):
+        chunk = self.fp.read1(size) if size > 0 else self.fp.read()
+        self.lines += chunk.count(b"\n")
+        if time.time() - self._t > self.dt:
+            # The first line is '['
+            log(f"{self.descr}: File count {max(self.lines - 1, 0)}")
+            self._t = time.time()
+        return chunk
+
+
 def mkdir(path, isdir=True):
     if not isdir:
         path = os.path.dirname(path)
@@ -45,6 +195,16 @@ class RcloneVersionError(ValueError):
     pass
 
 
+def filter_rule(path):
+    """
+    rclone filter rule to include exactly path or None if it can not be written
+    as one (e.g. it has a newline or leading or trailing spaces)
+    """
+    if "\n" in path or "\r" in path or path != path.strip():
+        return None
+    return "+ /" + re.sub(r"([\\*?\[\]{}])", r"\\\1", path)
+
+
 class Rclone:
     def __init__(self, config):
         self.config = config
@@ -52,6 +212,13 @@ class Rclone:
         self.tmpdir = config.tempdir
 
         self.rclonetime = 0.0
+        self.rclonecalls = 0
+        self._stats_lock = threading.Lock()  # Calls are made from many threads
+        self._callids = count()  # Unique names for the output of concurrent calls
+
+        self.state_info = {}  # AB: state.read_state info + 'list'
+        self.resident = {}  # AB: From the last run to reuse. See pull_prev_list
+        self.daemons = {AB: rcd.RCDaemon(self, AB) for AB in "AB"}  # See rc_daemon
 
         try:
             os.makedirs(self.tmpdir)
@@ -77,8 +244,14 @@ class Rclone:
         I have been struggling with edge cases on this regex (e.g., #27 and #28)
         but it also isn't critical so wrap everything in a try block.
         """
-        log("rclone version:")
-        ver = json.loads(self.call(["rc", "--loopback", "core/version"], stream=True))
+        def _version():
+            log("rclone version:")
+            cmd = ["rc", "--loopback", "core/version"]
+            return json.loads(self.call(cmd, stream=True))
+
+        ver, where = self.cached(_version, "version")
+        if where:
+            log(f"rclone version: {ver.get('version')} ({where})")
         try:
             decomposed = tuple(ver["decomposed"])
             dtxt = ".".join(f"{d}" for d in decomposed)
@@ -103,21 +276,24 @@ class Rclone:
                     )
 
     def call(
-        self, cmd, stream=False, logstderr=True, display_error=True, fl_remote=None
+        self,
+        cmd,
+        stream=False,
+        logstderr=True,
+        display_error=True,
     ):
         """
         Call rclone. If streaming, will write stdout & stderr to
         log. If logstderr, will always send stderr to log (default)
+
+        See lsjson() for listings
         """
         config = self.config
         cmd = shlex.split(self.config.rclone_exe) + cmd
         debug("rclone:call", cmd)
 
-        env = os.environ.copy()
-        k0 = set(env)
-
-        env.update(self.config.rclone_env)
-        env["RCLONE_ASK_PASSWORD"] = "false"  # so that it never prompts
+        env = self.env()
+        k0 = set(os.environ)
 
         debug_env = {k: v for k, v in env.items() if k not in k0}
         if "RCLONE_CONFIG_PASS" in debug_env:
@@ -129,12 +305,13 @@ class Rclone:
             stdout = subprocess.PIPE
             stderr = subprocess.STDOUT
         else:  # Stream both stdout and stderr to files to prevent a deadlock
-            tns = time.time_ns()
-            stdout = open(f"{config.tempdir}/std.{tns}.out", mode="wb")
-            stderr = open(f"{config.tempdir}/std.{tns}.err", mode="wb")
+            callid = f"{time.time_ns()}.{next(self._callids)}"
+            stdout = open(f"{config.tempdir}/std.{callid}.out", mode="wb")
+            stderr = open(f"{config.tempdir}/std.{callid}.err", mode="wb")
 
         t0 = time.time()
         proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, env=env)
+        self.add_stats(calls=1)
 
         if stream:
             out = []
@@ -149,33 +326,8 @@ class Rclone:
             out = "\n".join(out)
             err = ""  # Piped to stderr
 
-        ## Special for file listing. Not general purpose... Will count lines -1
-        if fl_remote:
-            with open(stdout.name, "rb") as fp:  # 'b' to avoid dealing with encoding
-                _c = 0
-                _t = time.time()
-                lines = []
-
-                while True:
-                    line = fp.readline()
-                    if not line:
-                        if proc.poll() is not None:
-                            break
-                        time.sleep(0.01)
-                        continue
-                    lines.append(line)
-                    if b"\n" in line:
-                        # normally would yield/return b'\n'.join(lines) but we don't
-                        # really care
-                        lines = []
-
-                        _c += 1
-                        if time.time() - _t > config.list_status_dt:
-                            log(f"Reading from {fl_remote}: File count {_c - 1}")
-                            _t = time.time()
-
         proc.wait()
-        self.rclonetime += time.time() - t0
+        self.add_stats(dt=time.time() - t0)
 
         if not stream:
             stdout.close()
@@ -203,46 +355,347 @@ class Rclone:
             out = out + "\n" + err
         return out
 
+    @contextlib.contextmanager
+    def lsjson(self, cmd, AB):
+        """
+        Run the listing, cmd, and yield a (binary) file object of its output.
+        stdout is read directly from the pipe, counting files (lines) as it goes
+        for the list_status_dt progress. stderr goes to a file so that it can't
+        deadlock. The output must be read inside the context.
+        """
+        config = self.config
+        cmd = shlex.split(config.rclone_exe) + cmd
+        debug("rclone:call", cmd)
+
+        callid = f"{time.time_ns()}.{next(self._callids)}"
+        errpath = f"{config.tempdir}/std.{callid}.err"
+
+        t0 = time.time()
+        with open(errpath, "wb") as stderr:
+            proc = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=stderr, env=self.env()
+            )
+        self.add_stats(calls=1)
+
+        reader = ProgressReader(
+            proc.stdout, f"Reading from {AB}", config.list_status_dt
+        )
+        try:
+            with proc.stdout:
+                yield reader
+                while reader.read(outofcore.READ_SIZE):  # Anything left
+                    pass
+        except BaseException:
+            # If rclone failed, the (partial) output is likely why. Report that
+            if proc.poll() is None:
+                proc.kill()
+            if proc.wait() <= 0:
+                raise
+        proc.wait()
+        self.add_stats(dt=time.time() - t0)
+
+        with open(errpath, "rt") as F:
+            err = F.read()
+        if err:
+            log(" rclone stderr:", err)
+
+        if proc.returncode:
+            log("RCLONE ERROR")
+            log("CMD", cmd)
+            log("STDERR", err.strip())
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=err)
+
+    def add_stats(self, calls=0, dt=0.0):
+        """Add to the rclone call count and time. Thread-safe"""
+        with self._stats_lock:
+            self.rclonecalls += calls
+            self.rclonetime += dt
+
+    def env(self):
+        """The environment for rclone calls"""
+        env = os.environ.copy()
+        env.update(self.config.rclone_env)
+        env["RCLONE_ASK_PASSWORD"] = "false"  # so that it never prompts
+        return env
+
+    def action_map(self, func, items, congested=None):
+        """
+        Run func on each item concurrently (for actions like moves) and yield the
+        results in order. Uses action_threads or, with adaptive_threads, an
+        AIMD limiter between adaptive_threads_min and action_threads.
+        congested(result) is used to detect rate limiting
+        """
+        config = self.config
+        if config.adaptive_threads:
+            limiter = utils.AIMDLimiter(
+                config.adaptive_threads_min, config.action_threads
+            )
+            yield from limiter.map(func, items, congested=congested)
+            return
+
+        with ThreadPoolExecutor(max_workers=int(config.action_threads)) as exe:
+            yield from exe.map(func, items)
+
+    def stop_daemons(self):
+        """Stop any rclone rcd daemons that were started"""
+        for daemon in self.daemons.values():
+            daemon.stop()
+
     def push_file_list(self, filelist, remote=None):
+        """
+        Upload the new file list. With state_format = 'delta', only the changes
+        from the last known state are uploaded unless it is time to compact into
+        a new base. With 'sharded', only the shards that changed are uploaded.
+        With 'packed', it is a binary list (see packed.py)
+        """
         config = self.config
         AB = remote
-        remote = getattr(config, f"remote{AB}")
         workdir = getattr(config, f"workdir{AB}")
+        flags = (
+            config.rclone_flags + self.add_args + getattr(config, f"rclone_flags{AB}")
+        )
+
+        if not getattr(filelist, "sorted", False):  # outofcore lists are re-iterable
+            filelist = list(filelist)
+        info = self.state_info.get(AB)
+
+        if config.state_format == "sharded":
+            return self._push_shards(filelist, AB, info, flags)
+        if config.state_format == "packed":
+            return self._push_packed(filelist, AB, flags)
+
+        if (
+            config.state_format == "delta"
+            and info
+            and info["base"]
+            and not info["stale"]
+            and info["deltas"] < config.state_deltas_max
+        ):
+            delta = state.make_delta(info["list"], filelist)
+            nentries = len(delta["add"]) + len(delta["remove"])
+            if not nentries:
+                log(f"No changes to the file list on {AB}. Not uploading")
+                return
+            if 2 * (info["delta_entries"] + nentries) <= len(filelist):
+                seq = info["deltas"] + 1
+                delta = {"base": info["base"], "seq": seq, **delta}
+
+                src = os.path.join(self.tmpdir, f"{AB}_curr_delta")
+                mkdir(src, isdir=False)
+                state.write(src, delta)
+                dst = utils.pathjoin(workdir, state.delta_name(AB, config.name, seq))
+                self.call(flags + ["copyto", src, dst])
+                debug(f"{AB}: Uploaded state delta {seq} with {nentries} entries")
+
+                info["files"].append(state.delta_name(AB, config.name, seq))
+                info["deltas"] = seq
+                info["delta_entries"] += nentries
+                info["list"] = filelist
+                return
+            debug(f"{AB}: Compacting state deltas")
 
-        dst = utils.pathjoin(workdir, f"{AB}-{self.config.name}_fl.json.xz")
         src = os.path.join(self.tmpdir, f"{AB}_curr")
         mkdir(src, isdir=False)
+        md5 = state.write(src, filelist)
+        dst = utils.pathjoin(workdir, state.base_name(AB, config.name))
+        self.call(flags + ["copyto", src, dst])
+
+        # Remove any deltas. They would be ignored since the base changed but do
+        # not leave them around. If the state is not known (e.g. reset_state), there
+        # may be some. Same for a sharded or packed state (which is ignored if there
+        # is a base)
+        if info is None or set(info["files"]) - {state.base_name(AB, config.name)}:
+            stem = state.glob_escape(state.stem(AB, config.name))
+            cmd = flags + ["delete", "--retries", "1", workdir]
+            cmd += ["--include", f"/{stem}.delta.*"]
+            cmd += ["--include", f"/{stem}.manifest.*", "--include", f"/{stem}.shard.*"]
+            cmd += ["--include", f"/{stem}.packed.xz"]
+            try:
+                self.call(cmd, display_error=False, logstderr=False)
+            except subprocess.CalledProcessError:
+                debug(f"{AB}: Could not remove state deltas")
 
-        filelist = list(filelist)
-        with lzma.open(src, "wt") as file:
-            json.dump(filelist, file, ensure_ascii=False)
+        self.state_info[AB] = info = state.new_info()
+        info.update(base=md5, files=[state.base_name(AB, config.name)], list=filelist)
 
+    def _push_shards(self, filelist, AB, info, flags):
+        """
+        Upload the shards that changed from the last known manifest and then the
+        new manifest. Then remove any other state files (e.g. shards that are now
+        empty or a base from another state_format)
+        """
+        config = self.config
+        workdir = getattr(config, f"workdir{AB}")
+        shard_by = config.state_shard_by
+
+        prev = (info or {}).get("manifest") or {}
+        prev = prev.get("shards", {}) if prev.get("shard_by") == shard_by else {}
+
+        src = os.path.join(self.tmpdir, f"{AB}_curr_shards")
+        mkdir(src)
+        manifest = state.new_manifest(shard_by)
+        nchanged = 0
+        for sid, entries in state.split_shards(filelist, shard_by).items():
+            digest = state.digest(entries)
+            if sid in prev and prev[sid]["digest"] == digest:
+                manifest["shards"][sid] = prev[sid]
+                continue
+            fname = state.shard_name(AB, config.name, sid)
+            md5 = state.write(os.path.join(src, fname), entries)
+            manifest["shards"][sid] = {
+                "file": fname,
+                "md5": md5,
+                "digest": digest,
+                "count": len(entries),
+            }
+            nchanged += 1
+
+        keep = {state.manifest_name(AB, config.name)}
+        keep.update(shard["file"] for shard in manifest["shards"].values())
+        if info and manifest["shards"] == prev and keep.issuperset(info["files"]):
+            log(f"No changes to the file list on {AB}. Not uploading")
+            info["list"] = filelist
+            return
+
+        if nchanged:
+            self.call(flags + ["copy", src, workdir])
+        debug(f"{AB}: Uploaded {nchanged} of {len(manifest['shards'])} state shards")
+
+        # Uploaded last so that it never lists a shard that is not there yet
+        mpath = os.path.join(self.tmpdir, f"{AB}_curr_manifest")
+        state.write(mpath, manifest)
+        dst = utils.pathjoin(workdir, state.manifest_name(AB, config.name))
+        self.call(flags + ["copyto", mpath, dst])
+
+        if info is None or not keep.issuperset(info["files"]):
+            self._remove_old_state(AB, keep, flags)
+
+        self.state_info[AB] = info = state.new_info()
+        info.update(files=sorted(keep), list=filelist, manifest=manifest)
+
+    def _push_packed(self, filelist, AB, flags):
+        """Upload the list as a packed.py list and remove any other state files"""
+        config = self.config
+        src = os.path.join(self.tmpdir, f"{AB}_curr_packed")
+        mkdir(src, isdir=False)
+        packed.write_xz(src, filelist)
+        fname = state.packed_name(AB, config.name)
+        dst = utils.pathjoin(getattr(config, f"workdir{AB}"), fname)
+        self.call(flags + ["copyto", src, dst])
+
+        info = self.state_info.get(AB)
+        if info is None or set(info["files"]) - {fname}:
+            self._remove_old_state(AB, {fname}, flags)
+
+        self.state_info[AB] = info = state.new_info()
+        info.update(files=[fname], list=filelist)
+
+    def _remove_old_state(self, AB, keep, flags):
+        """Remove the state files on AB other than those in keep"""
+        config = self.config
+        stem = state.glob_escape(state.stem(AB, config.name))
+        rules = [f"- /{state.glob_escape(fname)}" for fname in sorted(keep)]
+        rules += [f"+ /{stem}.json.xz", f"+ /{stem}.delta.*", f"+ /{stem}.shard.*"]
+        rules += [f"+ /{stem}.manifest.*", f"+ /{stem}.packed.xz", "- **"]
+        rulesfile = os.path.join(self.tmpdir, f"{AB}_state_filter")
+        with open(rulesfile, "wt") as fp:
+            fp.write("\n".join(rules) + "\n")
+        cmd = flags + ["delete", "--retries", "1", getattr(config, f"workdir{AB}")]
+        cmd += ["--filter-from", rulesfile]
+        try:
+            self.call(cmd, display_error=False, logstderr=False)
+        except subprocess.CalledProcessError:
+            debug(f"{AB}: Could not remove old state files")
+
+    def pull_prev_list(self, *, remote=None, table=False):
+        """
+        Download and read the previous state. The base and any deltas are all
+        downloaded in one call. If table, return it as a DictTable unless it is
+        already sorted (out_of_core or a packed.PackedFiles)
+        """
+        prev_list = self._resident_list(AB=remote)
+        if prev_list is None:
+            prev_list = self._pull_prev_list(AB=remote)
+        if table and not isinstance(prev_list, DictTable) and not getattr(
+            prev_list, "sorted", False
+        ):
+            prev_list = DictTable(prev_list, fixed_attributes=["Path", "Size", "mtime"])
+        return prev_list
+
+    def _resident_list(self, AB):
+        """
+        The list kept from the last run (see SyncRClone.resident_state) if the
+        state on AB has not changed since it was written. Otherwise None
+        """
+        kept = self.resident.get(AB)
+        if not kept or kept["signature"] is None:
+            return None
+        if self.state_signature(AB) != kept["signature"]:
+            log(f"State on {AB} changed since the last run. Pulling it")
+            return None
+        debug(f"{AB}: Using the state from the last run")
+        self.state_info[AB] = kept["info"]
+        return kept["list"]
+
+    def state_signature(self, AB):
+        """
+        The names, sizes, modtimes, and (if the remote has them) md5 or sha1
+        hashes of the state files on AB. None if they can not be listed
+        """
+        config = self.config
+        stem = state.glob_escape(state.stem(AB, config.name))
         cmd = (
             config.rclone_flags
             + self.add_args
             + getattr(config, f"rclone_flags{AB}")
-            + ["copyto", src, dst]
+            + ["lsjson", "--files-only", "--hash", "--hash-type", "md5"]
+            + ["--hash-type", "sha1", "--retries", "1"]
+            + ["--include", f"/{stem}.json.xz"]
+            + ["--include", f"/{stem}.delta.*.json.xz"]
+            + ["--include", f"/{stem}.manifest.json.xz"]  # Has the shard md5s
+            + ["--include", f"/{stem}.packed.xz"]
+            + [getattr(config, f"workdir{AB}")]
         )
-
-        self.call(cmd)
-
-    def pull_prev_list(self, *, remote=None):
+        try:
+            files = json.loads(self.call(cmd, display_error=False, logstderr=False))
+        except (subprocess.CalledProcessError, ValueError):
+            return None
+        signature = []
+        for f in files:
+            hashes = sorted(f.get("Hashes", {}).items())
+            signature.append((f["Path"], f["Size"], f.get("ModTime"), hashes))
+        return sorted(signature)
+
+    def _pull_prev_list(self, AB):
         config = self.config
-        AB = remote
-        remote = getattr(config, f"remote{AB}")
         workdir = getattr(config, f"workdir{AB}")
-        src = utils.pathjoin(workdir, f"{AB}-{self.config.name}_fl.json.xz")
         dst = os.path.join(self.tmpdir, f"{AB}_prev")
-        mkdir(dst, isdir=False)
+        mkdir(dst)
+
+        self.state_info[AB] = info = state.new_info()
+        info["list"] = []
 
         cmd = (
             config.rclone_flags
             + self.add_args
             + getattr(config, f"rclone_flags{AB}")
-            + ["--retries", "1", "copyto", src, dst]
+            + ["--retries", "1", "copy", workdir, dst]
         )
+        stem = state.glob_escape(state.stem(AB, config.name))
+        cmd += ["--include", f"/{stem}.json.xz"]
+        cmd += ["--include", f"/{stem}.delta.*.json.xz"]
+        cmd += ["--include", f"/{stem}.manifest.json.xz"]
+        cmd += ["--include", f"/{stem}.packed.xz"]
+
+        # Shards that are already in memory (--daemon) are not downloaded again.
+        # Otherwise, get them all in the same call
+        kept = self._kept_shards(AB)
+        if not kept:
+            cmd += ["--include", f"/{stem}.shard.*.json.xz"]
         try:
             self.call(cmd, display_error=False, logstderr=False)
+            if kept:
+                self._pull_shards(AB, dst, kept)
         except subprocess.CalledProcessError as err:
             # Codes (https://rclone.org/docs/#exit-code) 3,4 are expected if there is no list
             if err.returncode in {3, 4}:
@@ -251,14 +704,76 @@ class Rclone:
             log(f"WARNING: Unexpected rclone return. Resetting state in {AB}")
             return []
 
+        out = None
+        if config.out_of_core:
+            out = outofcore.SortedFiles(self.tmpdir, f"prev{AB}")
+        prev_list, info = state.read_state(
+            dst,
+            AB,
+            config.name,
+            out=out,
+            prefer=config.state_format,
+            kept=kept,
+        )
+        self.state_info[AB] = info
+        if prev_list is None:
+            if info["files"]:
+                log(f"WARNING: Missing previous state in {AB}. Resetting")
+            else:
+                log(f"No previous list on {AB}. Reset state")
+            prev_list = []
+        elif info["deltas"]:
+            debug(f"{AB}: Applied {info['deltas']} state deltas")
+        info["list"] = prev_list
+        return prev_list
+
+    def _kept_shards(self, AB):
+        """
+        Dict of shard md5 to entries from the list kept from the last run (see
+        _resident_list) when its state is sharded. Only used if the state changed
+        on the remote since then
+        """
+        kept = self.resident.get(AB)
+        if self.config.state_format != "sharded" or not kept:
+            return {}
+        manifest = (kept["info"] or {}).get("manifest")
+        if not manifest:
+            return {}
+        shards = state.split_shards(kept["list"], manifest["shard_by"])
+        return {
+            shard["md5"]: shards.get(sid, [])
+            for sid, shard in manifest["shards"].items()
+        }
+
+    def _pull_shards(self, AB, dst, kept):
+        """Download the shards in the downloaded manifest that are not in kept"""
+        config = self.config
+        mpath = os.path.join(dst, state.manifest_name(AB, config.name))
         try:
-            with lzma.open(dst) as file:
-                return json.load(file)
+            with lzma.open(mpath) as fp:
+                manifest = json.load(fp)
         except FileNotFoundError:
-            log(f"WARNING: Missing previous state in {AB}. Resetting")
-            return []
+            return
+        need = [s["file"] for s in manifest["shards"].values() if s["md5"] not in kept]
+        debug(f"{AB}: Downloading {len(need)} of {len(manifest['shards'])} shards")
+        if not need:
+            return
 
-    def file_list(self, *, prev_list=None, remote=None):
+        rulesfile = os.path.join(self.tmpdir, f"{AB}_prev_filter")
+        with open(rulesfile, "wt") as fp:
+            for fname in need:
+                fp.write(f"+ /{state.glob_escape(fname)}\n")
+            fp.write("- **\n")
+        cmd = (
+            config.rclone_flags
+            + self.add_args
+            + getattr(config, f"rclone_flags{AB}")
+            + ["--retries", "1", "copy", getattr(config, f"workdir{AB}"), dst]
+            + ["--filter-from", rulesfile]
+        )
+        self.call(cmd, display_error=False, logstderr=False)
+
+    def file_list(self, *, prev_list=None, remote=None, only=None):
         """
         Get both current and previous file lists. If prev_list is
         set, then it is not pulled.
@@ -271,6 +786,11 @@ class Rclone:
         remote
             A or B
 
+        only (list)
+            Only list these paths (e.g. for --watch). They are added as filter
+            rules after the user's so those still apply. See filter_rule().
+            Otherwise, with --subpath, only that directory is listed the same way
+
 
         It will decide if it needs hashes and whether to reuse them based
         on the config.
@@ -281,7 +801,12 @@ class Rclone:
         remote = getattr(config, f"remote{AB}")
 
         compute_hashes = "hash" in [config.compare, getattr(config, f"renames{AB}")]
-        reuse = compute_hashes and getattr(config, f"reuse_hashes{AB}")
+        lazy = compute_hashes and getattr(config, f"lazy_hashes{AB}")
+        reuse = compute_hashes and (
+            getattr(config, f"reuse_hashes{AB}")
+            or lazy
+            or (config.hash_cache and self.is_local(AB))
+        )
 
         # build the command including initial filters *before* any filters set
         # by the user
@@ -296,8 +821,10 @@ class Rclone:
         if compute_hashes and not reuse:
             cmd.append("--hash")
 
+        # Lazy hashes need mtime to reuse hashes and compare unhashed files
         if not config.always_get_mtime and not (
-            config.compare == "mtime"
+            lazy
+            or config.compare == "mtime"
             or getattr(config, f"renames{AB}") == "mtime"
             or config.conflict_mode in ("newer", "older")
         ):
@@ -311,6 +838,19 @@ class Rclone:
             + config.filter_flags
         )
 
+        rules = None
+        if only is not None:
+            rules = [filter_rule(path) for path in only]
+        elif config.subpath:
+            rules = [filter_rule(config.subpath) + "/**"]
+        if rules is not None:
+            if None in rules:
+                raise ValueError(f"Can not list only {only[rules.index(None)]!r}")
+            rulespath = os.path.join(self.tmpdir, f"{AB}_only_filter")
+            with open(rulespath, "wt") as fp:
+                fp.writelines(rule + "\n" for rule in rules + ["- **"])
+            cmd += ["--filter-from", rulespath]
+
         cmd.extend(
             [
                 "-R",
@@ -321,32 +861,30 @@ class Rclone:
 
         cmd.append(remote)
 
-        files_raw = self.call(cmd, fl_remote=AB)
+        # Download and decode the previous list while listing
+        if config.reset_state:
+            debug(f"Reset state on {AB}")
+            prev_thread = None
+        else:
+            prev_thread = utils.ReturnThread(
+                target=self.pull_prev_list, kwargs=dict(remote=AB, table=True)
+            ).start()
+
+        if config.out_of_core:
+            return self._file_list_ooc(cmd, AB, prev_thread)
 
-        files = json.loads(files_raw)
+        with self.lsjson(cmd, AB) as fp:
+            data = b"".join(iter(lambda: fp.read(outofcore.READ_SIZE), b""))
+        files = self._clean_listing(data, AB)
+        del data  # Not needed while building the DictTable
         debug(f"{AB}: Read {len(files)}")
-        for file in files:
-            for key in [
-                "IsDir",
-                "Name",
-                "ID",
-                "Tier",
-            ]:  # Things we do not need. There may be others but it doesn't hurt
-                file.pop(key, None)
-            mtime = file.pop("ModTime", None)
-            file["mtime"] = utils.RFC3339_to_unix(mtime) if mtime else None
 
         # Make them DictTables
         files = DictTable(files, fixed_attributes=["Path", "Size", "mtime"])
         debug(f"{AB}: Read {len(files)}")
 
-        if config.reset_state:
-            debug(f"Reset state on {AB}")
-            prev_list = []
-        else:
-            prev_list = self.pull_prev_list(remote=AB)
-
-        if not isinstance(prev_list, DictTable):
+        prev_list = prev_thread.join() if prev_thread else []
+        if not isinstance(prev_list, (DictTable, packed.PackedFiles)):  # mmap view
             prev_list = DictTable(prev_list, fixed_attributes=["Path", "Size", "mtime"])
 
         if not compute_hashes or "--hash" in cmd:
@@ -370,31 +908,127 @@ class Rclone:
         if len(not_hashed) == 0:
             debug(f"{AB}: Updated {updated}. No need to fetch more")
             return files, prev_list
+        if lazy:
+            debug(f"{AB}: Updated {updated}. Deferring {len(not_hashed)} (lazy)")
+            return files, prev_list
         debug(f"{AB}: Updated {updated}. Fetching hashes for {len(not_hashed)}")
 
-        tmpfile = self.tmpdir + f"/{AB}_update_hash"
-        with open(tmpfile, "wt") as file:
-            file.write("\n".join(f for f in not_hashed))
+        self.fetch_hashes(AB, files, not_hashed)
 
-        cmd = ["lsjson", "--hash", "--files-from", tmpfile]
-        cmd += (
+        return files, prev_list
+
+    def _clean_listing(self, data, AB):
+        """
+        clean_listing(data) in a worker process if list_processes (and the pool
+        works). Otherwise in this thread
+        """
+        if not self.config.list_processes:
+            return clean_listing(data)
+        try:
+            return unpack_files(list_pool().submit(clean_listing_packed, data).result())
+        except (BrokenProcessPool, OSError) as exc:
+            global _LIST_POOL
+            with _LIST_POOL_LOCK:
+                _LIST_POOL = None  # Try a new one next time
+            debug(f"{AB}: Could not use a worker process ({exc!r}). Using a thread")
+            return clean_listing(data)
+
+    def _file_list_ooc(self, cmd, AB, prev_thread):
+        """
+        Out-of-core version of the end of file_list. The listing is streamed
+        from the rclone output into an outofcore.SortedFiles and so is the
+        previous list. Hashes are never reused (see config)
+        """
+        files = outofcore.SortedFiles(self.tmpdir, f"curr{AB}")
+        with self.lsjson(cmd, AB) as fp:
+            for file in outofcore.iter_json_array(fp):
+                mtime = file.pop("ModTime", None)
+                file["mtime"] = utils.RFC3339_to_unix(mtime) if mtime else None
+                for key in LIST_DROP_KEYS:
+                    file.pop(key, None)
+                files.add(file)
+        files.finish()
+        debug(f"{AB}: Read {len(files)}")
+
+        prev_list = prev_thread.join() if prev_thread else []
+        if not getattr(prev_list, "sorted", False):  # Empty
+            prev_list = outofcore.SortedFiles(self.tmpdir, f"prev{AB}").finish()
+
+        return files, prev_list
+
+    def fetch_hashes(self, remote, files, paths):
+        """
+        Compute the hashes of paths on remote and set them in files (DictTable)
+        in place. Files that are fetched always get a 'Hashes' key even if the
+        remote does not provide any.
+
+        The paths are split into concurrent batches. See hash_threads in the
+        config.
+        """
+        config = self.config
+        AB = remote
+        paths = list(paths)
+        byPath = {file["Path"]: file for file in files}
+
+        cache = None
+        if config.hash_cache and self.is_local(AB):
+            cache = hashcache.HashCache(hashcache.dbpath(config.hash_cache))
+            root = getattr(config, f"remote{AB}")
+            keys = {path: hashcache.statkey(os.path.join(root, path)) for path in paths}
+            cached = cache.get(keys)
+            for path, hashes in cached.items():
+                byPath[path]["Hashes"] = hashes
+            paths = [path for path in paths if path not in cached]
+            log(f"{AB}: Got {len(cached)} hashes from the local hash cache")
+            if not paths:
+                cache.close()
+                return
+
+        nthreads = config.hash_threads
+        if nthreads is None:  # Hashing is CPU-bound locally. Others may not like it
+            nthreads = (os.cpu_count() or 1) if self.is_local(AB) else 1
+        nthreads = max(min(int(nthreads), len(paths) // HASH_BATCH_MIN), 1)
+
+        cmd0 = ["lsjson", "--hash"]
+        cmd0 += (
             config.rclone_flags + self.add_args + getattr(config, f"rclone_flags{AB}")
         )
 
-        cmd.extend(
+        cmd0.extend(
             ["-R", "--no-mimetype", "--files-only"]  # Not needed so will be faster
         )
 
-        cmd.append(remote)
-
-        updated = json.loads(self.call(cmd))
-        for file in updated:
-            if "Hashes" in file:
-                files[{"Path": file["Path"]}]["Hashes"] = file["Hashes"]
-
-        debug(f"{AB}: Updated hash on {len(updated)} files")
-
-        return files, prev_list
+        def _fetch(ii):
+            tmpfile = self.tmpdir + f"/{AB}_update_hash.{ii}"
+            with open(tmpfile, "wt") as file:
+                file.write("\n".join(paths[ii::nthreads]))  # Interleave to balance
+
+            cmd = cmd0 + ["--files-from", tmpfile, getattr(config, f"remote{AB}")]
+            return json.loads(self.call(cmd))
+
+        debug(f"{AB}: Fetching hashes in {nthreads} batch(es)")
+        count = 0
+        with ThreadPoolExecutor(max_workers=nthreads) as exe:
+            for updated in exe.map(_fetch, range(nthreads)):
+                for file in updated:
+                    byPath[file["Path"]]["Hashes"] = file.get("Hashes", {})
+                count += len(updated)
+
+        debug(f"{AB}: Updated hash on {count} files")
+
+        if cache:
+            # Only cache if the file did not change while hashing
+            items = []
+            for path in paths:
+                key = hashcache.statkey(os.path.join(root, path))
+                if key is not None and key == keys[path]:
+                    items.append((key, byPath[path].get("Hashes")))
+            cache.set(items)
+            cache.close()
+
+    def is_local(self, remote):
+        """Whether remote (A or B) is a local path (not an rclone remote)"""
+        return ":" not in getattr(self.config, f"remote{remote}")
 
     def delete_backup_move(self, remote, dels, backups, moves):
         """
@@ -548,8 +1182,10 @@ class Rclone:
             cmd += [src, dst]
             return t, self.call(cmd, stream=False, logstderr=False)
 
-        with ThreadPoolExecutor(max_workers=int(config.action_threads)) as exe:
-            for action, res in exe.map(_moveto, moveto):
+        if config.rc_daemon:
+            self._moveto_rc(AB, remote, moveto)
+        else:
+            for action, res in self.action_map(_moveto, moveto, congested=_output):
                 log(action)
                 for line in res.split("\n"):
                     line = line.strip()
@@ -618,6 +1254,39 @@ class Rclone:
                 if line:
                     log("rclone:", line)
 
+    def _moveto_rc(self, AB, remote, moveto):
+        """
+        moveto for each (src,dst) over the rclone rcd daemon for AB. All moves are
+        tried and each failure is logged before raising an error
+        """
+        daemon = self.daemons[AB]
+        # Same as the moveto flags. The dest is known not to exist
+        flags = {"NoCheckDest": True, "IgnoreTimes": True, "NoTraverse": True}
+
+        def _movefile(file):
+            src, dst = file
+            try:
+                daemon.call(
+                    "operations/movefile",
+                    srcFs=remote,
+                    srcRemote=src,
+                    dstFs=remote,
+                    dstRemote=dst,
+                    _config=flags,
+                )
+                return file, None
+            except rcd.RCError as err:
+                return file, err
+
+        failed = []
+        for (src, dst), err in self.action_map(_movefile, moveto, congested=_error):
+            log(f"Move {repr(src)} --> {repr(dst)}")
+            if err:
+                log(f"ERROR: Could not move {repr(src)} on {AB}: {err}")
+                failed.append(src)
+        if failed:
+            raise rcd.RCError(f"{len(failed)} of {len(moveto)} moves failed on {AB}")
+
     def transfer(self, mode, matched_size, diff_size):
         config = self.config
         if mode == "A2B":
@@ -789,8 +1458,8 @@ class Rclone:
 
     def rmdirs(self, remote, dirlist):
         """
-        Remove the directories in dirlist. dirlist is sorted so the deepest
-        go first and then they are removed. Note that this is done this way
+        Remove the directories in dirlist. dirlist is reduced to the top-most
+        directories and rmdirs removes the rest. Note that this is done this way
         since rclone will not delete if *anything* exists there; even files
         we've ignored.
         """
@@ -801,15 +1470,9 @@ class Rclone:
         # Originally, I sorted by length to get the deepest first but I can
         # actually get the root of them so that I can call rmdirs (with the `s`)
         # and let that go deep
-
-        rmdirs = []
-        for diritem in sorted(dirlist):
-            # See if it's parent is already there. This can 100% be improved
-            # since the list is sorted. See https://stackoverflow.com/q/7380629/3633154
-            # for example. But it's not worth it here
-            if any(diritem.startswith(f"{rmdir}/") for rmdir in rmdirs):
-                continue  # ^^^ Add the / so it gets child dirs only
-            rmdirs.append(diritem)
+        rmdirs = utils.collapse_dirs(dirlist)
+        if config.rc_daemon:
+            return self._rmdirs_rc(AB, remote, rmdirs)
 
         cmd = config.rclone_flags + self.add_args + getattr(config, f"rclone_flags{AB}")
         cmd += [
@@ -832,29 +1495,80 @@ class Rclone:
                 # properly removing empty dirs is acceptable
                 return rmdir, "<< could not delete >>"
 
-        with ThreadPoolExecutor(max_workers=int(config.action_threads)) as exe:
-            for rmdir, res in exe.map(_rmdir, rmdirs):
-                log(f"rmdirs (if possible) on {AB}: {rmdir}")
-                for line in res.split("\n"):
-                    line = line.strip()
-                    if line:
-                        log("rclone:", line)
+        for rmdir, res in self.action_map(_rmdir, rmdirs, congested=_output):
+            log(f"rmdirs (if possible) on {AB}: {rmdir}")
+            for line in res.split("\n"):
+                line = line.strip()
+                if line:
+                    log("rclone:", line)
+
+    def _rmdirs_rc(self, AB, remote, rmdirs):
+        """
+        rmdirs over the rclone rcd daemon for AB rather than a process for each.
+        Errors are logged and otherwise ignored like rmdirs
+        """
+        daemon = self.daemons[AB]
+
+        def _rmdir(rmdir):
+            try:
+                daemon.call("operations/rmdirs", fs=remote, remote=rmdir)
+                return rmdir, ""
+            except rcd.RCError as err:
+                return rmdir, f"<< could not delete >> {err}"
+
+        for rmdir, res in self.action_map(_rmdir, rmdirs, congested=_output):
+            log(f"rmdirs (if possible) on {AB}: {rmdir}")
+            if res:
+                log("rclone:", res)
 
-    @utils.memoize
     def features(self, remote):
         """Get remote features"""
         config = self.config
         AB = remote
         remote = getattr(config, f"remote{AB}")
-        features = json.loads(
-            self.call(
-                ["backend", "features", remote]
-                + config.rclone_flags
-                + getattr(config, f"rclone_flags{AB}"),
-                stream=False,
+        flags = config.rclone_flags + getattr(config, f"rclone_flags{AB}")
+
+        def _features():
+            cmd = ["backend", "features", remote] + flags
+            return json.loads(self.call(cmd, stream=False)).get("Features", {})
+
+        return self.cached(_features, "features", remote=remote, flags=flags)[0]
+
+    def cached(self, fetch, *args, remote=None, flags=()):
+        """
+        Return (fetch(), where) cached for this process (see process_key) and,
+        with rclone_cache_ttl, on disk (see rclonecache). where is None if it
+        was fetched or says which cache it came from
+        """
+        config = self.config
+        key = self.process_key(*args, remote, *flags)
+        if key in _PROCESS_CACHE:
+            return _PROCESS_CACHE[key], "checked already"
+
+        diskkey = value = where = None
+        if config.rclone_cache_ttl:
+            diskkey = rclonecache.key(
+                config.rclone_exe, self.env(), *args, remote=remote, flags=flags
             )
-        )
-        return features.get("Features", {})
+        if diskkey and not config.refresh_rclone_cache:
+            value = rclonecache.get(diskkey, config.rclone_cache_ttl)
+            where = "cached" if value is not None else None
+            debug(f"rclone cache {'hit' if where else 'miss'} for {args}, {remote}")
+        if value is None:
+            value = fetch()
+            if diskkey:
+                rclonecache.put(diskkey, value, config.rclone_cache_ttl)
+
+        _PROCESS_CACHE[key] = value
+        return value, where
+
+    def process_key(self, *args):
+        """
+        Key for _PROCESS_CACHE. Includes the rclone executable, the environment,
+        and the working directory (relative paths) with args
+        """
+        env = tuple(sorted(self.config.rclone_env.items()))
+        return (self.config.rclone_exe, env, os.getcwd()) + args
 
     def copy_support(self, remote):
         """
@@ -0,0 +1,199 @@
+"""
+On-disk cache of rclone results that rarely change (the version and the remote
+features) so repeated runs do not have to call rclone for them. See
+rclone_cache_ttl in the config and --refresh-rclone-cache.
+
+Entries are keyed by the rclone executable (resolved path, size, and mtime),
+the RCLONE_* environment, the arguments, and, for remotes, the remote's
+definition in the rclone config file (including any remotes it wraps such as
+with crypt or alias). A change to any of them is a miss. The key is a hash so
+no secrets are written.
+"""
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows. Concurrent runs may then drop an entry
+    fcntl = None
+
+from . import debug
+from . import utils
+
+ENCRYPTED = "RCLONE_ENCRYPT_V0:"
+
+
+def cachepath():
+    return utils.cache_dir("rclone.json")
+
+
+def exe_key(rclone_exe):
+    """(path, size, mtime_ns, *args) of the rclone executable or None if not found"""
+    parts = shlex.split(rclone_exe)
+    path = shutil.which(parts[0]) if parts else None
+    if not path:
+        return None
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    return [path, st.st_size, st.st_mtime_ns] + parts[1:]
+
+
+def config_path(env, flags=()):
+    """The rclone config file that would be used with this env and flags"""
+    flags = list(flags)
+    for ii, flag in enumerate(flags):
+        if flag == "--config" and ii + 1 < len(flags):
+            return flags[ii + 1]
+        if flag.startswith("--config="):
+            return flag.split("=", 1)[1]
+    if env.get("RCLONE_CONFIG"):
+        return env["RCLONE_CONFIG"]
+
+    home = os.path.expanduser("~")
+    xdg = env.get("XDG_CONFIG_HOME") or os.path.join(home, ".config")
+    path = os.path.join(xdg, "rclone", "rclone.conf")
+    legacy = os.path.join(home, ".rclone.conf")
+    if not os.path.exists(path) and os.path.exists(legacy):
+        return legacy
+    return path
+
+
+def remote_name(remote):
+    """Name of the configured remote in remote or None (local or ':backend:')"""
+    m = re.match(r"^([^:/\\]+):", remote.strip())
+    if not m or len(m.group(1)) == 1:  # Windows drive letters
+        return None
+    return m.group(1).split(",")[0]  # 'name,opt=val:' connection strings
+
+
+def _sections(text):
+    sections, lines = {}, None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        if line.startswith("[") and line.endswith("]"):
+            lines = sections[line[1:-1]] = []
+        elif lines is not None:
+            lines.append(line)
+    return sections
+
+
+def remote_def(remote, env, flags=()):
+    """
+    The config file lines that define remote and the remotes it wraps (via
+    'remote' or 'upstreams'). An encrypted config can not be read so the whole
+    file is used instead
+    """
+    try:
+        with open(config_path(env, flags)) as fp:
+            text = fp.read()
+    except (OSError, UnicodeDecodeError):
+        text = ""
+    if ENCRYPTED in text:
+        return [text]
+
+    sections = _sections(text)
+    lines = []
+    names = [remote_name(remote)]
+    seen = set()
+    while names:
+        name = names.pop(0)
+        if not name or name in seen:
+            continue
+        seen.add(name)
+        section = sections.get(name, [])
+        lines.append(f"[{name}]")
+        lines.extend(section)
+        for line in section:
+            key, _, val = line.partition("=")
+            if key.strip() in {"remote", "upstreams"}:
+                names.extend(remote_name(v) for v in val.split())
+    return lines
+
+
+def key(rclone_exe, env, *args, remote=None, flags=()):
+    """
+    Cache key for args (e.g. 'version' or 'features'). Returns None if the
+    rclone executable can not be found (so it should not be cached)
+    """
+    exe = exe_key(rclone_exe)
+    if exe is None:
+        return None
+    parts = {
+        "exe": exe,
+        "env": sorted((k, v) for k, v in env.items() if k.startswith("RCLONE_")),
+        "cwd": os.getcwd(),  # Relative local paths
+        "args": args,
+        "flags": list(flags),
+    }
+    if remote is not None:
+        parts["remote"] = remote
+        parts["def"] = remote_def(remote, env, flags)
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def _load(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def get(key, ttl, path=None):
+    """Cached value for key or None if missing or older than ttl (sec)"""
+    entry = _load(path or cachepath()).get(key)
+    if not entry or time.time() - entry["time"] > ttl:
+        return None
+    return entry["value"]
+
+
+@contextmanager
+def _locked(path):
+    """Hold an exclusive lock on path + '.lock' (if it can be taken)"""
+    if fcntl is None:
+        yield
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fp = open(f"{path}.lock", "a")
+    except OSError as exc:
+        debug(f"Could not lock rclone cache {path!r}: {exc}")
+        yield
+        return
+    with fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def put(key, value, ttl, path=None):
+    """
+    Set key to value. Also removes entries older than ttl. The read, merge, and
+    write are done under a lock so concurrent runs (e.g. --multi) do not drop
+    each other's entries
+    """
+    path = path or cachepath()
+    with _locked(path):
+        now = time.time()
+        cache = _load(path)
+        cache = {k: e for k, e in cache.items() if now - e["time"] <= ttl}
+        cache[key] = {"time": now, "value": value}
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{utils.random_str(5)}"
+            with open(tmp, "wt") as fp:
+                json.dump(cache, fp)
+            os.replace(tmp, path)  # Atomic so readers do not see partial files
+        except OSError as exc:
+            debug(f"Could not write rclone cache {path!r}: {exc}")
@@ -0,0 +1,256 @@
+"""
+SQLite-backed file lists (see filelist_store in the config).
+
+SQLiteTable implements the subset of the DictTable interface used by
+syncrclone so the planner can use either. The files are stored as JSON with
+Path, Size, and mtime also as indexed columns. All tables for a run share one
+database in the tempdir so it can be inspected afterwards.
+
+Note that items are decoded on every access so, unlike DictTable, modifying a
+returned item does *not* modify the table. Use update_files().
+"""
+import json
+import os
+import sqlite3
+import threading
+from itertools import count
+
+from . import debug
+
+COLUMNS = ("Path", "Size", "mtime")
+FETCH_SIZE = 10000
+
+
+class FileListDB:
+    """The shared database. Safe to use from multiple threads"""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.remove(path)  # Start fresh
+        except OSError:
+            pass
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = OFF")  # Scratch data
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.lock = threading.RLock()
+        self._ids = count()
+
+    def execute(self, sql, params=()):
+        with self.lock, self.conn:
+            return self.conn.execute(sql, params)
+
+    def table(self, items=(), name="files"):
+        return SQLiteTable(self, items, name=name)
+
+    def close(self):
+        self.conn.close()
+
+
+class SQLiteTable:
+    """
+    A file list (dicts with at least 'Path') in a FileListDB. Iterates in Path
+    order (so it can be used where outofcore sorted lists can)
+    """
+
+    sorted = True
+
+    def __init__(self, db, items=(), name="files"):
+        self.db = db
+        self.name = f"{name}_{next(db._ids)}"
+        self.N = 0
+        db.execute(
+            f"CREATE TABLE {self.name}(Path TEXT, Size INTEGER, mtime REAL, data TEXT)"
+        )
+        self.add(items)
+        self._index()
+
+    def _index(self):
+        # Indexes are faster to build after the bulk insert
+        for cols in ["Path", "Size", "Size, mtime"]:
+            ixname = f"{self.name}_{cols.replace(', ', '_')}"
+            self.db.execute(f"CREATE INDEX {ixname} ON {self.name}({cols})")
+
+    def add(self, item):
+        """Add an item or an iterable of items"""
+        items = [item] if isinstance(item, dict) else item
+        with self.db.lock, self.db.conn:
+            cur = self.db.conn.executemany(
+                f"INSERT INTO {self.name} VALUES (?, ?, ?, ?)",
+                (
+                    (it["Path"], it.get("Size"), it.get("mtime"), json.dumps(it))
+                    for it in items
+                ),
+            )
+            self.N += cur.rowcount
+
+    def _select(self, cols, *args, **kwargs):
+        """SELECT rowid, cols, data for the query"""
+        query = dict(*args, **kwargs)
+        if not all(isinstance(key, str) for key in query):
+            raise ValueError("SQLiteTable only supports {attribute:value} queries")
+
+        where = [f"{key} IS ?" for key in query if key in COLUMNS]
+        params = [val for key, val in query.items() if key in COLUMNS]
+        others = {key: val for key, val in query.items() if key not in COLUMNS}
+
+        for row in paged(self.db, cols, f"FROM {self.name}", where, params, "rowid"):
+            item = json.loads(row[-1])
+            if all(key in item and item[key] == val for key, val in others.items()):
+                yield row[0], item
+
+    def query(self, *args, **kwargs):
+        return (item for _, item in self._select("data", *args, **kwargs))
+
+    __call__ = query
+
+    def query_one(self, *args, **kwargs):
+        return next(self.query(*args, **kwargs), None)
+
+    def __getitem__(self, item):
+        if not isinstance(item, dict):
+            raise ValueError("Must specify DB[{'attribute':val}]")
+        return self.query_one(item)
+
+    def __contains__(self, item):
+        return self.query_one(item) is not None
+
+    def pop(self, *args, **kwargs):
+        """Query, delete, and return the item. See DictTable.pop"""
+        rows = list(self._select("data", *args, **kwargs))
+        if len(rows) == 0:
+            raise KeyError("No matching query")
+        if len(rows) > 1:
+            raise ValueError("Cannot `.pop()` more than one item`")
+        self._delete([rows[0][0]])
+        return rows[0][1]
+
+    def remove(self, *args, **kwargs):
+        """Remove all matching items"""
+        rowids = [rowid for rowid, _ in self._select("data", *args, **kwargs)]
+        if not rowids:
+            raise ValueError("No matching items")
+        self._delete(rowids)
+
+    __delitem__ = remove
+
+    def _delete(self, rowids):
+        with self.db.lock, self.db.conn:
+            self.db.conn.executemany(
+                f"DELETE FROM {self.name} WHERE rowid = ?", ((r,) for r in rowids)
+            )
+        self.N -= len(rowids)
+
+    def remove_paths(self, table):
+        """Remove all items with a Path in the (SQL) table"""
+        cur = self.db.execute(
+            f"DELETE FROM {self.name} WHERE Path IN (SELECT Path FROM {table})"
+        )
+        self.N -= cur.rowcount
+
+    def update_files(self, files):
+        """Replace the stored items with these (matched by Path)"""
+        with self.db.lock, self.db.conn:
+            self.db.conn.executemany(
+                f"UPDATE {self.name} SET Size = ?, mtime = ?, data = ? WHERE Path = ?",
+                (
+                    (f.get("Size"), f.get("mtime"), json.dumps(f), f["Path"])
+                    for f in files
+                ),
+            )
+
+    def copy(self):
+        new = SQLiteTable.__new__(SQLiteTable)
+        new.db = self.db
+        new.name = f"{self.name.rsplit('_', 1)[0]}_{next(self.db._ids)}"
+        new.N = self.N
+        self.db.execute(
+            f"CREATE TABLE {new.name} AS SELECT * FROM {self.name} ORDER BY rowid"
+        )
+        new._index()
+        return new
+
+    __copy__ = copy
+
+    def __len__(self):
+        return self.N
+
+    def __iter__(self):
+        for row in paged(self.db, "data", f"FROM {self.name}", key="Path, rowid"):
+            yield json.loads(row[-1])
+
+    items = __iter__
+
+
+def paged(db, cols, source, where=(), params=(), key="rowid"):
+    """
+    Yield the rows of 'SELECT key, cols source WHERE where' in key order. They
+    are fetched FETCH_SIZE at a time (paged by key, which must be unique) so
+    the whole result is never in memory and the lock is not held while the
+    caller works (e.g. writes to the same database)
+    """
+    nkey = len(key.split(","))
+    last = None
+    while True:
+        conds, args = list(where), list(params)
+        if last is not None:
+            conds.append(f"({key}) > ({', '.join('?' * nkey)})")
+            args.extend(last)
+        sql = f"SELECT {key}, {cols} {source}"
+        if conds:
+            sql += " WHERE " + " AND ".join(conds)
+        sql += f" ORDER BY {key} LIMIT {FETCH_SIZE}"
+        rows = db.execute(sql, args).fetchall()  # At most FETCH_SIZE
+        if not rows:
+            return
+        yield from rows
+        last = rows[-1][:nkey]
+
+
+def common_paths(tableA, tableB, compare, dt, fallback):
+    """
+    Find the paths in both tables that are the same and return the name of a
+    new SQL table of them. Pairs that can be decided with SQL are (size and
+    mtime compare when both have mtimes). The rest are decided by
+    fallback(fileA, fileB), e.g. SyncRClone.compare.
+    """
+    db = tableA.db
+    name = f"common_{next(db._ids)}"
+    db.execute(f"CREATE TABLE {name}(Path TEXT PRIMARY KEY)")
+
+    join = f"FROM {tableA.name} a JOIN {tableB.name} b ON a.Path = b.Path"
+    if compare == "size":
+        decided = ["a.Size = b.Size"]
+        undecided = None
+    elif compare == "mtime":
+        decided = ["a.Size = b.Size", f"abs(a.mtime - b.mtime) <= {float(dt)!r}"]
+        undecided = ["a.Size = b.Size", "(a.mtime IS NULL OR b.mtime IS NULL)"]
+    else:  # hash: All in python. Hash compare doesn't check size
+        decided = None
+        undecided = []
+
+    if decided:
+        db.execute(
+            f"INSERT OR IGNORE INTO {name} SELECT a.Path {join} "
+            f"WHERE {' AND '.join(decided)}"
+        )
+
+    def insert(paths):
+        with db.lock, db.conn:
+            db.conn.executemany(f"INSERT OR IGNORE INTO {name} VALUES (?)", paths)
+
+    if undecided is not None:
+        equal = []
+        rows = paged(db, "a.data, b.data", join, undecided, key="a.rowid, b.rowid")
+        for _, _, dataA, dataB in rows:
+            fileA, fileB = json.loads(dataA), json.loads(dataB)
+            if fallback(fileA, fileB):
+                equal.append((fileA["Path"],))
+            if len(equal) >= FETCH_SIZE:
+                insert(equal)
+                equal = []
+        insert(equal)
+
+    ncommon = db.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+    debug(f"SQL: {ncommon} common files in {name}")
+    return name
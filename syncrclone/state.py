@@ -0,0 +1,465 @@
+"""
+Reading and writing the stored file lists (state).
+
+The state on each remote is a base file, `{AB}-{name}_fl.json.xz`, that is the
+full list (and is all older versions read) plus optional delta files,
+`{AB}-{name}_fl.delta.{seq}.json.xz`. Each delta stores the files added (or
+changed) and the paths removed relative to the base with all prior deltas
+applied. Deltas also record the md5 of the base they apply to so stale deltas
+(e.g. from before a compaction or a reset) are ignored.
+
+With state_format = 'sharded', the list is instead split into shards by path
+(the top-level directory or a hash bucket), `{AB}-{name}_fl.shard.{id}.json.xz`,
+with a manifest, `{AB}-{name}_fl.manifest.json.xz`, of each shard's file, md5,
+and a digest of its entries. Shards that did not change are not written again.
+
+With state_format = 'packed', it is `{AB}-{name}_fl.packed.xz`, the xz of a
+binary list that is decompressed to the tempdir and read with mmap. See packed.py
+
+Lists are written as concatenated xz streams of BLOCK_ENTRIES entries each. It
+is still one valid .json.xz (xz and lzma read all of the streams) but the
+streams can be found from the xz index and decompressed in parallel. See decode
+
+This module only deals with local files. The transfers are done in rclone.py
+"""
+import hashlib
+import json
+import lzma
+import os
+import re
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from . import debug
+from . import outofcore
+from . import packed
+
+BLOCK_ENTRIES = 50000  # Entries per xz stream when writing lists
+DECODE_THREADS = min(os.cpu_count() or 1, 8)
+
+XZ_HEADER_MAGIC = b"\xfd7zXZ\x00"
+XZ_FOOTER_MAGIC = b"YZ"
+
+
+def stem(AB, name):
+    return f"{AB}-{name}_fl"
+
+
+def base_name(AB, name):
+    return f"{stem(AB,name)}.json.xz"
+
+
+def delta_name(AB, name, seq):
+    return f"{stem(AB,name)}.delta.{seq:06d}.json.xz"
+
+
+def manifest_name(AB, name):
+    return f"{stem(AB,name)}.manifest.json.xz"
+
+
+def packed_name(AB, name):
+    return f"{stem(AB,name)}.packed.xz"
+
+
+def shard_name(AB, name, sid):
+    """The shard file name. The id is hashed since it may be any directory name"""
+    sid = hashlib.md5(sid.encode("utf-8", "surrogateescape")).hexdigest()[:16]
+    return f"{stem(AB,name)}.shard.{sid}.json.xz"
+
+
+def glob_escape(text):
+    """Escape text to be used literally in an rclone filter glob"""
+    return re.sub(r"([\\*?\[\]{}])", r"\\\1", text)
+
+
+def new_info():
+    """Info for a remote with no (known) state"""
+    return {
+        "base": None,
+        "deltas": 0,
+        "delta_entries": 0,
+        "files": [],
+        "stale": False,
+        "manifest": None,
+    }
+
+
+def read_state(srcdir, AB, name, out=None, prefer="single", kept=None):
+    """
+    Read the state in srcdir (where the state files were downloaded).
+
+    If out is specified (e.g. an outofcore.SortedFiles), the files are streamed
+    into it (and it is returned) rather than all read into memory. A packed
+    state is returned as a packed.PackedFiles (which is already on disk).
+
+    If there is state in more than one format (e.g. the old files could not be
+    removed), the prefer format (a state_format) is read. Otherwise the base,
+    then a sharded, then a packed state. kept is a dict of shard md5 to the
+    entries already in memory (e.g. from the last --daemon run); they are not
+    read.
+
+    Returns the file list (or None if there is no base) and an info dict:
+        base          : md5 of the base file
+        deltas        : number of deltas applied
+        delta_entries : total number of entries in the applied deltas
+        files         : the state file names present
+        stale         : Whether there were deltas that could not be applied. If
+                        so, the next push should write a new base.
+        manifest      : The manifest if the state was sharded
+    """
+    info = new_info()
+    try:
+        info["files"] = sorted(os.listdir(srcdir))
+    except OSError:
+        return None, info
+
+    present = {
+        "single": base_name(AB, name),
+        "sharded": manifest_name(AB, name),
+        "packed": packed_name(AB, name),
+    }
+    present = [fmt for fmt, fname in present.items() if fname in info["files"]]
+    prefer = "single" if prefer == "delta" else prefer
+    fmt = prefer if prefer in present else (present or [None])[0]
+    if fmt == "sharded":
+        return _read_sharded(srcdir, AB, name, info, out, kept or {})
+    if fmt == "packed":
+        return _read_packed(srcdir, AB, name, info)
+
+    basepath = os.path.join(srcdir, base_name(AB, name))
+
+    if out is not None:
+        return _stream_state(basepath, srcdir, AB, name, info, out)
+
+    try:
+        with open(basepath, "rb") as file:
+            data = file.read()
+    except FileNotFoundError:
+        return None, info
+
+    info["base"] = hashlib.md5(data).hexdigest()
+    files = decode(data)
+
+    deltas = _read_deltas(srcdir, AB, name, info)
+    if not deltas:
+        return files, info
+
+    state = {file["Path"]: file for file in files}
+    for delta in deltas:
+        apply_delta(state, delta)
+    return list(state.values()), info
+
+
+def _read_deltas(srcdir, AB, name, info):
+    """Read the deltas that apply to info['base'] (in order) and update info"""
+    deltare = re.compile(re.escape(stem(AB, name)) + r"\.delta\.(\d+)\.json\.xz")
+    deltas = {}
+    for fname in info["files"]:
+        m = deltare.fullmatch(fname)
+        if m:
+            deltas[int(m.group(1))] = fname
+    applied = []
+    seq = 1
+    while seq in deltas:
+        with lzma.open(os.path.join(srcdir, deltas[seq])) as file:
+            delta = json.load(file)
+        if delta.get("base") != info["base"] or delta.get("seq") != seq:
+            break
+        applied.append(delta)
+        info["deltas"] = seq
+        info["delta_entries"] += len(delta["add"]) + len(delta["remove"])
+        seq += 1
+
+    if info["deltas"] != len(deltas):
+        debug(f"{AB}: {len(deltas) - info['deltas']} stale state deltas")
+        info["stale"] = True
+
+    return applied
+
+
+def _stream_state(basepath, srcdir, AB, name, info, out):
+    md5 = hashlib.md5()
+    try:
+        with open(basepath, "rb") as file:
+            for chunk in iter(lambda: file.read(outofcore.READ_SIZE), b""):
+                md5.update(chunk)
+    except FileNotFoundError:
+        return None, info
+    info["base"] = md5.hexdigest()
+
+    # The final state of any path in a delta. None if removed
+    changes = {}
+    for delta in _read_deltas(srcdir, AB, name, info):
+        apply_delta(changes, delta, removed=None)
+
+    with lzma.open(basepath) as file:
+        for entry in outofcore.iter_json_array(file):
+            if entry["Path"] not in changes:
+                out.add(entry)
+    out.extend(file for file in changes.values() if file is not None)
+    return out.finish(), info
+
+
+def _read_packed(srcdir, AB, name, info):
+    src = os.path.join(srcdir, packed_name(AB, name))
+    dst = os.path.join(srcdir, f"{stem(AB, name)}.packed")
+    try:
+        packed.decompress(src, dst)
+        files = packed.PackedFiles(dst)
+    except (lzma.LZMAError, ValueError) as exc:
+        debug(f"{AB}: Could not read packed state: {exc}")
+        return None, info
+    debug(f"{AB}: Mapped packed state with {len(files)} files")
+    return files, info
+
+
+def shard_id(path, shard_by):
+    """The shard of path: its top-level directory ('' if none) or hash bucket"""
+    if shard_by == "top":
+        return path.split("/", 1)[0] if "/" in path else ""
+    return str(zlib.crc32(path.encode("utf-8", "surrogateescape")) % shard_by)
+
+
+def split_shards(files, shard_by):
+    """Dict of shard id to its entries (sorted by Path)"""
+    shards = {}
+    for file in files:
+        shards.setdefault(shard_id(file["Path"], shard_by), []).append(file)
+    for entries in shards.values():
+        entries.sort(key=lambda file: file["Path"])
+    return shards
+
+
+def digest(entries):
+    """Hash of the entries to tell if a shard changed without compressing it"""
+    sha1 = hashlib.sha1()
+    for file in entries:
+        sha1.update(json.dumps(file, ensure_ascii=False, sort_keys=True).encode())
+        sha1.update(b"\n")
+    return sha1.hexdigest()
+
+
+def new_manifest(shard_by):
+    return {"version": 1, "shard_by": shard_by, "shards": {}}
+
+
+def _read_shard(srcdir, shard):
+    """The entries of a shard or None if it is missing or not the expected md5"""
+    try:
+        with open(os.path.join(srcdir, shard["file"]), "rb") as file:
+            data = file.read()
+    except FileNotFoundError:
+        return None
+    if hashlib.md5(data).hexdigest() != shard["md5"]:
+        return None
+    return decode(data, threads=1)  # Already one thread per shard
+
+
+def _read_sharded(srcdir, AB, name, info, out, kept):
+    with lzma.open(os.path.join(srcdir, manifest_name(AB, name))) as file:
+        manifest = json.load(file)
+    shards = list(manifest["shards"].values())
+    info["files"] = sorted(set(info["files"]) | {shard["file"] for shard in shards})
+    if out is not None:
+        return _stream_sharded(srcdir, AB, info, out, manifest)
+
+    # Decompression (but not the JSON parsing) releases the GIL
+    toread = [shard for shard in shards if shard["md5"] not in kept]
+    nthreads = max(min(len(toread), os.cpu_count() or 1, 8), 1)
+    with ThreadPoolExecutor(max_workers=nthreads) as exe:
+        read = exe.map(lambda shard: _read_shard(srcdir, shard), toread)
+        read = dict(zip((shard["md5"] for shard in toread), read))
+
+    if any(entries is None for entries in read.values()):
+        debug(f"{AB}: Missing or modified state shards")
+        return None, info
+
+    debug(f"{AB}: Read {len(toread)} of {len(shards)} state shards")
+    info["manifest"] = manifest
+    files = []
+    for shard in shards:
+        files.extend(kept[shard["md5"]] if shard["md5"] in kept else read[shard["md5"]])
+    return files, info
+
+
+def _stream_sharded(srcdir, AB, info, out, manifest):
+    """Stream the shards one at a time into out (out_of_core)"""
+    for shard in manifest["shards"].values():
+        path = os.path.join(srcdir, shard["file"])
+        md5 = hashlib.md5()
+        try:
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(outofcore.READ_SIZE), b""):
+                    md5.update(chunk)
+        except FileNotFoundError:
+            pass
+        if md5.hexdigest() != shard["md5"]:
+            debug(f"{AB}: Missing or modified state shard {shard['file']}")
+            return None, info
+        with lzma.open(path) as file:
+            out.extend(outofcore.iter_json_array(file))
+    info["manifest"] = manifest
+    return out.finish(), info
+
+
+def apply_delta(state, delta, removed=False):
+    """
+    Apply delta to state, a dict of Path:file, in place. If removed is not
+    False, removed paths are set to it rather than popped.
+    """
+    for path in delta["remove"]:
+        if removed is False:
+            state.pop(path, None)
+        else:
+            state[path] = removed
+    for file in delta["add"]:
+        state[file["Path"]] = file
+
+
+def make_delta(prev, curr):
+    """
+    Compute the delta from lists prev to curr. Files are compared on all of the
+    stored attributes so changed files are (re)added.
+
+    If both are sorted (see outofcore), it is done as a streaming merge.
+    """
+    if getattr(prev, "sorted", False) and getattr(curr, "sorted", False):
+        add, remove = [], []
+        for path, (pfile, cfile) in outofcore.merge_by_path(prev, curr):
+            if cfile is None:
+                remove.append(path)
+            elif pfile != cfile:
+                add.append(cfile)
+        return {"add": add, "remove": remove}
+
+    prev = {file["Path"]: file for file in prev}
+    add = []
+    for file in curr:
+        if prev.pop(file["Path"], None) != file:
+            add.append(file)
+    return {"add": add, "remove": sorted(prev)}
+
+
+def write(path, obj):
+    """
+    Write obj as compressed JSON to path. Returns the md5 of the written file.
+
+    Lists and other iterables that are not dicts (e.g. outofcore.SortedFiles) are
+    written one item at a time. The result decompresses to the same as json.dump
+    but doesn't require the encoded list in memory (and is faster). A new xz
+    stream is started every BLOCK_ENTRIES items so it can be decoded in parallel.
+    """
+    md5 = hashlib.md5()
+    with open(path, "wb") as file:
+
+        def _write(data):
+            md5.update(data)
+            file.write(data)
+
+        comp = lzma.LZMACompressor()
+        if isinstance(obj, dict):
+            _write(comp.compress(json.dumps(obj, ensure_ascii=False).encode()))
+        else:
+            text = ["["]
+            for ii, item in enumerate(obj):
+                if ii and not ii % BLOCK_ENTRIES:  # The stream ends between items
+                    _write(comp.compress("".join(text).encode()))
+                    _write(comp.flush())
+                    comp = lzma.LZMACompressor()
+                    text = []
+                if ii:
+                    text.append(", ")
+                text.append(json.dumps(item, ensure_ascii=False))
+                if len(text) >= 1000:
+                    _write(comp.compress("".join(text).encode()))
+                    text = []
+            text.append("]")
+            _write(comp.compress("".join(text).encode()))
+        _write(comp.flush())
+    return md5.hexdigest()
+
+
+def decode(data, threads=None):
+    """
+    Decompress and parse data (the bytes of a .json.xz). If it has more than one
+    xz stream, they are decompressed in parallel (lzma releases the GIL) and, if
+    each stream is whole entries of a list (see write), parsed separately.
+
+    The JSON parsing is not done in processes since sending the entries back
+    costs about as much as parsing them.
+    """
+    streams = xz_streams(data)
+    threads = threads or DECODE_THREADS
+    if not streams or len(streams) == 1 or threads == 1:
+        return json.loads(lzma.decompress(data))
+
+    with ThreadPoolExecutor(max_workers=min(threads, len(streams))) as exe:
+        texts = list(exe.map(lambda ab: lzma.decompress(data[ab[0] : ab[1]]), streams))
+    try:
+        return _join_fragments(texts)
+    except ValueError:  # Not split between entries (e.g. not written by write)
+        return json.loads(b"".join(texts))
+
+
+def _join_fragments(texts):
+    """Parse the text of each stream from write(). Raise ValueError if they aren't"""
+    files = []
+    for ii, text in enumerate(texts):
+        start = b"[" if ii == 0 else b", "
+        if not text.startswith(start):
+            raise ValueError("Not a fragment")
+        text = text[len(start) :]
+        if ii == len(texts) - 1:
+            if not text.endswith(b"]"):
+                raise ValueError("Not a fragment")
+            text = text[:-1]
+        if text:
+            files.extend(json.loads(b"[" + text + b"]"))
+    return files
+
+
+def _varint(data, pos):
+    """Read an xz multibyte integer at pos. Returns (value, new pos)"""
+    value = shift = 0
+    for ii in range(9):
+        byte = data[pos + ii]
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos + ii + 1
+        shift += 7
+    raise ValueError("Bad xz integer")
+
+
+def xz_streams(data):
+    """
+    The (start, end) of each xz stream in data (in order) found by walking back
+    from the end with the stream footers and indexes. None if it can't be parsed.
+    Nothing is decompressed.
+    """
+    streams = []
+    end = len(data)
+    try:
+        while end > 0:
+            while end >= 4 and data[end - 4 : end] == b"\0\0\0\0":  # Padding
+                end -= 4
+            if end < 24 or data[end - 2 : end] != XZ_FOOTER_MAGIC:
+                return None
+            (backward,) = struct.unpack("<I", data[end - 8 : end - 4])
+            index_start = end - 12 - (backward + 1) * 4
+            if data[index_start] != 0:
+                return None
+            nrecords, pos = _varint(data, index_start + 1)
+            blocks = 0
+            for _ in range(nrecords):
+                unpadded, pos = _varint(data, pos)
+                _, pos = _varint(data, pos)  # uncompressed size
+                blocks += (unpadded + 3) // 4 * 4
+            start = index_start - blocks - 12
+            if start < 0 or data[start : start + 6] != XZ_HEADER_MAGIC:
+                return None
+            streams.append((start, end))
+            end = start
+    except (IndexError, ValueError, struct.error):
+        return None
+    return streams[::-1]
@@ -1,8 +1,11 @@
 import datetime
 import random
+import re
 import string
 import os
-from threading import Thread
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Thread
 
 from . import log, debug
 
@@ -34,9 +37,12 @@ except ImportError:
 
 # Note to future self: Do not use this in other applications. See
 # DFB's parser which is much better
-def RFC3339_to_unix(timestr):
+def _RFC3339_to_unix(timestr):
     """
-    Parses RFC3339 into a unix time
+    Parses RFC3339 into a unix time. This is the original (slow) parser. It is
+    used by RFC3339_to_unix as a fallback for anything its fixed-offset fast path
+    does not handle and it *defines* the semantics that RFC3339_to_unix must
+    match.
     """
     d, t = timestr.split("T")
     year, month, day = d.split("-")
@@ -72,6 +78,94 @@ def RFC3339_to_unix(timestr):
     return unix
 
 
+_RFC3339_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}$")
+_RFC3339_TZ_RE = re.compile(r"Z$|([+-])(\d{2}):(\d{2})$")
+_RFC3339_DATES = {}  # "YYYY-MM-DD": seconds since epoch
+_RFC3339_TZS = {}  # suffix: (hour, minute) seconds to subtract
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def RFC3339_to_unix(timestr):
+    """
+    Parses RFC3339 into a unix time.
+
+    This is identical to the original parser (_RFC3339_to_unix) including the
+    truncation of the fractional seconds to 6 digits (and treating them as an
+    integer number of microseconds) but uses fixed offsets rather than splitting
+    and building datetime objects. The date and the timezone are validated once
+    and cached since listings have many repeats. Anything unexpected goes to the
+    original parser.
+    """
+    date, hh, mm, ss = timestr[:10], timestr[11:13], timestr[14:16], timestr[17:19]
+    if (
+        timestr[10:11] != "T"
+        or timestr[13:14] != ":"
+        or timestr[16:17] != ":"
+        or not (hh + mm + ss).isdigit()
+    ):
+        return _RFC3339_to_unix(timestr)
+    hh, mm, ss = int(hh), int(mm), int(ss)
+    if hh > 23 or mm > 59 or ss > 59:
+        return _RFC3339_to_unix(timestr)  # Will raise the proper error
+
+    rest = timestr[19:]
+    if rest[-1:] == "Z":
+        tz, frac = "Z", rest[:-1]
+    else:
+        tz, frac = rest[-6:], rest[:-6]
+
+    if not frac:
+        micro = 0
+    elif frac[0] == "." and frac[1:].isdigit():
+        micro = int(frac[1:7])  # Python doesn't support beyond 999999
+    else:
+        return _RFC3339_to_unix(timestr)
+
+    try:
+        days = _RFC3339_DATES[date]
+    except KeyError:
+        if not _RFC3339_DATE_RE.match(date):
+            return _RFC3339_to_unix(timestr)
+        try:
+            ordinal = datetime.date(
+                int(date[:4]), int(date[5:7]), int(date[8:10])
+            ).toordinal()
+        except ValueError:
+            return _RFC3339_to_unix(timestr)  # Will raise the proper error
+        days = _RFC3339_DATES[date] = (ordinal - _EPOCH_ORDINAL) * 86400
+
+    try:
+        tzhh, tzmm = _RFC3339_TZS[tz]
+    except KeyError:
+        match = _RFC3339_TZ_RE.match(tz)
+        if not match:
+            return _RFC3339_to_unix(timestr)
+        sign, tzhh, tzmm = match.groups()
+        if sign:
+            offset = -1 if sign == "-" else +1
+            tzhh, tzmm = int(tzhh) * 3600 * offset, int(tzmm) * 60 * offset
+        else:  # Zulu
+            tzhh, tzmm = 0, 0
+        _RFC3339_TZS[tz] = tzhh, tzmm
+
+    # Integer microseconds and then a true division is what timedelta's
+    # total_seconds() does so the result is identical, bit-for-bit. The timezone
+    # is subtracted in two steps for the same reason.
+    unix = ((days + hh * 3600 + mm * 60 + ss) * 1000000 + micro) / 10**6
+    unix -= tzhh
+    unix -= tzmm
+    return unix
+
+
+def RFC3339_to_unix_many(timestrs):
+    """
+    Parse an iterable of RFC3339 strings (or None) into a list of unix times
+    (or None)
+    """
+    parse = RFC3339_to_unix
+    return [parse(timestr) if timestr else None for timestr in timestrs]
+
+
 def add_hash_compare_attribute(*filelists):
     """
     Tool to generate a hash attribute that accounts for choosing a
@@ -178,6 +272,18 @@ def search_upwards(pwd):
     return search_upwards(newpwd)
 
 
+def cache_dir(*parts):
+    """
+    Path in the syncrclone cache directory ($XDG_CACHE_HOME/syncrclone or
+    ~/.cache/syncrclone). Set $SYNCRCLONE_CACHE to override it
+    """
+    root = os.environ.get("SYNCRCLONE_CACHE")
+    if not root:
+        xdg = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        root = os.path.join(xdg, "syncrclone")
+    return os.path.join(root, *parts)
+
+
 def time_format(dt, upper=False):
     """Format time into days (D), hours (H), minutes (M), and seconds (S)"""
     labels = [  # Label, # of sec
@@ -229,6 +335,77 @@ def pathjoin(*args):
     return path
 
 
+class DirIndex:
+    """
+    Index of directories with the number of files in each, including those in
+    subdirectories. Directories are kept when their count drops to zero so
+    that empty() can find the ones that no longer have any files.
+
+        >>> index = DirIndex(old_paths)
+        >>> index.remove('dir/file.txt') # or index.reset() to zero all counts
+        >>> index.update(new_paths)
+        >>> index.empty()  # top-most dirs that had files but no longer do
+
+    The root ('') is never included.
+    """
+
+    def __init__(self, paths=()):
+        self.counts = {}
+        self.update(paths)
+
+    def _add_dir(self, dirpath, n):
+        counts = self.counts
+        while dirpath:
+            counts[dirpath] = counts.get(dirpath, 0) + n
+            dirpath = os.path.dirname(dirpath)
+
+    def add(self, path):
+        self._add_dir(os.path.dirname(path), 1)
+
+    def remove(self, path):
+        self._add_dir(os.path.dirname(path), -1)
+
+    def move(self, src, dst):
+        self.remove(src)
+        self.add(dst)
+
+    def update(self, paths):
+        """Add all paths. Faster than add() for each"""
+        direct = {}
+        for path in paths:
+            dirpath = os.path.dirname(path)
+            direct[dirpath] = direct.get(dirpath, 0) + 1
+        for dirpath, n in direct.items():
+            self._add_dir(dirpath, n)
+
+    def reset(self):
+        """Set all counts to zero (but remember the directories)"""
+        self.counts = dict.fromkeys(self.counts, 0)
+
+    def empty(self):
+        """The top-most directories that no longer have files"""
+        counts = self.counts
+        return {
+            dirpath
+            for dirpath, n in counts.items()
+            if n == 0 and counts.get(os.path.dirname(dirpath)) != 0
+        }
+
+
+def collapse_dirs(dirs):
+    """
+    Reduce dirs to the top-most directories, removing any that are inside
+    another. Sorting by the parts keeps subdirectories right after their
+    parent so it is a single pass.
+    """
+    roots = []
+    for dirpath in sorted(set(dirs), key=lambda d: d.split("/")):
+        if roots and dirpath.startswith(f"{roots[-1]}/"):
+            continue
+        roots.append(dirpath)
+    return roots
+
+
 class ReturnThread(Thread):
     """
     Like a regular thread except when you `join`, it returns the function
@@ -237,20 +414,126 @@ class ReturnThread(Thread):
         >>> mythread = ReturnThread(...).start() # instantiate and start
 
     Note that target is a required keyword argument.
+
+    If the target raised an exception, it is re-raised on `join`.
     """
 
     def __init__(self, *, target, **kwargs):
         self.target = target
         super().__init__(target=self._target, **kwargs)
         self._res = None
+        self._exc = None
 
     def start(self, *args, **kwargs):
         super().start(*args, **kwargs)
         return self
 
     def _target(self, *args, **kwargs):
-        self._res = self.target(*args, **kwargs)
+        try:
+            self._res = self.target(*args, **kwargs)
+        except BaseException as exc:
+            self._exc = exc
 
     def join(self, *args, **kwargs):
         super().join(*args, **kwargs)
+        if self._exc is not None:
+            raise self._exc
         return self._res
+
+
+def join_all(threads, what=""):
+    """
+    Join all of the {AB:ReturnThread} threads and return {AB:result}. All threads
+    are joined before raising the first error (if any). Each failure is logged.
+    """
+    results, errors = {}, {}
+    for AB, thread in threads.items():
+        try:
+            results[AB] = thread.join()
+        except Exception as exc:
+            log(f"ERROR: {what} failed on {AB}: {exc!r}")
+            errors[AB] = exc
+    if errors:
+        raise errors[min(errors)]
+    return results
+
+
+class AIMDLimiter:
+    """
+    Concurrency that adapts AIMD-style (like TCP) between lo and hi. It starts at
+    lo and each call that is fine adds 1/limit (so about one more thread per
+    round of calls) while an error, a congested result, or a call that is much
+    slower than usual halves it. Only one decrease happens per round so a burst
+    of errors from the same calls doesn't collapse it to lo.
+
+        >>> limiter = AIMDLimiter(1, 8)
+        >>> for res in limiter.map(func, items, congested=lambda res: ...):
+        ...     pass
+    """
+
+    def __init__(self, lo, hi, slow_factor=3.0):
+        self.lo, self.hi = max(int(lo), 1), max(int(hi), 1)
+        self.lo = min(self.lo, self.hi)
+        self.limit = float(self.lo)
+        self.slow_factor = slow_factor
+
+        self.cond = Condition()
+        self.active = 0
+        self.epoch = 0  # Incremented on each decrease
+        self.latency = None  # EWMA of calls that were fine
+        self.peak = self.lo
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+            return self.epoch
+
+    def release(self, epoch, latency, congested=False):
+        with self.cond:
+            self.active -= 1
+            if (
+                not congested
+                and self.latency is not None
+                and latency > self.slow_factor * self.latency
+            ):
+                congested = True
+
+            if congested:
+                if epoch == self.epoch:  # Started before the last decrease
+                    self.limit = max(self.lo, self.limit / 2)
+                    self.epoch += 1
+                    debug(f"AIMD: Decrease to {int(self.limit)}")
+            else:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency = 0.8 * self.latency + 0.2 * latency
+                self.limit = min(self.hi, self.limit + 1 / self.limit)
+                self.peak = max(self.peak, int(self.limit))
+            self.cond.notify_all()
+
+    def map(self, func, items, congested=None):
+        """
+        Like ThreadPoolExecutor.map(func, items) (results in order) with the
+        adaptive concurrency. congested(result) can flag results that indicate
+        rate limiting (e.g. retries). Exceptions count as congested and are
+        re-raised
+        """
+
+        def _run(item):
+            epoch = self.acquire()
+            t0 = time.time()
+            try:
+                res = func(item)
+            except BaseException:
+                self.release(epoch, time.time() - t0, congested=True)
+                raise
+            flag = bool(congested and congested(res))
+            self.release(epoch, time.time() - t0, congested=flag)
+            return res
+
+        with ThreadPoolExecutor(max_workers=self.hi) as exe:
+            yield from exe.map(_run, items)
+        debug(f"AIMD: Ended at {int(self.limit)}. Peak {self.peak} of {self.hi}")
@@ -0,0 +1,377 @@
+"""
+Keep syncing as files change on A (see --watch).
+
+A must be a local path. Changes are collected with inotify (Linux, via ctypes)
+or, if that is not available, by polling the directory. After they settle for
+watch_delay, only the changed paths are listed on A and B and the rest are
+taken from the lists of the last run (kept in memory like --daemon). A full
+sync is still done at least every watch_full_interval to pick up changes to B
+(and anything that was missed).
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import shutil
+import struct
+import threading
+import time
+
+from . import debug, log
+from .cli import ConfigError
+from .rclone import filter_rule
+
+_TEST_CYCLES = None  # Stop after this many syncs (after the first). Testing only
+
+MAX_PATHS = 10000  # Do a full sync if there are more changed paths than this
+DEBOUNCE_MAX = 10  # Sync after this many watch_delays even if not settled
+POLL_INTERVAL = 5  # sec. For PollWatcher
+
+# From sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+EVENT = struct.Struct("iIII")  # wd, mask, cookie, len then the name
+
+
+def skip(relpath):
+    """Whether to ignore relpath. The workdir changes every sync"""
+    return relpath == ".syncrclone" or relpath.startswith(".syncrclone/")
+
+
+class Watcher:
+    """
+    Collects changed paths under root. Paths are relative to root with '/'.
+    Changed directories (e.g. moved or deleted) are kept separately since
+    everything under them may have changed too
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.paths, self.dirs = set(), set()
+        self.overflow = False
+        self.last = 0.0  # Time of the last change
+        self.cond = threading.Condition()
+
+    def mark(self, relpath, isdir=False, overflow=False):
+        if relpath is not None and skip(relpath):
+            return
+        with self.cond:
+            if overflow:
+                self.overflow = True
+            elif isdir:
+                self.dirs.add(relpath)
+            else:
+                self.paths.add(relpath)
+            self.last = time.time()
+            self.cond.notify_all()
+
+    def wait(self, timeout, delay):
+        """
+        Wait up to timeout for changes and then until there are none for delay
+        (or DEBOUNCE_MAX * delay). Returns (paths, dirs, overflow) and resets
+        them. Empty if there were none
+        """
+        end = time.time() + timeout
+        with self.cond:
+            while not (self.paths or self.dirs or self.overflow):
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return set(), set(), False
+                self.cond.wait(remaining)
+
+            t0 = time.time()
+            while True:
+                settle = self.last + delay - time.time()
+                if settle <= 0 or time.time() - t0 >= DEBOUNCE_MAX * delay:
+                    break
+                self.cond.wait(settle)
+
+            changes = self.paths, self.dirs, self.overflow
+            self.paths, self.dirs, self.overflow = set(), set(), False
+        return changes
+
+    def relpath(self, path):
+        relpath = os.path.relpath(path, self.root).replace(os.sep, "/")
+        return "" if relpath == "." else relpath
+
+
+class InotifyWatcher(Watcher):
+    """Watcher with Linux inotify. Raises OSError if it is not available"""
+
+    MASK = (
+        IN_MODIFY
+        | IN_ATTRIB
+        | IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_DELETE_SELF
+        | IN_MOVE_SELF
+        | IN_ONLYDIR
+    )
+
+    def __init__(self, root):
+        super().__init__(root)
+        libname = ctypes.util.find_library("c")
+        try:
+            self.libc = ctypes.CDLL(libname, use_errno=True)
+            self.libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError("inotify is not available")
+
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.wds = {}  # wd:relpath of the directory
+        self.add_tree("")
+
+        self.stopped = False
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def add_tree(self, reldir):
+        """Watch reldir and all directories under it"""
+        for dirpath, dirnames, _ in os.walk(os.path.join(self.root, reldir)):
+            relpath = self.relpath(dirpath)
+            if skip(relpath):
+                dirnames[:] = []
+                continue
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dirpath), self.MASK
+            )
+            if wd < 0:  # e.g. removed already or too many watches
+                err = ctypes.get_errno()
+                debug(f"watch: Could not watch {relpath!r}: {os.strerror(err)}")
+                if err == 28:  # ENOSPC: max_user_watches
+                    self.mark(None, overflow=True)
+                continue
+            self.wds[wd] = relpath
+
+    def remove_tree(self, reldir):
+        """Stop watching reldir and all directories under it"""
+        prefix = reldir + "/"
+        for wd, relpath in list(self.wds.items()):
+            if relpath == reldir or relpath.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                self.wds.pop(wd, None)
+
+    def _read(self):
+        while not self.stopped:
+            ready, _, _ = select.select([self.fd], [], [], 1)
+            if not ready:
+                continue
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except OSError:
+                return
+            ii = 0
+            while ii < len(buf):
+                wd, mask, _, length = EVENT.unpack_from(buf, ii)
+                name = buf[ii + EVENT.size : ii + EVENT.size + length]
+                ii += EVENT.size + length
+                self.event(wd, mask, os.fsdecode(name.rstrip(b"\0")))
+
+    def event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            debug("watch: inotify queue overflow")
+            self.mark(None, overflow=True)
+            return
+        if mask & IN_IGNORED:
+            self.wds.pop(wd, None)
+            return
+        if wd not in self.wds:
+            return
+
+        reldir = self.wds[wd]
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if not reldir:  # A itself
+                self.mark(None, overflow=True)
+            return  # The parent will report it
+        relpath = f"{reldir}/{name}" if reldir else name
+
+        if not mask & IN_ISDIR:
+            self.mark(relpath)
+            return
+
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            self.add_tree(relpath)
+        elif mask & (IN_MOVED_FROM | IN_DELETE):
+            self.remove_tree(relpath)
+        if mask & (IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+            self.mark(relpath, isdir=True)
+
+    def stop(self):
+        self.stopped = True
+        self.thread.join()
+        os.close(self.fd)
+
+
+class PollWatcher(Watcher):
+    """Watcher that compares os.stat of all files every POLL_INTERVAL"""
+
+    def __init__(self, root, interval=None):
+        super().__init__(root)
+        self.interval = interval or POLL_INTERVAL
+        self.snapshot = self.scan()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._poll, daemon=True)
+        self.thread.start()
+
+    def scan(self):
+        """{relpath: (size, mtime_ns, ino)} of all files"""
+        snapshot = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if skip(self.relpath(dirpath)):
+                dirnames[:] = []
+                continue
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[self.relpath(path)] = (st.st_size, st.st_mtime_ns, st.st_ino)
+        return snapshot
+
+    def _poll(self):
+        while not self.stopped.wait(self.interval):
+            snapshot = self.scan()
+            for relpath in set(snapshot) | set(self.snapshot):
+                if snapshot.get(relpath) != self.snapshot.get(relpath):
+                    self.mark(relpath)
+            self.snapshot = snapshot
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def watcher(root):
+    """InotifyWatcher if available or a PollWatcher"""
+    try:
+        return InotifyWatcher(root)
+    except OSError as exc:
+        log(f"inotify not available ({exc}). Polling every {POLL_INTERVAL} sec")
+        return PollWatcher(root)
+
+
+def expand(paths, dirs, root, lists):
+    """
+    All file paths for the changed paths and directories. Directories include
+    every file under them in lists (the last known files) and now on disk.
+    """
+    paths = set(paths)
+    if dirs:
+        prefixes = tuple(f"{reldir}/" for reldir in dirs)
+        for files in lists:
+            paths.update(f["Path"] for f in files if f["Path"].startswith(prefixes))
+        for reldir in dirs:
+            top = os.path.join(root, reldir)
+            for dirpath, _, filenames in os.walk(top):
+                rel = os.path.relpath(dirpath, root).replace(os.sep, "/")
+                paths.update(f"{rel}/{filename}" for filename in filenames)
+    return {path for path in paths if not skip(path)}
+
+
+def can_limit(config, paths):
+    """Whether only paths can be listed (or there needs to be a full sync)"""
+    if len(paths) > MAX_PATHS:
+        debug(f"watch: {len(paths)} changed paths is more than {MAX_PATHS}")
+        return False
+    if any(filter_rule(path) is None for path in paths):
+        debug("watch: Changed paths can not be filter rules")
+        return False
+
+    # A new marker file changes what else is excluded
+    flags = config.filter_flags
+    markers = {
+        flags[ii + 1]
+        for ii, flag in enumerate(flags[:-1])
+        if flag == "--exclude-if-present"
+    }
+    if any(path.rsplit("/", 1)[-1] in markers for path in paths):
+        debug("watch: exclude-if-present file changed")
+        return False
+    return True
+
+
+def run(config):
+    """
+    Sync and then keep syncing changes on A until interrupted. Returns the
+    last SyncRClone object.
+    """
+    from .main import SyncRClone
+
+    if ":" in config.remoteA:
+        raise ConfigError("--watch requires remoteA to be a local path")
+    if config.interactive:
+        raise ConfigError("Cannot use --watch with --interactive")
+    if config.out_of_core:
+        raise ConfigError("--watch can not be used with out_of_core")
+
+    # Filters are added after the user's but --include(-from) adds an implicit
+    # exclude of everything else at the very end. See rclone.filter_rule
+    limit = not any(
+        flag in {"--include", "--include-from", "--files-from", "--files-from-raw"}
+        for flag in config.filter_flags
+    )
+    if not limit:
+        log("WARNING: --watch will always do a full sync with --include filters")
+
+    # Start watching before the first sync so nothing is missed
+    watch = watcher(config.remoteA)
+    log(f"Watching '{config.remoteA}'")
+
+    r = SyncRClone(config)
+    resident = r.resident_state()  # None with --dry-run
+    config.reset_state = False  # Only the first
+    last_full = time.time()
+    cycles = 0
+    try:
+        while _TEST_CYCLES is None or cycles < _TEST_CYCLES:
+            timeout = max(last_full + config.watch_full_interval - time.time(), 0)
+            paths, dirs, overflow = watch.wait(timeout, config.watch_delay)
+
+            log.clear()  # Each sync has its own log
+            incremental = None
+            if (paths or dirs) and not overflow and limit and resident:
+                lists = [resident["A"]["list"], resident["B"]["list"]]
+                paths = expand(paths, dirs, watch.root, lists)
+                if not paths:
+                    continue  # Just the workdir
+                if can_limit(config, paths):
+                    incremental = (paths, *lists)
+
+            if incremental:
+                log(f"Syncing {len(paths)} changed paths on A")
+            else:
+                log("Full sync")
+                last_full = time.time()
+
+            shutil.rmtree(config.tempdir, ignore_errors=True)
+            try:
+                r = SyncRClone(config, incremental=incremental, resident=resident)
+                resident = r.resident_state()
+            except Exception as exc:
+                log(f"ERROR: {exc!r}. Will do a full sync next time")
+                resident = None
+            cycles += 1
+    except KeyboardInterrupt:
+        log("Stopping --watch")
+    finally:
+        watch.stop()
+    return r
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+"""
+Benchmarks!
+
+These are not tests. They generate synthetic data and time the pure-Python parts
+of syncrclone (bypassing rclone) so that regressions can be caught. Run with
+
+    $ python benchmark.py plan --files 1000 100000 --modified 0.01
+
+or `python benchmark.py state` for reading and writing the state (run on a
+machine with many cores to see the parallel decoding)
+
+and see `python benchmark.py --help` for the rest.
+"""
+import os, sys
+import argparse
+import contextlib
+import io
+import json
+import lzma
+import random
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+p = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import syncrclone
+import syncrclone.cli
+from syncrclone import log
+from syncrclone.main import SyncRClone
+from syncrclone.dicttable import DictTable
+from syncrclone import utils
+
+MTIME0 = 1600000000.0
+
+
+class Timer:
+    """
+    Record the time and (optionally) the peak memory of named phases.
+    Peak memory is the peak *above* what was allocated when the phase started.
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.results = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.memory:
+            tracemalloc.reset_peak()
+            mem0 = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        yield
+        dt = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1] - mem0 if self.memory else None
+        self.results.append({"phase": name, "time": dt, "peak": peak})
+
+    def report(self, title=""):
+        print(title)
+        for res in self.results:
+            line = f"    {res['phase']:<24s} {res['time']:10.4f} s"
+            if res["peak"] is not None:
+                line += " {0:10.2f} {1}".format(*utils.bytes2human(res["peak"]))
+            print(line)
+        total = sum(res["time"] for res in self.results)
+        print(f"    {'TOTAL':<24s} {total:10.4f} s")
+
+
+def make_file(ix, *, hashes=True, mtimes=True, gen=0):
+    """Make a synthetic file entry that looks like a cleaned up lsjson entry"""
+    file = {
+        "Path": f"dir{ix % 1000:03d}/sub{ix % 7}/file{ix}.txt",
+        "Size": 100 + (ix * 7919 + gen) % 100000,
+        "mtime": MTIME0 + ix + gen * 1e6 if mtimes else None,
+    }
+    if hashes:
+        file["Hashes"] = {"sha1": f"{ix:032x}{gen:08x}"}
+    return file
+
+
+def synthetic_lists(
+    nfiles,
+    *,
+    new=0.01,
+    modified=0.01,
+    deleted=0.01,
+    moved=0.01,
+    conflicts=0.001,
+    hashes=True,
+    mtimes=True,
+    seed=1,
+):
+    """
+    Generate currA, currB, prevA, prevB lists (of dicts) for nfiles synced files
+    and then apply changes at the specified rates. Each change is applied to a
+    random side and each file gets at most one change.
+    """
+    rand = random.Random(seed)
+    kw = dict(hashes=hashes, mtimes=mtimes)
+
+    prev = [make_file(ix, **kw) for ix in range(nfiles)]
+    curr = {AB: {f["Path"]: f.copy() for f in prev} for AB in "AB"}
+
+    ixs = list(range(nfiles))
+    rand.shuffle(ixs)
+    rates = (modified, deleted, moved, conflicts)
+    counts = [int(round(rate * nfiles)) for rate in rates]
+    if sum(counts) > nfiles:
+        raise ValueError("Rates sum to more than 1")
+
+    it = iter(ixs)
+    for change, count in zip(("modified", "deleted", "moved", "conflicts"), counts):
+        for _ in range(count):
+            ix = next(it)
+            path = prev[ix]["Path"]
+            AB = rand.choice("AB")
+            if change == "modified":
+                curr[AB][path] = make_file(ix, gen=1, **kw)
+            elif change == "deleted":
+                del curr[AB][path]
+            elif change == "moved":
+                file = curr[AB].pop(path)
+                file["Path"] = f"moved/{path}"
+                curr[AB][file["Path"]] = file
+            elif change == "conflicts":
+                curr["A"][path] = make_file(ix, gen=1, **kw)
+                curr["B"][path] = make_file(ix, gen=2, **kw)
+
+    for ix in range(nfiles, nfiles + int(round(new * nfiles))):
+        file = make_file(ix, **kw)
+        curr[rand.choice("AB")][file["Path"]] = file
+
+    currA, currB = list(curr["A"].values()), list(curr["B"].values())
+    prevA, prevB = prev, [f.copy() for f in prev]
+    return currA, currB, prevA, prevB
+
+
+def planning_config(**settings):
+    """
+    Get a real Config object with the defaults from the template and any
+    settings. Note that parsing will chdir to a temp directory
+    """
+    tmpdir = tempfile.mkdtemp(prefix="syncrclone_bench_")
+    configpath = os.path.join(tmpdir, "config.py")
+    with contextlib.redirect_stdout(io.StringIO()):
+        config = syncrclone.cli.Config(configpath)
+        config._write_template()
+        with open(configpath, "at") as file:
+            file.write("\nremoteA = 'A'\nremoteB = 'B'\n")
+        config.parse(skiplog=True)
+    for key, val in settings.items():
+        setattr(config, key, val)
+    config.now = time.strftime("%Y-%m-%dT%H%M%S", time.localtime())
+    return config
+
+
+def bench_plan(nfiles, args):
+    """Run the planning phases on synthetic lists"""
+    currA, currB, prevA, prevB = synthetic_lists(
+        nfiles,
+        new=args.new,
+        modified=args.modified,
+        deleted=args.deleted,
+        moved=args.moved,
+        conflicts=args.conflicts,
+        hashes=not args.no_hash,
+        mtimes=not args.no_mtime,
+        seed=args.seed,
+    )
+
+    config = planning_config(
+        compare=args.compare,
+        renamesA=args.renames,
+        renamesB=args.renames,
+        conflict_mode=args.conflict_mode,
+        filelist_store=args.store,
+    )
+
+    sync = SyncRClone.__new__(SyncRClone)  # Do NOT call __init__ (rclone)
+    sync.config = config
+    sync.now = config.now
+    sync.now_compact = sync.now.replace("-", "")
+
+    timer = Timer(memory=args.memory)
+    if args.memory:
+        tracemalloc.start()
+
+    attribs = ["Path", "Size", "mtime"]
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+
+        with timer.phase("build DictTables"):
+            sync.currA = DictTable(currA, fixed_attributes=attribs)
+            sync.currB = DictTable(currB, fixed_attributes=attribs)
+            sync.prevA = DictTable(prevA, fixed_attributes=attribs)
+            sync.prevB = DictTable(prevB, fixed_attributes=attribs)
+        if args.store == "sqlite":
+            with timer.phase("store_lists"):
+                sync.store_lists()
+        with timer.phase("copy curr"):
+            sync.currA0 = sync.currA.copy()
+            sync.currB0 = sync.currB.copy()
+
+        with timer.phase("remove_common_files"):
+            sync.remove_common_files()
+        with timer.phase("process_non_common"):
+            sync.process_non_common()
+        with timer.phase("track_moves"):
+            sync.track_moves("A")
+            sync.track_moves("B")
+        with timer.phase("process_new_tags"):
+            sync.process_new_tags("A")
+            sync.process_new_tags("B")
+        with timer.phase("avoid_relist"):
+            sync.avoid_relist()
+
+    if args.memory:
+        tracemalloc.stop()
+    log.clear()
+
+    timer.report(
+        f"{nfiles:d} files. {len(sync.transA2B)} A >>> B, "
+        f"{len(sync.transB2A)} A <<< B, {len(sync.movesA) + len(sync.movesB)} moves"
+    )
+    return timer.results
+
+
+def bench_rfc3339(nfiles, args):
+    """Time parsing RFC3339 timestamps like those in an lsjson listing"""
+    rand = random.Random(args.seed)
+    timestrs = []
+    for _ in range(nfiles):
+        frac = f"{rand.randrange(10**9):09d}".rstrip("0")  # like rclone
+        t = time.gmtime(MTIME0 + 1e8 * rand.random())
+        timestrs.append(
+            time.strftime("%Y-%m-%dT%H:%M:%S", t)
+            + (f".{frac}" if frac else "")
+            + rand.choice(["Z", "-05:00", "+01:00"])
+        )
+
+    timer = Timer(memory=args.memory)
+    if args.memory:
+        tracemalloc.start()
+    with timer.phase("original"):
+        old = [utils._RFC3339_to_unix(timestr) for timestr in timestrs]
+    with timer.phase("RFC3339_to_unix_many"):
+        new = utils.RFC3339_to_unix_many(timestrs)
+    if args.memory:
+        tracemalloc.stop()
+
+    assert old == new, "Parsers disagree"
+    timer.report(f"{nfiles:d} timestamps")
+    return timer.results
+
+
+def bench_state(nfiles, args):
+    """
+    Time writing and reading a state file serially and in parallel and as a
+    packed (mmap) list
+    """
+    from syncrclone import packed, state
+
+    files = [make_file(ix, hashes=not args.no_hash) for ix in range(nfiles)]
+    path = os.path.join(tempfile.mkdtemp(prefix="syncrclone_bench_"), "state.json.xz")
+    if args.threads:
+        state.DECODE_THREADS = args.threads
+
+    timer = Timer(memory=args.memory)
+    if args.memory:
+        tracemalloc.start()
+    with timer.phase("write"):
+        state.write(path, files)
+    with open(path, "rb") as file:
+        data = file.read()
+    with timer.phase("decode serial"):
+        serial = json.loads(lzma.decompress(data))
+    with timer.phase("decode parallel"):
+        parallel = state.decode(data)
+    del serial[:], parallel[:]
+
+    ppath = path.replace(".json.xz", ".packed.xz")
+    with timer.phase("packed write"):
+        packed.write_xz(ppath, files)
+    with timer.phase("packed load (mmap)"):
+        packed.decompress(ppath, ppath[:-3])
+        packedfiles = packed.PackedFiles(ppath[:-3])
+    with timer.phase("packed paths (lazy)"):
+        paths = [file["Path"] for file in packedfiles.lazy()]
+    if args.memory:
+        tracemalloc.stop()
+
+    assert state.decode(data) == files, "Decoded lists disagree"
+    assert paths == sorted(file["Path"] for file in files)
+    nstreams = len(state.xz_streams(data))
+    timer.report(
+        f"{nfiles:d} files. {len(data)} bytes in {nstreams} streams. "
+        f"{state.DECODE_THREADS} threads"
+    )
+    return timer.results
+
+
+BENCHMARKS = {"plan": bench_plan, "rfc3339": bench_rfc3339, "state": bench_state}
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="syncrclone benchmarks")
+
+    parser.add_argument("benchmark", choices=list(BENCHMARKS))
+    parser.add_argument(
+        "--files",
+        nargs="+",
+        type=int,
+        default=[1000, 10000, 100000],
+        metavar="N",
+        help="Number of (synced) files. Can specify multiple. Default %(default)s",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--no-memory",
+        action="store_false",
+        dest="memory",
+        help="Do not trace memory. Tracing adds overhead to the timings",
+    )
+    parser.add_argument("--json", metavar="FILE", help="Also save results to FILE")
+
+    group = parser.add_argument_group("plan", "Options for the 'plan' benchmark")
+    for change, default in [
+        ("new", 0.01),
+        ("modified", 0.01),
+        ("deleted", 0.01),
+        ("moved", 0.01),
+        ("conflicts", 0.001),
+    ]:
+        group.add_argument(
+            f"--{change}",
+            type=float,
+            default=default,
+            metavar="RATE",
+            help=f"Fraction of files that are {change}. Default %(default)s",
+        )
+    group.add_argument("--no-hash", action="store_true", help="No hashes in lists")
+    group.add_argument("--no-mtime", action="store_true", help="No mtimes in lists")
+    group.add_argument(
+        "--compare", choices=("size", "mtime", "hash"), default="mtime"
+    )
+    group.add_argument(
+        "--renames",
+        choices=("size", "mtime", "hash", "None"),
+        default="mtime",
+        help="renames(A/B) setting. Default %(default)s",
+    )
+    group.add_argument("--conflict-mode", default="newer")
+    group.add_argument(
+        "--store",
+        choices=("memory", "sqlite"),
+        default="memory",
+        help="filelist_store setting. Default %(default)s",
+    )
+
+    group = parser.add_argument_group("state", "Options for the 'state' benchmark")
+    group.add_argument(
+        "--threads",
+        type=int,
+        metavar="N",
+        help="Threads to decode with. Default state.DECODE_THREADS",
+    )
+
+    args = parser.parse_args(argv)
+    args.renames = None if args.renames == "None" else args.renames
+    if args.no_mtime and "mtime" in (args.compare, args.renames):
+        parser.error("Cannot compare or track renames with mtime if --no-mtime")
+    if args.no_hash and "hash" in (args.compare, args.renames):
+        parser.error("Cannot compare or track renames with hash if --no-hash")
+
+    results = {}
+    for nfiles in args.files:
+        results[nfiles] = BENCHMARKS[args.benchmark](nfiles, args)
+
+    if args.json:
+        with open(args.json, "wt") as fout:
+            json.dump({"args": vars(args), "results": results}, fout, indent=1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmarks!
+
+Build (large) local trees with the testutils machinery and run full syncs with
+cli.cli on local, alias, and crypt remotes (see rclone.cfg) so that changes to
+the rclone-call layer can be measured without any cloud accounts. Run with
+
+    $ python benchmark_e2e.py --files 1000 10000 --remotes local crypt
+
+The reported times are *only* of the syncrclone call and not the extra rclone
+calls the Tester uses to push and pull non-local remotes.
+"""
+import os, sys
+import argparse
+import contextlib
+import io
+import json
+import random
+import time
+
+import testutils
+
+import syncrclone.cli
+from syncrclone import set_debug
+
+syncrclone.cli._RETURN = True
+
+PWD0 = os.path.abspath(os.path.dirname(__file__))
+
+REMOTES = {  # name: (remoteA, remoteB)
+    "local": ("A", "B"),
+    "alias": ("aliasA1:", "B"),
+    "crypt": ("cryptA:", "cryptB:"),
+}
+
+
+def build_tree(test, nfiles, seed=1):
+    """Write nfiles to A/ in the past"""
+    rand = random.Random(seed)
+    for ix in range(nfiles):
+        path = f"A/dir{ix % 100:02d}/sub{ix % 10}/file{ix}.txt"
+        test.write(path, f"{ix} {rand.random()}", dt=-5 * (1 + rand.random()))
+
+
+def small_change(test, nfiles, rate=0.01, seed=2):
+    """Modify, add, and delete rate*nfiles files. Spread on A and B"""
+    rand = random.Random(seed)
+    count = max(int(rate * nfiles), 1)
+    ixs = rand.sample(range(nfiles), min(2 * count, nfiles))
+    for ix in ixs[:count]:
+        path = f"dir{ix % 100:02d}/sub{ix % 10}/file{ix}.txt"
+        test.write_post(f"{rand.choice('AB')}/{path}", f"mod {rand.random()}")
+    for ix in ixs[count:]:
+        path = f"dir{ix % 100:02d}/sub{ix % 10}/file{ix}.txt"
+        os.remove(f"A/{path}")
+    for ix in range(nfiles, nfiles + count):
+        test.write_post(f"{rand.choice('AB')}/new/file{ix}.txt", f"new {ix}")
+
+
+def mass_rename(test):
+    """Rename every top-level directory on A"""
+    for name in sorted(os.listdir("A")):
+        if name.startswith("dir"):
+            test.move(f"A/{name}", f"A/renamed_{name}")
+
+
+def sync_stats(sync):
+    """Run sync (test.setup or test.sync) and return the stats"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.time()
+        syncobj = sync()
+        dt = time.time() - t0
+    return {
+        "total": sum(syncobj.timings.values()),
+        "total_with_tester": dt,
+        "rclone_calls": syncobj.rclone.rclonecalls,
+        "rclone_time": syncobj.rclone.rclonetime,
+        "phases": syncobj.timings,
+    }
+
+
+def bench_remote(name, nfiles, args):
+    remoteA, remoteB = REMOTES[name]
+    test = testutils.Tester(f"bench_{name}", remoteA, remoteB)
+
+    test.config.renamesA = test.config.renamesB = "mtime"
+    test.config.action_threads = args.action_threads
+    for item in args.override:
+        key, val = (i.strip() for i in item.split("=", 1))
+        setattr(test.config, key, eval(val))
+    test.write_config()
+
+    build_tree(test, nfiles)
+
+    results = {}
+    results["initial"] = sync_stats(test.setup)
+    results["no-change"] = sync_stats(test.sync)
+
+    small_change(test, nfiles)
+    results["small-change"] = sync_stats(test.sync)
+
+    mass_rename(test)
+    results["mass-rename"] = sync_stats(test.sync)
+
+    assert test.compare_tree() == set(), "Trees do not agree!"
+    test.done()
+    os.chdir(PWD0)
+    return results
+
+
+def report(name, nfiles, results):
+    print(f"{name}: {nfiles} files")
+    phases = []
+    for res in results.values():
+        phases.extend(p for p in res["phases"] if p not in phases)
+    print(
+        f"    {'scenario':<14s} {'total':>8s} {'calls':>6s} {'rclone':>8s} "
+        + " ".join(f"{p[:9]:>9s}" for p in phases)
+    )
+    for scenario, res in results.items():
+        print(
+            f"    {scenario:<14s} {res['total']:8.2f} {res['rclone_calls']:6d} "
+            f"{res['rclone_time']:8.2f} "
+            + " ".join(f"{res['phases'].get(p, 0):9.3f}" for p in phases)
+        )
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="syncrclone end-to-end benchmarks")
+    parser.add_argument(
+        "--files",
+        nargs="+",
+        type=int,
+        default=[1000],
+        metavar="N",
+        help="Number of files in the tree. Can specify multiple. Default %(default)s",
+    )
+    parser.add_argument(
+        "--remotes",
+        nargs="+",
+        choices=list(REMOTES),
+        default=list(REMOTES),
+        help="Remote pairs to test. Default %(default)s",
+    )
+    parser.add_argument("--action-threads", type=int, default=1)
+    parser.add_argument(
+        "--override",
+        action="append",
+        default=list(),
+        metavar="'OPTION = VALUE'",
+        help="Set any config option. Can specify multiple times",
+    )
+    parser.add_argument("--json", metavar="FILE", help="Also save results to FILE")
+
+    args = parser.parse_args(argv)
+    set_debug(False)
+
+    allresults = {}
+    for name in args.remotes:
+        for nfiles in args.files:
+            results = bench_remote(name, nfiles, args)
+            report(name, nfiles, results)
+            allresults[f"{name}_{nfiles}"] = results
+
+    if args.json:
+        with open(os.path.join(PWD0, args.json), "wt") as fout:
+            json.dump({"args": vars(args), "results": allresults}, fout, indent=1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -507,6 +507,102 @@ def test_reuse_hash():
     os.chdir(PWD0)
 
 
+def test_hash_threads():
+    """Fetch hashes in concurrent batches and make sure they all land"""
+    import syncrclone.rclone
+
+    set_debug(False)
+    test = testutils.Tester("hashthreads", "A", "B")
+
+    test.config.reuse_hashesA = True
+    test.config.compare = "hash"
+    test.config.hash_threads = 3
+    test.write_config()
+
+    for ii in range(10):
+        test.write_pre(f"A/file{ii}.txt", f"file {ii}")
+
+    batch_min0 = syncrclone.rclone.HASH_BATCH_MIN
+    syncrclone.rclone.HASH_BATCH_MIN = 1
+    try:
+        syncobj = test.setup(flags=["--debug"])
+    finally:
+        syncrclone.rclone.HASH_BATCH_MIN = batch_min0
+    stdout = "".join(test.synclogs[-1])
+
+    assert "A: Fetching hashes in 3 batch(es)" in stdout
+    assert "A: Updated hash on 10 files" in stdout
+    assert all(file.get("Hashes") for file in syncobj.currA0)
+    assert test.compare_tree() == set()
+
+    os.chdir(PWD0)
+
+
+def test_hash_cache():
+    """Test the hash cache directly including surviving renames"""
+    from syncrclone import hashcache
+
+    tmpdir = os.path.join(PWD0, "testdirs", "hash_cache")
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    dbpath = os.path.join(tmpdir, "db", "hashes.sqlite")  # Will make "db"
+    cache = hashcache.HashCache(dbpath)
+
+    paths = [os.path.join(tmpdir, f"file{ii}") for ii in range(3)]
+    for ii, path in enumerate(paths):
+        with open(path, "wt") as fp:
+            fp.write(f"file {ii}")
+    keys = {path: hashcache.statkey(path) for path in paths}
+    keys["missing"] = hashcache.statkey(os.path.join(tmpdir, "missing"))
+    assert keys["missing"] is None
+
+    assert cache.get(keys) == {}
+    cache.set([(keys[paths[0]], {"md5": "0"}), (keys[paths[1]], {})])
+    assert cache.get(keys) == {paths[0]: {"md5": "0"}}  # Empty not cached
+    cache.close()
+
+    # Rename survives
+    os.rename(paths[0], paths[0] + ".moved")
+    cache = hashcache.HashCache(dbpath)
+    key = hashcache.statkey(paths[0] + ".moved")
+    assert cache.get({"moved": key}) == {"moved": {"md5": "0"}}
+
+    # Modified does not
+    with open(paths[0] + ".moved", "at") as fp:
+        fp.write("more")
+    os.utime(paths[0] + ".moved", ns=(0, key[-1] + 10))
+    key = hashcache.statkey(paths[0] + ".moved")
+    assert cache.get({"moved": key}) == {}
+    cache.close()
+
+
+def test_hash_cache_sync():
+    """Hashes come from the cache after renames and a reset state"""
+    set_debug(False)
+    test = testutils.Tester("hashcache_sync", "A", "B")
+
+    test.config.compare = "hash"
+    test.config.renamesA = "hash"
+    test.config.hash_cache = "hashes.sqlite"  # relative to config
+    test.write_config()
+
+    for ii in range(5):
+        test.write_pre(f"A/file{ii}.txt", f"file {ii}")
+    test.setup()
+    stdout = "".join(test.synclogs[-1])
+    assert "A: Got 0 hashes from the local hash cache" in stdout
+
+    test.move("A/file0.txt", "A/moved0.txt")
+    test.sync(["--reset-state"])
+    stdout = "".join(test.synclogs[-1])
+    assert "A: Got 5 hashes from the local hash cache" in stdout
+    assert "B: Got 5 hashes from the local hash cache" in stdout
+    assert test.compare_tree() == set()
+
+    os.chdir(PWD0)
+
+
 def test_no_hashes():
     remoteA = "A"
     remoteB = "cryptB:"  # Crypt does not have hashes
@@ -1597,6 +1693,94 @@ def test_hash_compare_sync():
     assert diffs == set()
 
 
+def test_lazy_hashes():
+    """
+    Lazy hashes should give the same result as test_hash_compare_sync but only
+    hash what is needed
+    """
+    test = testutils.Tester("lazyhash", "A", "B")
+
+    test.config.renamesA = "hash"
+    test.config.compare = "hash"
+    test.config.conflict_mode = "A"
+    test.config.lazy_hashesA = test.config.lazy_hashesB = True
+
+    test.write_config()
+
+    test.write_pre("A/main.txt", "1234")
+    test.write_pre("A/size.txt", "ABCD")
+    test.write_pre("A/mtime.txt", "XYZ")
+    test.write_pre("A/mtime_mod.txt", "XYZW")
+    test.write_pre("A/move.txt", "aaa")
+
+    for fn in ["main.txt", "size.txt", "mtime.txt", "mtime_mod.txt"]:
+        stat = os.stat(f"A/{fn}")
+        os.utime(f"A/{fn}", (int(stat.st_atime), int(stat.st_mtime)))
+
+    test.setup()  # On both sides with no state. All are needed
+    stdout = "".join(test.synclogs[-1])
+    assert "Lazy hashes on A: 5 of 5 unhashed files are needed" in stdout
+    assert "Lazy hashes on B: 5 of 5 unhashed files are needed" in stdout
+
+    test.write_post("A/onlyA.txt", "only on A")
+    test.sync()  # Only on A. No hash needed
+    stdout = "".join(test.synclogs[-1])
+    assert "Lazy hashes on A: 0 of 1 unhashed files are needed" in stdout
+    assert "Lazy hashes on B: 0 of 0 unhashed files are needed" in stdout
+
+    # Note that (like reuse_hashes), changes that keep the size and mtime will
+    # not be detected
+    test.write_post("B/size.txt", "ABCDE")
+    test.write_post("B/mtime.txt", "XYZ")
+    test.write_post("B/mtime_mod.txt", "xyzw")
+    test.write_post("B/new.txt", "=/*")
+
+    test.move("A/move.txt", "A/moved.txt")
+
+    test.sync(["--debug"])
+    stdout = "".join(test.synclogs[-1])
+    assert test.compare_tree() == set()
+    # moved.txt and the now common (but never hashed) onlyA.txt
+    assert "Lazy hashes on A: 2 of 2 unhashed files are needed" in stdout
+    assert "Lazy hashes on B: 3 of 5 unhashed files are needed" in stdout
+    assert "Move found: on B: 'move.txt' --> 'moved.txt'" in stdout
+    assert test.read("A/mtime_mod.txt") == "xyzw"
+
+    os.chdir(PWD0)
+
+
+def test_lazy_hashes_compare():
+    """
+    compare() with lazy hashes: only the lazy side may skip hashing and files
+    listed without mtime fall back to size
+    """
+    from benchmark import planning_config
+
+    sync = syncrclone.main.SyncRClone.__new__(syncrclone.main.SyncRClone)
+    sync.config = planning_config(compare="hash", lazy_hashesA=True)
+    os.chdir(PWD0)
+
+    hashed = {"Path": "f", "Size": 3, "mtime": None, "Hashes": {"md5": "abc"}}
+    unhashed = {"Path": "f", "Size": 3, "mtime": None}
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        assert sync.compare(unhashed, hashed)  # No mtime so size
+        assert not sync.compare(unhashed, hashed | {"Size": 4})
+        assert sync.compare(unhashed, unhashed, sides="AA")
+        assert sync.compare(unhashed | {"mtime": 1.0}, hashed | {"mtime": 1.5})
+        assert not sync.compare(unhashed | {"mtime": 1.0}, hashed | {"mtime": 9.0})
+
+        # B is not lazy so missing hashes are an error (or use the fallback)
+        sync.config.hash_fail_fallback = None
+        with pytest.raises(ValueError):
+            sync.compare(hashed, unhashed)
+        with pytest.raises(ValueError):
+            sync.compare(unhashed, unhashed, sides="BB")
+        sync.config.hash_fail_fallback = "size"
+        assert sync.compare(hashed, unhashed)
+
+
 def test_directory_moves():
     """
     This tests when directories are moved around. syncrclone does NOT move directories,
@@ -1677,6 +1861,1239 @@ def test_directory_moves():
     os.chdir(PWD0)
 
 
+@pytest.mark.parametrize("reset", [False, True])
+def test_state_delta(reset):
+    """
+    Test the delta state format including compaction and switching back to a
+    single file. Also, with reset, make sure old deltas are not applied to a new
+    base even if it is identical.
+    """
+    remoteA = "A"
+    remoteB = "B"
+    set_debug(False)
+
+    test = testutils.Tester("state_delta", remoteA, remoteB)
+    test.config.state_format = "delta"
+    test.config.state_deltas_max = 2
+    test.write_config()
+
+    for ii in range(10):
+        test.write_pre(f"A/file{ii}.txt", f"file {ii}")
+
+    test.setup()
+
+    def statefiles(AB):
+        wd = test.wdA if AB == "A" else test.wdB
+        return sorted(f for f in os.listdir(wd) if f.startswith(f"{AB}-main_fl"))
+
+    assert statefiles("A") == ["A-main_fl.json.xz"]
+
+    # No changes. Nothing uploaded
+    test.sync()
+    assert statefiles("A") == ["A-main_fl.json.xz"]
+
+    test.write_post("A/new1.txt", "new1")
+    test.sync()
+    assert statefiles("A") == [
+        "A-main_fl.delta.000001.json.xz",
+        "A-main_fl.json.xz",
+    ]
+    assert statefiles("B") == [
+        "B-main_fl.delta.000001.json.xz",
+        "B-main_fl.json.xz",
+    ]
+
+    if reset:
+        test.sync(["--reset-state"])  # Same list but must remove deltas
+        assert statefiles("A") == ["A-main_fl.json.xz"]
+        test.write_post("A/new1.txt", "new1 again")
+        test.sync()
+        assert test.compare_tree() == set()
+        assert test.read("B/new1.txt") == "new1 again"
+        os.chdir(PWD0)
+        return
+
+    # A delete will only happen if the delta was read correctly
+    os.remove("A/new1.txt")
+    test.write_post("B/file2.txt", "mod2")
+    test.sync()
+    assert test.compare_tree() == set()
+    assert not exists("B/new1.txt")
+    assert test.read("A/file2.txt") == "mod2"
+    assert len(statefiles("A")) == 3
+
+    test.write_post("B/new2.txt", "new2")
+    test.sync()  # Compacts
+    assert statefiles("A") == ["A-main_fl.json.xz"]
+    assert statefiles("B") == ["B-main_fl.json.xz"]
+
+    test.write_post("A/new3.txt", "new3")
+    test.sync()  # One delta
+    assert len(statefiles("B")) == 2
+
+    with lzma.open(os.path.join(test.wdB, "B-main_fl.json.xz")) as fp:
+        assert "new3.txt" not in {f["Path"] for f in json.load(fp)}
+
+    os.remove("B/new3.txt")
+    test.sync(["--override", "state_format = 'single'"])
+    assert statefiles("A") == ["A-main_fl.json.xz"]
+    assert statefiles("B") == ["B-main_fl.json.xz"]
+    assert not exists("A/new3.txt")
+    with lzma.open(os.path.join(test.wdB, "B-main_fl.json.xz")) as fp:
+        assert "new3.txt" not in {f["Path"] for f in json.load(fp)}
+
+    assert test.compare_tree() == set()
+    os.chdir(PWD0)
+
+
+def test_state_sharded():
+    """
+    Test the sharded state format. Only changed shards should be written and
+    switching formats must remove the other's files
+    """
+    set_debug(False)
+
+    test = testutils.Tester("state_sharded", "A", "B")
+    test.config.state_format = "sharded"
+    test.write_config()
+
+    for ii in range(10):
+        test.write_pre(f"A/dir{ii % 3}/file{ii}.txt", f"file {ii}")
+    test.write_pre("A/top.txt", "top")
+
+    test.setup()
+
+    def statefiles(AB):
+        wd = test.wdA if AB == "A" else test.wdB
+        files = sorted(f for f in os.listdir(wd) if f.startswith(f"{AB}-main_fl"))
+        return {f: os.path.getmtime(os.path.join(wd, f)) for f in files}
+
+    files0 = statefiles("A")
+    assert len(files0) == 5  # Manifest, top, and the three dirs
+    assert "A-main_fl.manifest.json.xz" in files0
+
+    time.sleep(1.1)  # mtime resolution
+    test.write_post("A/dir1/new.txt", "new")
+    test.sync()
+    assert test.compare_tree() == set()
+
+    files1 = statefiles("A")
+    assert set(files1) == set(files0)
+    changed = {f for f in files1 if files1[f] != files0[f]}
+    assert changed == {
+        "A-main_fl.manifest.json.xz",
+        syncrclone.state.shard_name("A", "main", "dir1"),
+    }
+
+    # Deleting needs the state to be read correctly. dir2 is then empty
+    for ii in [2, 5, 8]:
+        os.remove(f"B/dir2/file{ii}.txt")
+    test.sync()
+    assert test.compare_tree() == set()
+    assert not exists("A/dir2/file2.txt")
+    assert len(statefiles("A")) == 4
+
+    test.sync(["--override", "state_format = 'single'"])
+    assert list(statefiles("A")) == ["A-main_fl.json.xz"]
+
+    test.sync()  # Back to sharded. Removes the base
+    assert len(statefiles("B")) == 4
+    assert "B-main_fl.json.xz" not in statefiles("B")
+
+    os.remove("A/top.txt")
+    test.sync()
+    assert not exists("B/top.txt")
+
+    os.chdir(PWD0)
+
+
+def test_state_read():
+    """Test reading state deltas directly including stale and out-of-order"""
+    from syncrclone import state
+
+    tmpdir = os.path.join(PWD0, "testdirs", "state_read")
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    files0 = [{"Path": f"file{ii}", "Size": ii, "mtime": ii + 0.5} for ii in range(5)]
+    md5 = state.write(os.path.join(tmpdir, state.base_name("A", "n")), files0)
+
+    files1 = [f.copy() for f in files0[1:]] + [{"Path": "new", "Size": 1, "mtime": 1}]
+    files1[0]["Size"] = 100  # modified
+    delta = state.make_delta(files0, files1)
+    assert delta["remove"] == ["file0"]
+    assert [f["Path"] for f in delta["add"]] == ["file1", "new"]
+
+    delta = {"base": md5, "seq": 1, **delta}
+    state.write(os.path.join(tmpdir, state.delta_name("A", "n", 1)), delta)
+
+    files, info = state.read_state(tmpdir, "A", "n")
+    assert sorted(files, key=str) == sorted(files1, key=str)
+    assert info["base"] == md5 and info["deltas"] == 1 and not info["stale"]
+    assert info["delta_entries"] == 3
+
+    # Wrong base and a gap. Neither should be applied
+    bad = {"base": "wrong", "seq": 2, "add": [], "remove": ["file2"]}
+    state.write(os.path.join(tmpdir, state.delta_name("A", "n", 2)), bad)
+    bad = {"base": md5, "seq": 4, "add": [], "remove": ["file3"]}
+    state.write(os.path.join(tmpdir, state.delta_name("A", "n", 4)), bad)
+
+    files, info = state.read_state(tmpdir, "A", "n")
+    assert sorted(files, key=str) == sorted(files1, key=str)
+    assert info["deltas"] == 1 and info["stale"]
+
+    files, info = state.read_state(tmpdir, "B", "n")
+    assert files is None and not info["base"]
+
+    assert state.glob_escape("a*b[c]{d}?") == r"a\*b\[c\]\{d\}\?"
+
+
+def test_state_shards():
+    """Test reading and writing sharded state directly"""
+    from syncrclone import state
+
+    tmpdir = os.path.join(PWD0, "testdirs", "state_shards")
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    files = [{"Path": f"d{ii % 3}/f{ii}", "Size": ii, "mtime": ii} for ii in range(9)]
+    files.append({"Path": "top.txt", "Size": 1, "mtime": 1})
+
+    shards = state.split_shards(files, "top")
+    assert sorted(shards) == ["", "d0", "d1", "d2"]
+    assert [f["Path"] for f in shards["d1"]] == ["d1/f1", "d1/f4", "d1/f7"]
+    assert set(state.split_shards(files, 4)) <= {"0", "1", "2", "3"}
+
+    # The digest is of the entries, not their key order
+    assert state.digest(shards["d0"]) == state.digest(
+        [dict(reversed(f.items())) for f in shards["d0"]]
+    )
+
+    manifest = state.new_manifest("top")
+    for sid, entries in shards.items():
+        fname = state.shard_name("A", "n", sid)
+        md5 = state.write(os.path.join(tmpdir, fname), entries)
+        manifest["shards"][sid] = {
+            "file": fname,
+            "md5": md5,
+            "digest": state.digest(entries),
+            "count": len(entries),
+        }
+    state.write(os.path.join(tmpdir, state.manifest_name("A", "n")), manifest)
+
+    read, info = state.read_state(tmpdir, "A", "n")
+    assert sorted(read, key=str) == sorted(files, key=str)
+    assert info["manifest"] == manifest and not info["base"]
+
+    # Kept shards are not read (even if the file is gone)
+    os.remove(os.path.join(tmpdir, manifest["shards"]["d2"]["file"]))
+    kept = {manifest["shards"]["d2"]["md5"]: shards["d2"]}
+    read, info = state.read_state(tmpdir, "A", "n", kept=kept)
+    assert sorted(read, key=str) == sorted(files, key=str)
+
+    read, info = state.read_state(tmpdir, "A", "n")
+    assert read is None and info["files"]
+
+    # A base is preferred unless sharded
+    state.write(os.path.join(tmpdir, state.base_name("A", "n")), files[:2])
+    read, info = state.read_state(tmpdir, "A", "n")
+    assert len(read) == 2 and info["manifest"] is None
+    read, info = state.read_state(tmpdir, "A", "n", prefer="sharded", kept=kept)
+    assert len(read) == len(files)
+
+
+def test_state_streams():
+    """Lists are written in xz streams that can be found and decoded in parallel"""
+    from syncrclone import state
+
+    tmpdir = os.path.join(PWD0, "testdirs", "state_streams")
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+    path = os.path.join(tmpdir, "state.json.xz")
+
+    block0 = state.BLOCK_ENTRIES
+    state.BLOCK_ENTRIES = 7
+    try:
+        for nfiles in [0, 1, 7, 8, 50]:
+            files = [{"Path": f"dir/fïle{ii}", "Size": ii} for ii in range(nfiles)]
+            state.write(path, files)
+            with open(path, "rb") as fp:
+                data = fp.read()
+            assert json.loads(lzma.decompress(data)) == files  # Still one .json.xz
+            assert len(state.xz_streams(data)) == max((nfiles + 6) // 7, 1)
+            assert state.decode(data, threads=4) == files
+    finally:
+        state.BLOCK_ENTRIES = block0
+
+    # Streams that are not split between entries are still read
+    text = json.dumps([{"a": 1}, {"b": 2}]).encode()
+    data = lzma.compress(text[:5]) + lzma.compress(text[5:])
+    assert len(state.xz_streams(data)) == 2
+    assert state.decode(data, threads=4) == [{"a": 1}, {"b": 2}]
+
+    assert state.xz_streams(b"not xz") is None
+
+
+def test_clean_listing():
+    """The listing is cleaned up the same in a worker process"""
+    from syncrclone import rclone
+
+    listing = [
+        {
+            "Path": f"dir/file{ii}",
+            "Name": f"file{ii}",
+            "Size": ii,
+            "ModTime": f"2023-01-0{ii + 1}T12:00:00Z",
+            "IsDir": False,
+            "Tier": "STANDARD",
+        }
+        for ii in range(5)
+    ]
+    data = json.dumps(listing).encode()
+
+    files = rclone.clean_listing(data)
+    assert files[0] == {"Path": "dir/file0", "Size": 0, "mtime": 1672574400.0}
+    packed = rclone.list_pool().submit(rclone.clean_listing_packed, data).result()
+    assert rclone.unpack_files(packed) == files
+
+    # Round trip including the files that do not fit the columns
+    files = [
+        {"Path": "a", "Size": 1, "mtime": 1.5, "Hashes": {"md5": "x"}},
+        {"Path": "b", "Size": -1, "mtime": None},
+        {"Path": "c", "Size": 2},
+        {"Path": "d", "Size": 3, "mtime": 17},
+        {"Path": "e\0", "Size": 4, "mtime": 2.5},
+        {"Path": "f", "mtime": 3.5},
+    ]
+    copies = [json.loads(json.dumps(file)) for file in files]
+    assert rclone.unpack_files(rclone.pack_files(copies)) == files
+    assert rclone.unpack_files(rclone.pack_files([])) == []
+
+
+def test_packed():
+    """Packed lists round trip and only decode what is asked for"""
+    from syncrclone import packed, state
+
+    tmpdir = os.path.join(PWD0, "testdirs", "packed")
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    files = [
+        {"Path": "dir/fïle", "Size": 3, "mtime": 1.5, "Hashes": {"md5": "abc"}},
+        {"Path": "a.txt", "Size": -1, "mtime": None},
+        {"Path": "b.txt", "Size": 0, "mtime": 17},
+        {"Path": "c.txt"},
+    ]
+    packed.write_xz(os.path.join(tmpdir, state.packed_name("A", "n")), files)
+
+    read, info = state.read_state(tmpdir, "A", "n")
+    assert isinstance(read, packed.PackedFiles) and read.sorted
+    assert len(read) == 4
+    assert list(read) == sorted(files, key=lambda f: f["Path"])
+    assert read.get("b.txt") == {"Path": "b.txt", "Size": 0, "mtime": 17}
+    assert read.get("missing") is None
+
+    lazy = list(read.lazy())
+    assert [f["Path"] for f in lazy] == ["a.txt", "b.txt", "c.txt", "dir/fïle"]
+    assert all(f._file is None for f in lazy)  # Only the paths so far
+    assert lazy[3]["Hashes"] == {"md5": "abc"} and dict(lazy[3]) == files[0]
+    assert lazy[3] == files[0]
+
+    # The base is preferred unless packed
+    state.write(os.path.join(tmpdir, state.base_name("A", "n")), files[:2])
+    read, info = state.read_state(tmpdir, "A", "n")
+    assert isinstance(read, list) and len(read) == 2
+    read, info = state.read_state(tmpdir, "A", "n", prefer="packed")
+    assert len(read) == 4
+
+    # Queried by Path like a DictTable
+    assert read[{"Path": "b.txt"}] == {"Path": "b.txt", "Size": 0, "mtime": 17}
+    assert read[{"Path": "b.txt", "Size": 0, "mtime": 17}]["Path"] == "b.txt"
+    assert read[{"Path": "b.txt", "Size": 1}] is None
+    assert {"Path": "c.txt"} in read and {"Path": "missing"} not in read
+    with pytest.raises(ValueError):
+        read[{"Size": 0}]
+
+
+def test_packed_planning():
+    """The in-memory planner gives the same plan with packed previous lists"""
+    from benchmark import planning_config, synthetic_lists
+    from syncrclone import packed
+
+    tmpdir = os.path.join(PWD0, "testdirs", "packed_planning")
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    currA, currB, prevA, prevB = synthetic_lists(500, moved=0.05, seed=1)
+    config = planning_config(compare="mtime", renamesA="mtime", renamesB="mtime")
+    os.chdir(PWD0)
+
+    attribs = ["Path", "Size", "mtime"]
+    plans = []
+    for use_packed in [False, True]:
+        sync = syncrclone.main.SyncRClone.__new__(syncrclone.main.SyncRClone)
+        sync.config = config
+        sync.now = sync.now_compact = config.now
+        for AB, curr, prev in [("A", currA, prevA), ("B", currB, prevB)]:
+            curr = DictTable([f.copy() for f in curr], fixed_attributes=attribs)
+            setattr(sync, f"curr{AB}", curr)
+            if use_packed:
+                path = os.path.join(tmpdir, f"prev{AB}.packed.xz")
+                packed.write_xz(path, prev)
+                packed.decompress(path, path[:-3])
+                prev = packed.PackedFiles(path[:-3])
+            else:
+                prev = DictTable([f.copy() for f in prev], fixed_attributes=attribs)
+            setattr(sync, f"prev{AB}", prev)
+        sync.currA0, sync.currB0 = sync.currA.copy(), sync.currB.copy()
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            sync.remove_common_files()
+            sync.process_non_common()
+            sync.track_moves("A")
+            sync.track_moves("B")
+        assert isinstance(sync.prevA, DictTable)  # Only what is not common
+        attrs = ["newA", "newB", "delA", "delB", "transA2B", "transB2A"]
+        plans.append({attr: sorted(getattr(sync, attr)) for attr in attrs})
+        plans[-1].update(movesA=sorted(sync.movesA), movesB=sorted(sync.movesB))
+    assert plans[0] == plans[1]
+    assert plans[0]["movesA"] or plans[0]["movesB"]
+
+
+def test_join_all():
+    """Errors in threads are raised on join but only after all are done"""
+    done = []
+
+    def work(AB, fail=False):
+        time.sleep(0.05 if AB == "B" else 0)
+        done.append(AB)
+        if fail:
+            raise ValueError(AB)
+        return AB.lower()
+
+    ReturnThread = syncrclone.utils.ReturnThread
+    threads = {AB: ReturnThread(target=work, args=(AB,)).start() for AB in "AB"}
+    assert syncrclone.utils.join_all(threads) == {"A": "a", "B": "b"}
+
+    done.clear()
+    threads = {
+        AB: ReturnThread(target=work, args=(AB,), kwargs={"fail": True}).start()
+        for AB in "AB"
+    }
+    with pytest.raises(ValueError, match="A"):
+        syncrclone.utils.join_all(threads, what="test")
+    assert sorted(done) == ["A", "B"]
+
+
+@pytest.mark.parametrize("state_format", ["single", "delta", "packed"])
+def test_out_of_core(state_format):
+    """
+    Out-of-core planning with tiny runs so that everything spills. Also leaves
+    files in common directories so that empty dir cleanup must check the
+    spilled common files.
+    """
+    import syncrclone.outofcore
+
+    set_debug(False)
+    test = testutils.Tester("out_of_core", "A", "B")
+    test.config.out_of_core = True
+    test.config.state_format = state_format
+    test.config.renamesA = test.config.renamesB = "mtime"
+    test.write_config()
+
+    for ii in range(20):
+        test.write_pre(f"A/dir{ii % 3}/file{ii}.txt", f"file {ii}")
+    test.write_pre("A/gone/gone.txt", "gone")
+
+    run_size0 = syncrclone.outofcore.RUN_SIZE
+    syncrclone.outofcore.RUN_SIZE = 3
+    try:
+        test.setup()
+
+        test.write_post("A/dir0/file0.txt", "mod on A")
+        test.write_post("B/dir1/file1.txt", "mod on B")
+        test.write_post("B/new/new.txt", "new")
+        os.remove("A/dir2/file2.txt")
+        os.remove("B/gone/gone.txt")
+        test.move("A/dir0/file3.txt", "A/moved/file3.txt")
+
+        test.sync()
+        stdout = "".join(test.synclogs[-1])
+        assert test.compare_tree() == set()
+        assert "Move 'dir0/file3.txt' --> 'moved/file3.txt'" in stdout
+
+        assert not exists("A/gone")
+        assert exists("B/dir0") and exists("B/dir2")  # Still have common files
+
+        # And once more to make sure the state was written correctly
+        test.write_post("B/dir0/file0.txt", "mod on B")
+        test.sync()
+        stdout = "".join(test.synclogs[-1])
+        assert test.compare_tree() == set()
+        assert test.read("A/dir0/file0.txt") == "mod on B"
+    finally:
+        syncrclone.outofcore.RUN_SIZE = run_size0
+
+    os.chdir(PWD0)
+
+
+def test_outofcore_tools():
+    """The streaming JSON reader, sorted spills, and the sorted delta"""
+    import io
+    from syncrclone import outofcore, state
+
+    tmpdir = os.path.join(PWD0, "testdirs", "outofcore_tools")
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    files = [
+        {"Path": f"d{ii % 4}/f{ii}", "Size": ii, "mtime": ii / 3} for ii in range(50)
+    ]
+    files.append({"Path": "unicode/\u00e9\u4e2d", "Size": 1, "mtime": None})
+
+    # Like lsjson (one per line) and like the state (one line)
+    lsjson = "[\n" + ",\n".join(json.dumps(f) for f in files) + "\n]\n"
+    for text in [lsjson, json.dumps(files, ensure_ascii=False), "", "[]"]:
+        read = list(outofcore.iter_json_array(io.BytesIO(text.encode()), chunksize=5))
+        assert read == (files if len(text) > 2 else [])
+
+    run_size0 = outofcore.RUN_SIZE
+    outofcore.RUN_SIZE = 7
+    try:
+        sfiles = outofcore.SortedFiles(tmpdir)
+        sfiles.extend(reversed(files))
+        sfiles.finish()
+        assert len(sfiles.runs) == 8
+        assert list(sfiles) == sorted(files, key=lambda f: f["Path"])
+        assert list(sfiles) == list(sfiles)  # re-iterable
+
+        # Writing is the same as json.dump
+        path = os.path.join(tmpdir, "fl.json.xz")
+        state.write(path, sfiles)
+        with lzma.open(path, "rt") as fp:
+            assert fp.read() == json.dumps(list(sfiles), ensure_ascii=False)
+
+        # Sorted delta matches the unsorted one
+        new = [f.copy() for f in files[5:]]
+        new[0]["Size"] = 100
+        new.append({"Path": "new", "Size": 1, "mtime": 1.0})
+        snew = outofcore.SortedFiles(tmpdir)
+        snew.extend(new)
+        snew.finish()
+        delta, sdelta = state.make_delta(files, new), state.make_delta(sfiles, snew)
+        assert delta["remove"] == sdelta["remove"]
+        key = lambda f: f["Path"]
+        assert sorted(delta["add"], key=key) == sorted(sdelta["add"], key=key)
+    finally:
+        outofcore.RUN_SIZE = run_size0
+
+
+@pytest.mark.parametrize("compare", ["mtime", "hash"])
+def test_filelist_store_sqlite(compare):
+    """Sync with the SQLite file-list store. Same as memory but via SQL"""
+    set_debug(False)
+    test = testutils.Tester("filelist_sqlite", "A", "B")
+    test.config.filelist_store = "sqlite"
+    test.config.compare = compare
+    test.config.renamesA = test.config.renamesB = "mtime"
+    test.write_config()
+
+    for ii in range(10):
+        test.write_pre(f"A/dir{ii % 3}/file{ii}.txt", f"file {ii}")
+    test.write_pre("A/gone/gone.txt", "gone")
+    test.setup()
+
+    test.write_post("A/dir0/file0.txt", "mod on A")
+    test.write_post("B/dir1/file1.txt", "mod on B")
+    test.write_post("B/new/new.txt", "new")
+    os.remove("A/dir2/file2.txt")
+    os.remove("B/gone/gone.txt")
+    test.move("A/dir0/file3.txt", "A/moved/file3.txt")
+
+    obj = test.sync()
+    stdout = "".join(test.synclogs[-1])
+    assert test.compare_tree() == set()
+    assert "Move 'dir0/file3.txt' --> 'moved/file3.txt'" in stdout
+    assert not exists("A/gone")
+    assert os.path.exists(obj.listdb.path)
+
+    # The stored state must be right too
+    test.write_post("B/dir0/file0.txt", "mod on B")
+    test.sync()
+    assert test.compare_tree() == set()
+    assert test.read("A/dir0/file0.txt") == "mod on B"
+
+    os.chdir(PWD0)
+
+
+def test_sqlitetable():
+    """SQLiteTable gives the same results as DictTable for what syncrclone uses"""
+    from syncrclone.dicttable import DictTable
+    from syncrclone import sqlitetable
+
+    tmpdir = os.path.join(PWD0, "testdirs", "sqlitetable")
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    files = [
+        {"Path": f"d{ii % 4}/f{ii}", "Size": ii % 5, "mtime": ii / 3}
+        for ii in range(30)
+    ]
+    files.append({"Path": "nomtime", "Size": 1, "mtime": None, "Hashes": {"md5": "x"}})
+
+    db = sqlitetable.FileListDB(os.path.join(tmpdir, "test.sqlite"))
+    dt = DictTable(files, fixed_attributes=["Path", "Size", "mtime"])
+    st = db.table(files)
+
+    key = lambda f: f["Path"]
+    assert len(st) == len(dt)
+    assert list(st) == sorted(dt, key=key)
+    for q in [{"Size": 2}, {"Size": 2, "mtime": 7 / 3}, {"mtime": None}, {"Size": 99}]:
+        assert list(st.query(q)) == list(dt.query(q))
+        assert st[q] == dt[q]
+        assert (q in st) == (q in dt)
+    assert list(st.query({"Hashes": {"md5": "x"}})) == files[-1:]
+
+    cp = st.copy()
+    for table in [st, dt]:
+        file = table.pop({"Path": "d1/f1"})
+        assert file == files[1]
+        with pytest.raises(KeyError):
+            table.pop({"Path": "d1/f1"})
+        with pytest.raises(ValueError):
+            table.pop({"Size": 0})
+        table.remove({"Size": 0})
+        file["Path"] = "moved"
+        table.add(file)
+    assert list(st) == sorted(dt, key=key)
+    assert len(st) == len(dt) == len(files) - 6
+    assert len(cp) == len(files) and {"Path": "d1/f1"} in cp
+
+    file = files[5].copy()
+    file["Hashes"] = {"sha1": "y"}
+    cp.update_files([file])
+    assert cp[{"Path": file["Path"]}] == file
+
+    # common_paths: SQL decided (size, mtime) and fallback (hash and NULL mtime)
+    other = [f.copy() for f in files]
+    other[2]["Size"] = 100
+    other[3]["mtime"] += 10
+    other[4]["mtime"] = None
+    other = db.table(other)
+    base = db.table(files)
+    fallback_calls = []
+
+    def fallback(fileA, fileB):
+        fallback_calls.append(fileA["Path"])
+        return True
+
+    common = sqlitetable.common_paths(base, other, "mtime", 1, fallback)
+    paths = {row[0] for row in db.execute(f"SELECT Path FROM {common}")}
+    assert paths == {f["Path"] for f in files} - {"d2/f2", "d3/f3"}
+    assert sorted(fallback_calls) == ["d0/f4", "nomtime"]
+
+    common = sqlitetable.common_paths(base, other, "size", 1, fallback)
+    other.remove_paths(common)
+    assert [f["Path"] for f in other] == ["d2/f2"]
+
+    # Results are fetched in pages so they are the same with small ones
+    fetch_size, sqlitetable.FETCH_SIZE = sqlitetable.FETCH_SIZE, 4
+    try:
+        assert list(base) == sorted(files, key=key)
+        assert list(base.query({"Size": 2})) == list(dt.query({"Size": 2}))
+        fallback_calls.clear()
+        common = sqlitetable.common_paths(base, base.copy(), "hash", 1, fallback)
+        assert sorted(fallback_calls) == sorted(f["Path"] for f in files)
+        assert db.execute(f"SELECT COUNT(*) FROM {common}").fetchone()[0] == 31
+    finally:
+        sqlitetable.FETCH_SIZE = fetch_size
+
+    db.close()
+
+
+def test_dirindex():
+    """DirIndex empty directories and collapse_dirs"""
+    from syncrclone.utils import DirIndex, collapse_dirs
+
+    old = [
+        "root.txt",
+        "a/b/c/file.txt",
+        "a/b/file.txt",
+        "a/keep/file.txt",
+        "d/e/file.txt",
+        "f/file.txt",
+        "f/g/file.txt",
+    ]
+    index = DirIndex(old)
+    assert index.counts["a"] == 3 and index.counts["a/b"] == 2
+    assert "" not in index.counts
+
+    index.remove("a/b/c/file.txt")
+    index.remove("a/b/file.txt")
+    index.move("d/e/file.txt", "new/file.txt")
+    index.move("f/file.txt", "f/g/h/file.txt")
+    assert index.empty() == {"a/b", "d"}
+
+    # Same as reset and the new list
+    new = ["root.txt", "a/keep/file.txt", "new/file.txt", "f/g/file.txt"]
+    new.append("f/g/h/file.txt")
+    index2 = DirIndex(old)
+    index2.reset()
+    index2.update(new)
+    assert index2.counts == index.counts
+
+    assert collapse_dirs(["a b", "a", "a/c", "a/c/d", "a-b/c", "a", "b"]) == [
+        "a",
+        "a b",
+        "a-b/c",
+        "b",
+    ]
+
+
+def test_rc_daemon():
+    """Renames, conflict tags, and empty directory removal over rclone rcd"""
+    set_debug(False)
+    test = testutils.Tester("rc_daemon", "A", "B")
+    test.config.rc_daemon = True
+    test.config.action_threads = 2
+    test.config.renamesA = "mtime"
+    test.config.conflict_mode = "newer_tag"
+    test.config.cleanup_empty_dirsA = test.config.cleanup_empty_dirsB = True
+    test.write_config()
+
+    test.write_pre("A/keep/keep.txt", "keep")
+    test.write_pre("A/del/sub/del.txt", "del")
+    test.write_pre("A/del2/del2.txt", "del2")
+    test.write_pre("A/rename.txt", "rename")
+    test.write_pre("A/conflict.txt", "conflict")
+    test.setup()
+
+    shutil.rmtree("A/del")
+    shutil.rmtree("A/del2")
+    test.move("A/rename.txt", "A/renamed.txt")
+    test.write_post("A/conflict.txt", "A")
+    test.write_post("B/conflict.txt", "B", add_dt=50)
+
+    obj = test.sync()
+    stdout = "".join(test.synclogs[-1])
+    assert test.compare_tree() == set()
+    assert not exists("B/del") and not exists("B/del2")
+    assert exists("B/keep/keep.txt")
+    assert "rmdirs (if possible) on B: del2" in stdout
+
+    assert "Move 'rename.txt' --> 'renamed.txt'" in stdout
+    assert not exists("B/rename.txt") and test.read("B/renamed.txt") == "rename"
+    assert test.read("A/conflict.txt") == "B"
+    tagged = [f for f in os.listdir("A") if f.startswith("conflict.2")]
+    assert len(tagged) == 1 and test.read(f"A/{tagged[0]}") == "A"
+
+    assert obj.rclone.daemons["A"].calls >= 1
+    assert obj.rclone.daemons["B"].calls >= 3
+    assert obj.rclone.daemons["B"].proc is None  # stopped
+
+    os.chdir(PWD0)
+
+
+def test_aimd_limiter():
+    """Adaptive concurrency grows when fine and halves on congestion"""
+    import threading
+    from syncrclone.utils import AIMDLimiter
+
+    lock = threading.Lock()
+    state = {"active": 0, "max": 0}
+
+    def work(item):
+        with lock:
+            state["active"] += 1
+            state["max"] = max(state["max"], state["active"])
+        time.sleep(0.002)
+        with lock:
+            state["active"] -= 1
+        if item == "fail":
+            raise ValueError(item)
+        return item
+
+    limiter = AIMDLimiter(1, 4, slow_factor=1e9)  # Timing jitter is not congestion
+    assert list(limiter.map(work, range(100))) == list(range(100))
+    assert limiter.limit == 4 and state["max"] <= 4
+
+    # One decrease per round
+    limiter.release(limiter.acquire(), 0, congested=True)
+    assert limiter.limit == 2
+    epoch = limiter.epoch - 1
+    limiter.acquire()
+    limiter.release(epoch, 0, congested=True)  # Started before the decrease
+    assert limiter.limit == 2
+
+    # Slow calls and congested results count. Never goes below lo
+    limiter.slow_factor = 3
+    limiter.release(limiter.acquire(), 100 * limiter.latency)
+    assert limiter.limit == 1
+    res = list(limiter.map(work, ["x"] * 3, congested=lambda res: res == "x"))
+    assert res == ["x"] * 3 and limiter.limit == 1
+
+    with pytest.raises(ValueError):
+        list(AIMDLimiter(1, 2).map(work, ["ok", "fail", "ok"]))
+
+    # rclone output that shows congestion
+    from syncrclone.rclone import CONGESTED_RE
+
+    retry = (
+        "2023/11/17 10:22:33 ERROR : Attempt 1/3 failed with 1 errors and: "
+        "failed to delete file: context deadline exceeded"
+    )
+    assert CONGESTED_RE.search(retry)
+    assert CONGESTED_RE.search("pacer: low level retry 1/10 (error 429)")
+    assert not CONGESTED_RE.search("INFO  : file.txt: Deleted")
+
+
+def test_progress_reader():
+    """ProgressReader counts lines and logs progress"""
+    import io
+    from syncrclone.rclone import ProgressReader
+
+    text = b"[\n" + b",\n".join(b'{"Path": "f%d"}' % ii for ii in range(100)) + b"\n]\n"
+    reader = ProgressReader(io.BufferedReader(io.BytesIO(text)), "Reading", -1)
+    assert b"".join(iter(lambda: reader.read(7), b"")) == text
+    assert reader.lines == 102
+    assert "Reading: File count 101" in syncrclone.log.hist[-1][1]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_multi(jobs):
+    """Run several pairs (one failing) with --multi"""
+    import syncrclone.multi
+
+    set_debug(False)
+    tests = []
+    for ii in range(3):
+        test = testutils.Tester(f"multi{ii}", "A", "B")
+        test.write_config()
+        test.write_pre(f"A/file{ii}.txt", f"file {ii}")
+        test.setup()
+        test.write_post(f"A/new{ii}.txt", f"new {ii}")
+        tests.append(test)
+
+    os.chdir(PWD0)
+    with open(tests[2].config._configpath, "at") as file:
+        file.write("\ncompare = 'bad'\n")  # Fails validation
+
+    paths = [test.config._configpath for test in tests]
+    with pytest.raises(SystemExit):
+        syncrclone.cli.cli(["--multi"] + paths + ["--jobs", str(jobs)])
+    assert os.getcwd() == PWD0
+    summary = [line for _, line in syncrclone.log.hist]
+    assert any("Multi summary: 2 OK, 1 FAILED" in line for line in summary)
+
+    for ii, test in enumerate(tests[:2]):
+        os.chdir(test.pwd)
+        assert test.read(f"B/new{ii}.txt") == f"new {ii}"
+        assert test.compare_tree() == set()
+    os.chdir(PWD0)
+
+
+def test_multi_tools():
+    """Finding configs and remote keys for --multi"""
+    from syncrclone.multi import find_configs, remote_key
+
+    assert remote_key("gdrive:sub/dir") == "gdrive:"
+    assert remote_key("gdrive:") == "gdrive:"
+    assert remote_key(":s3,provider=AWS:bucket/dir") == ":s3,provider=AWS:"
+    assert remote_key("local/path") is None
+    assert remote_key("/abs/path:with:colon") is None
+    assert remote_key("C:\\Users\\me") is None
+
+    root = os.path.join(PWD0, "testdirs", "multi_tools")
+    shutil.rmtree(root, ignore_errors=True)
+    for path in ["a.py", "b.py", "c.txt", "sub/.syncrclone/config.py"]:
+        os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+        with open(os.path.join(root, path), "wt") as file:
+            file.write("")
+
+    found = find_configs([root, os.path.join(root, "a.py")])
+    assert [os.path.relpath(path, root) for path in found] == [
+        "a.py",
+        "b.py",
+        os.path.join("sub", ".syncrclone", "config.py"),
+    ]
+
+
+def test_rclone_cache():
+    """Test the on-disk cache of rclone results and its keys"""
+    from syncrclone import rclonecache
+
+    tmpdir = os.path.join(PWD0, "testdirs", "rclone_cache")
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    exe = os.path.join(tmpdir, "rclone")
+    with open(exe, "wt") as fp:
+        fp.write("#!/bin/sh\n")
+    os.chmod(exe, 0o755)
+    assert rclonecache.exe_key("does-not-exist-rclone") is None
+    assert rclonecache.key("does-not-exist-rclone", {}, "version") is None
+
+    conf = os.path.join(tmpdir, "rclone.conf")
+
+    def write_conf(path="/data"):
+        with open(conf, "wt") as fp:
+            fp.write(
+                textwrap.dedent(
+                    f"""\
+                    [base]
+                    type = local
+
+                    [secret]
+                    type = crypt
+                    remote = base:{path}
+
+                    [other]
+                    type = local
+                    """
+                )
+            )
+
+    write_conf()
+    env = {"RCLONE_CONFIG": conf, "HOME": tmpdir}
+    assert rclonecache.config_path(env) == conf
+    assert rclonecache.config_path(env, ["--config", "c.conf"]) == "c.conf"
+    assert rclonecache.config_path(env, ["--config=c.conf"]) == "c.conf"
+
+    assert rclonecache.remote_name("secret:sub/dir") == "secret"
+    assert rclonecache.remote_name("secret,opt=val:") == "secret"
+    for remote in ["/local/path", "rel/path", ":local:", "C:\\dir"]:
+        assert rclonecache.remote_name(remote) is None
+
+    # Wrapped remotes are followed
+    assert rclonecache.remote_def("secret:sub", env) == [
+        "[secret]",
+        "type = crypt",
+        "remote = base:/data",
+        "[base]",
+        "type = local",
+    ]
+
+    def key(remote, env=env):
+        return rclonecache.key(exe, env, "features", remote=remote)
+
+    key0, other0 = key("secret:sub"), key("other:")
+    assert key0 == key("secret:sub")
+    assert key0 != key("secret:sub2")
+    assert key0 != key("secret:sub", env=env | {"RCLONE_FAST_LIST": "true"})
+    assert key0 == key("secret:sub", env=env | {"OTHER": "ignored"})
+
+    write_conf("/data2")  # Changing a wrapped remote changes the key
+    assert key("secret:sub") != key0
+    assert key("other:") == other0
+
+    os.utime(exe, ns=(0, 0))  # New rclone
+    assert key("other:") != other0
+
+    path = os.path.join(tmpdir, "cache", "rclone.json")  # Will make "cache"
+    assert rclonecache.get(key0, 100, path=path) is None
+    rclonecache.put(key0, {"Copy": True}, 100, path=path)
+    assert rclonecache.get(key0, 100, path=path) == {"Copy": True}
+    assert rclonecache.get(key0, -1, path=path) is None  # Expired
+
+    # Expired entries are removed on put
+    rclonecache.put(other0, {}, -1, path=path)
+    with open(path) as fp:
+        assert set(json.load(fp)) == {other0}
+
+    # Concurrent puts (e.g. --multi) keep every entry
+    import threading
+
+    threads = [
+        threading.Thread(target=rclonecache.put, args=(f"k{ii}", ii, 100, path))
+        for ii in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for ii in range(20):
+        assert rclonecache.get(f"k{ii}", 100, path=path) == ii
+
+
+def test_watch():
+    """--watch syncs the paths that change on A after the first sync"""
+    import threading
+    import syncrclone.watch
+
+    set_debug(False)
+    test = testutils.Tester("watch", "A", "B")
+    test.config.watch_delay = 0.5
+    test.write_config()
+    test.write_pre("A/keep.txt", "keep")
+    test.write_pre("A/dir/mod.txt", "mod")
+    test.write_pre("A/dir/sub/deep.txt", "deep")
+    test.setup()
+
+    def change():
+        time.sleep(3)  # Should be after the first sync (it is fine if not)
+        test.write_post("A/new.txt", "new")
+        test.write_post("A/dir/mod.txt", "modified", add_dt=50)
+        test.move("A/keep.txt", "A/moved/keep.txt")
+        test.move("A/dir/sub", "A/dir/sub2")  # The whole directory
+
+    thread = threading.Thread(target=change)
+    thread.start()
+    syncrclone.watch._TEST_CYCLES = 1
+    try:
+        obj = test.sync(["--watch"])
+    finally:
+        syncrclone.watch._TEST_CYCLES = None
+    thread.join()
+
+    assert obj.incremental
+    assert "dir/sub/deep.txt" in obj.incremental[0]  # From the last list
+    assert "dir/sub2/deep.txt" in obj.incremental[0]  # From disk
+    assert "dir/mod.txt" in obj.incremental[0]
+
+    assert test.read("B/new.txt") == "new"
+    assert test.read("B/dir/mod.txt") == "modified"
+    assert test.read("B/moved/keep.txt") == "keep"
+    assert test.read("B/dir/sub2/deep.txt") == "deep"
+    assert test.compare_tree() == set()
+
+    # The saved lists are complete
+    assert {f["Path"] for f in obj.new_listB} == {
+        "new.txt",
+        "dir/mod.txt",
+        "moved/keep.txt",
+        "dir/sub2/deep.txt",
+    }
+    os.chdir(PWD0)
+
+
+def test_watcher():
+    """Changes found by the watchers and expanded to file paths"""
+    from syncrclone import watch
+
+    root = os.path.join(PWD0, "testdirs", "watcher")
+
+    def reset():
+        shutil.rmtree(root, ignore_errors=True)
+        os.makedirs(os.path.join(root, "d1", "sub"))
+        os.makedirs(os.path.join(root, ".syncrclone"))
+        with open(os.path.join(root, "d1", "sub", "file"), "wt") as fp:
+            fp.write("file")
+
+    def write(path):
+        with open(os.path.join(root, path), "wt") as fp:
+            fp.write(path)
+
+    watchers = [lambda: watch.PollWatcher(root, interval=0.1)]
+    if sys.platform.startswith("linux"):
+        watchers.append(lambda: watch.InotifyWatcher(root))
+
+    for new_watcher in watchers:
+        reset()
+        watcher = new_watcher()
+        try:
+            write("new.txt")
+            write(".syncrclone/ignored")
+            os.rename(os.path.join(root, "d1"), os.path.join(root, "d2"))
+            os.makedirs(os.path.join(root, "d3", "deep"))
+            write("d3/deep/file")
+
+            paths, dirs, overflow = watcher.wait(5, 0.5)
+            assert not overflow
+            expanded = watch.expand(paths, dirs, root, [[{"Path": "d1/sub/file"}]])
+            assert expanded == {"new.txt", "d1/sub/file", "d2/sub/file", "d3/deep/file"}
+
+            write("d2/sub/later")  # The moved directory is still watched
+            paths, dirs, _ = watcher.wait(5, 0.5)
+            assert watch.expand(paths, dirs, root, []) == {"d2/sub/later"}
+
+            assert watcher.wait(0.5, 0.1) == (set(), set(), False)
+        finally:
+            watcher.stop()
+
+    config = syncrclone.cli.Config()
+    config.filter_flags = ["--exclude-if-present", ".ignore"]
+    assert watch.can_limit(config, {"a", "b/c"})
+    assert not watch.can_limit(config, {"a", "b/.ignore"})
+    assert not watch.can_limit(config, {" lead"})
+    assert not watch.can_limit(config, {f"{ii}" for ii in range(watch.MAX_PATHS + 1)})
+
+
+def test_daemon():
+    """--daemon keeps the lists in memory unless the state changed"""
+    import socket
+    import threading
+    import syncrclone.daemon
+
+    set_debug(False)
+    test = testutils.Tester("daemon", "A", "B")
+    test.config.daemon_interval = None
+    test.config.daemon_socket = "daemon.sock"
+    test.write_config()
+    test.write_pre("A/file.txt", "file")
+    test.setup()
+
+    sockpath = os.path.join(test.pwd, "daemon.sock")
+
+    def trigger():
+        t0 = time.time()
+        hist = syncrclone.log.hist
+        while not any("Next sync when triggered" in line for _, line in hist):
+            assert time.time() - t0 < 60
+            time.sleep(0.1)
+        test.write_post("A/new.txt", "new")
+        (statepath,) = glob.glob(os.path.join(test.pwd, "B/.syncrclone/B-*_fl.json.xz"))
+        os.utime(statepath, (0, 0))  # Looks like another machine synced B
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(sockpath)
+            sock.sendall(b"sync\n")
+            assert sock.recv(100) == b"OK\n"
+
+    thread = threading.Thread(target=trigger)
+    thread.start()
+    syncrclone.daemon._TEST_CYCLES = 1
+    try:
+        obj = test.sync(["--daemon"])
+    finally:
+        syncrclone.daemon._TEST_CYCLES = None
+    thread.join()
+
+    lines = [line for _, line in syncrclone.log.hist]  # includes debug
+    assert any("A: Using the state from the last run" in line for line in lines)
+    assert any("State on B changed since the last run" in line for line in lines)
+    assert test.read("B/new.txt") == "new"
+    assert test.compare_tree() == set()
+    assert not os.path.exists(sockpath)
+    os.chdir(PWD0)
+
+
+def test_daemon_trigger():
+    """Triggering the daemon with the socket and SIGUSR1"""
+    import signal
+    import socket
+    from syncrclone.daemon import Trigger
+
+    tmpdir = os.path.join(PWD0, "testdirs", "daemon_trigger")
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+    sockpath = os.path.join(tmpdir, "sock")
+
+    def send(cmd):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(sockpath)
+            sock.sendall(cmd + b"\n")
+            return sock.recv(100)
+
+    handler = signal.getsignal(signal.SIGUSR1)
+    trigger = Trigger(sockpath)
+    try:
+        assert trigger.wait(0.1)  # Timeout
+        assert send(b"sync") == b"OK\n"
+        t0 = time.time()
+        assert trigger.wait(10)
+        assert time.time() - t0 < 5
+
+        assert send(b"what").startswith(b"Unknown command")
+
+        os.kill(os.getpid(), signal.SIGUSR1)
+        t0 = time.time()
+        assert trigger.wait(10)
+        assert time.time() - t0 < 5
+
+        assert send(b"stop") == b"OK\n"
+        assert not trigger.wait(10)
+    finally:
+        trigger.close()
+    assert not os.path.exists(sockpath)
+    assert signal.getsignal(signal.SIGUSR1) == handler
+
+
+def test_subpath():
+    """--subpath only syncs that directory and keeps the rest of the state"""
+    set_debug(False)
+    test = testutils.Tester("subpath", "A", "B")
+    test.write_config()
+    for path in ["sub/a.txt", "sub/b.txt", "other/c.txt", "d.txt"]:
+        test.write_pre(f"A/{path}", path)
+    test.setup()
+
+    test.write_post("A/sub/a.txt", "modified", add_dt=50)
+    test.write_post("A/sub/new.txt", "new")
+    test.write_post("A/other/new.txt", "new")
+    test.move("A/sub/b.txt", "A/other/b.txt")  # Out of subpath
+    test.move("A/other/c.txt", "A/sub/c.txt")  # Into subpath
+    test.write_post("B/d.txt", "modified", add_dt=50)
+
+    obj = test.sync(["--subpath", "/sub/"])
+    assert obj.config.subpath == "sub"
+
+    assert test.read("B/sub/a.txt") == "modified"
+    assert test.read("B/sub/new.txt") == "new"
+    assert test.read("B/sub/c.txt") == "other/c.txt"
+    assert not os.path.exists("B/sub/b.txt")  # Deleted
+    for path in ["B/other/new.txt", "B/other/b.txt"]:
+        assert not os.path.exists(path)
+    assert test.read("B/other/c.txt") == "other/c.txt"  # Not synced yet
+    assert test.read("A/d.txt") == "d.txt"
+
+    # The outside files are still in the state from before
+    assert {f["Path"] for f in obj.new_listA} == {
+        "d.txt",
+        "other/c.txt",
+        "sub/a.txt",
+        "sub/c.txt",
+        "sub/new.txt",
+    }
+
+    # Then a full sync picks up the rest
+    test.sync()
+    assert test.compare_tree() == set()
+    assert not os.path.exists("B/other/c.txt")
+    assert test.read("B/other/b.txt") == "sub/b.txt"
+    assert test.read("A/d.txt") == "modified"
+
+    for bad in ["", "/", "../sub", ".syncrclone/x", "sub/../other"]:
+        with pytest.raises(SystemExit):
+            test.sync(["--subpath", bad])
+    os.chdir(PWD0)
+
+
+def test_RFC3339_to_unix():
+    """
+    The fast parser must agree exactly with the original one, including the
+    (odd) handling of the fractional seconds, and fail on the same bad input
+    """
+    import random
+
+    rand = random.Random(1)
+    for _ in range(10000):
+        t = time.gmtime(4e9 * rand.random() - 1e9)
+        frac = f"{rand.randrange(10**9):09d}"[: rand.randint(0, 9)]
+        tz = rand.choice(["Z", "-05:00", "+01:30", "+00:00", "-12:45"])
+        timestr = time.strftime("%Y-%m-%dT%H:%M:%S", t) + (f".{frac}" if frac else "")
+        timestr += tz
+
+        new = syncrclone.utils.RFC3339_to_unix(timestr)
+        assert new == syncrclone.utils._RFC3339_to_unix(timestr), timestr
+
+    assert syncrclone.utils.RFC3339_to_unix_many(
+        ["1970-01-01T00:00:01.5Z", None, "1970-01-01T01:00:00+01:00"]
+    ) == [1.000005, None, 0.0]
+
+    for bad in [
+        "2020-02-30T00:00:00Z",
+        "2020-01-01T24:00:00Z",
+        "2020-01-01T00:00:60Z",
+        "2020-01-01T00:00:00.Z",
+        "2020-01-01T00:00:00+0100",
+        "bad",
+    ]:
+        with pytest.raises(ValueError):
+            syncrclone.utils._RFC3339_to_unix(bad)
+        with pytest.raises(ValueError):
+            syncrclone.utils.RFC3339_to_unix(bad)
+
+
 if __name__ == "__main__":
     test_main(
         # remoteA,renamesA,workdirA,remoteB,renamesB,workdirB,compare